@@ -0,0 +1,90 @@
+import argparse
+import json
+import statistics
+import time
+
+from utils import ytdlp_pool
+from utils.helpers import run_yt_dlp, select_random_cookie_file
+
+DEFAULT_VIDEO_IDS = ['dQw4w9WgXcQ', 'jNQXAC9IVRw', '9bZkp7q19f0']
+
+def bench_subprocess(video_ids, iterations, cookie_file):
+    """Холодный запуск бинарника yt-dlp --dump-json на каждое извлечение."""
+    timings = []
+    for _ in range(iterations):
+        for video_id in video_ids:
+            url = f'https://www.youtube.com/watch?v={video_id}'
+            start = time.perf_counter()
+            output = run_yt_dlp(['--dump-json', '--no-warnings', url], cookie_file)
+            elapsed = time.perf_counter() - start
+            if output:
+                json.loads(output)
+                timings.append(elapsed)
+            else:
+                print(f"  subprocess: extraction failed for {video_id}")
+    return timings
+
+def bench_pool(video_ids, iterations, cookie_file, pool_size):
+    """Извлечение на прогретом пуле YoutubeDL (прогрев не входит в замер)."""
+    pool = ytdlp_pool.YoutubeDLPool(size=pool_size)
+    warm_start = time.perf_counter()
+    pool.warm_up([cookie_file])
+    warm_up_time = time.perf_counter() - warm_start
+
+    timings = []
+    for _ in range(iterations):
+        for video_id in video_ids:
+            url = f'https://www.youtube.com/watch?v={video_id}'
+            start = time.perf_counter()
+            info = pool.extract_info(url, cookie_file)
+            elapsed = time.perf_counter() - start
+            if info:
+                timings.append(elapsed)
+            else:
+                print(f"  pool: extraction failed for {video_id}")
+    return timings, warm_up_time
+
+def summarize(name, timings):
+    if not timings:
+        print(f"{name:<12} no successful extractions")
+        return
+    ordered = sorted(timings)
+    p95 = ordered[min(len(ordered) - 1, int(round(len(ordered) * 0.95)) - 1)]
+    print(f"{name:<12} n={len(timings):<4} "
+          f"p50={statistics.median(timings):.3f}s "
+          f"mean={statistics.mean(timings):.3f}s "
+          f"p95={p95:.3f}s "
+          f"min={ordered[0]:.3f}s max={ordered[-1]:.3f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение задержки извлечения: бинарник yt-dlp vs прогретый пул YoutubeDL')
+    parser.add_argument('video_ids', nargs='*', default=DEFAULT_VIDEO_IDS)
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--pool-size', type=int, default=1)
+    parser.add_argument('--cookies', default=None, help='Файл cookies (по умолчанию случайный из доступных)')
+    args = parser.parse_args()
+
+    cookie_file = args.cookies or select_random_cookie_file()
+
+    print(f"Videos: {', '.join(args.video_ids)}; iterations: {args.iterations}")
+    print("Running cold subprocess benchmark...")
+    subprocess_timings = bench_subprocess(args.video_ids, args.iterations, cookie_file)
+
+    pool_timings, warm_up_time = [], 0.0
+    if ytdlp_pool.is_available():
+        print("Running warm pool benchmark...")
+        pool_timings, warm_up_time = bench_pool(args.video_ids, args.iterations, cookie_file, args.pool_size)
+    else:
+        print("yt_dlp module is not installed, skipping pool benchmark (pip install yt-dlp)")
+
+    print()
+    summarize('subprocess', subprocess_timings)
+    summarize('pool', pool_timings)
+    if pool_timings:
+        print(f"pool warm-up (one-off): {warm_up_time:.3f}s")
+    if subprocess_timings and pool_timings:
+        speedup = statistics.median(subprocess_timings) / statistics.median(pool_timings)
+        print(f"p50 speedup: x{speedup:.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+import argparse
+
+from utils.video_cache import CACHE_DIR, migrate_flat_cache
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Переносит кэш видео из плоской папки assets/temp ({video_id}_{quality}.mp4) '
+                    'в шардированную структуру assets/temp/<aa>/<bb>/<sha1>.mp4. Запускать при остановленном сервере.')
+    parser.add_argument('--dry-run', action='store_true', help='только показать, какие файлы будут перенесены')
+    args = parser.parse_args()
+
+    print(f"Cache directory: {CACHE_DIR}")
+    migrate_flat_cache(dry_run=args.dry_run)
@@ -1,16 +1,17 @@
-from flask import Blueprint, request, jsonify, Response, redirect
-import json
-import requests
+from flask import Blueprint, request, jsonify
 import subprocess
 import re
 import random
 from urllib.parse import quote
 from utils.video_processing import get_direct_video_url, get_real_direct_video_url, get_video_url
 from utils.helpers import (
-    run_yt_dlp, get_channel_thumbnail, get_proxy_url, get_video_proxy_url,
-    get_api_key, get_api_key_rotated, get_available_formats, get_cookies_files
+    get_channel_thumbnail, get_channel_thumbnails, get_proxy_url, get_video_proxy_url,
+    get_api_key, get_api_key_rotated, get_available_formats
 )
 from utils.auth import refresh_access_token
+from utils.prefetch import prefetch_feed
+from utils.api_cache import api_get
+from utils import http_client
 import string
 from yt import config
 
@@ -38,104 +39,6 @@ def setup_additional_routes(config):
             print('Error in get-direct-video-url:', e)
             return jsonify({'error': 'Internal server error'}), 500
 
-    @additional_bp.route('/direct_audio_url', methods=['GET', 'HEAD'])
-    def direct_audio_url():
-        try:
-            video_id = request.args.get('video_id')
-            proxy_param = request.args.get('proxy', 'true').lower()
-            use_proxy = proxy_param != 'false'
-            
-            if not video_id:
-                response = jsonify({'error': 'ID видео не был передан.'})
-                response.status_code = 400
-                response.headers['Content-Length'] = str(len(response.get_data()))
-                return response
-
-            # Получаем аудио URL используя bestaudio формат
-            url = f'https://www.youtube.com/watch?v={video_id}'
-            audio_url = run_yt_dlp(['-f', 'bestaudio', '--get-url', url])
-            
-            # Если не удалось получить URL, пробуем с другим cookie файлом
-            if not audio_url:
-                cookies_files = get_cookies_files()
-                for cookie_file in cookies_files:
-                    audio_url = run_yt_dlp(['-f', 'bestaudio', '--get-url', url], cookie_file)
-                    if audio_url:
-                        break
-            
-            if not audio_url:
-                response = jsonify({'error': 'Не удалось получить ссылку на аудио поток.'})
-                response.status_code = 500
-                response.headers['Content-Length'] = str(len(response.get_data()))
-                return response
-
-            # Если proxy=false, перенаправляем на прямую ссылку
-            if not use_proxy:
-                return redirect(audio_url)
-
-            # Получаем информацию о длительности видео
-            duration_value = None
-            try:
-                info_output = run_yt_dlp(['--dump-json', '--no-warnings', url])
-                
-                if info_output:
-                    try:
-                        info = json.loads(info_output)
-                        duration_value = info.get('duration')
-                    except json.JSONDecodeError as e:
-                        print(f"Error parsing JSON for duration: {e}")
-            except Exception as e:
-                print(f"Error fetching duration for video_id {video_id}: {e}")
-
-            # Обработка HEAD запроса
-            if request.method == 'HEAD':
-                response = Response(None, mimetype='audio/m4a')
-                if duration_value:
-                    duration_str = str(int(duration_value)) if isinstance(duration_value, (int, float)) else str(duration_value)
-                    response.headers['X-Content-Duration'] = duration_str
-                    response.headers['Content-Duration'] = duration_str
-                    response.headers['X-Video-Duration'] = duration_str
-                    response.headers['X-Duration-Seconds'] = duration_str
-                response.headers['Accept-Ranges'] = 'bytes'
-                response.headers['Content-Type'] = 'audio/m4a'
-                return response
-
-            # Проксируем аудио поток
-            headers = {
-                'Range': request.headers.get('Range', 'bytes=0-'),
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            resp = requests.get(audio_url, headers=headers, stream=True, timeout=config['request_timeout'])
-            
-            def generate():
-                try:
-                    for chunk in resp.iter_content(chunk_size=8192):
-                        if chunk:
-                            yield chunk
-                finally:
-                    pass
-            
-            response = Response(generate(), status=resp.status_code, mimetype='audio/m4a')
-            response.headers['Accept-Ranges'] = 'bytes'
-            response.headers['Content-Type'] = resp.headers.get('content-type', 'audio/m4a')
-            if 'content-length' in resp.headers:
-                response.headers['Content-Length'] = resp.headers['content-length']
-            if 'content-range' in resp.headers:
-                response.headers['Content-Range'] = resp.headers['content-range']
-            if duration_value:
-                duration_str = str(int(duration_value)) if isinstance(duration_value, (int, float)) else str(duration_value)
-                response.headers['X-Content-Duration'] = duration_str
-                response.headers['Content-Duration'] = duration_str
-                response.headers['X-Video-Duration'] = duration_str
-                response.headers['X-Duration-Seconds'] = duration_str
-            return response
-        except Exception as e:
-            print(f'Error in direct_audio_url: {e}')
-            response = jsonify({'error': f'Internal server error: {str(e)}'})
-            response.status_code = 500
-            response.headers['Content-Length'] = str(len(response.get_data()))
-            return response
-
     @additional_bp.route('/get_subscriptions.php', methods=['GET'])
     def get_default_subscriptions():
         try:
@@ -205,7 +108,7 @@ def setup_additional_routes(config):
             }
 
             try:
-                response = requests.post(endpoint, json=payload, params=params, headers=headers, timeout=30)
+                response = http_client.post(endpoint, json=payload, params=params, headers=headers, timeout=30)
                 response.raise_for_status()
                 json_data = response.json()
             except Exception as e:
@@ -223,6 +126,7 @@ def setup_additional_routes(config):
                         'thumbnail': f"{config['mainurl']}thumbnail/{video.get('video_id')}",
                         'channel_thumbnail': ''
                     })
+            prefetch_feed([v['video_id'] for v in formatted_videos], 'recommendations')
             return jsonify(formatted_videos)
         except Exception as e:
             msg = str(e).encode('ascii', errors='ignore').decode('ascii')
@@ -239,7 +143,7 @@ def setup_additional_routes(config):
             if not video_id:
                 return jsonify({'error': 'ID видео не был передан.'}), 400
 
-            video_resp = requests.get(f"https://www.googleapis.com/youtube/v3/videos?part=snippet&id={video_id}&key={apikey}")
+            video_resp = api_get(f"https://www.googleapis.com/youtube/v3/videos?part=snippet&id={video_id}&key={apikey}")
             video_resp.raise_for_status()
             video_data = video_resp.json()
             videoInfo = video_data.get('items', [{}])[0].get('snippet')
@@ -248,17 +152,19 @@ def setup_additional_routes(config):
 
             relatedVideos = []
             search_query = videoInfo['title'].split(' ')[0]
-            search_resp = requests.get(f"https://www.googleapis.com/youtube/v3/search?part=snippet&q={quote(search_query)}&type=video&maxResults={count}&key={apikey}")
+            search_resp = api_get(f"https://www.googleapis.com/youtube/v3/search?part=snippet&q={quote(search_query)}&type=video&maxResults={count}&key={apikey}")
             search_data = search_resp.json() if search_resp.status_code == 200 else {'items': []}
+            channelThumbnails = get_channel_thumbnails(
+                [video['snippet']['channelId'] for video in search_data.get('items', [])], apikey, config)
 
             for video in search_data.get('items', []):
                 if video['id']['videoId'] == video_id:
                     continue
                 vinfo = video['snippet']
                 vid = video['id']['videoId']
-                channelThumbnail = get_channel_thumbnail(vinfo['channelId'], apikey, config)
+                channelThumbnail = channelThumbnails.get(vinfo['channelId'], '')
                 try:
-                    stats = requests.get(f"https://www.googleapis.com/youtube/v3/videos?part=statistics&id={vid}&key={apikey}", timeout=5).json()
+                    stats = api_get(f"https://www.googleapis.com/youtube/v3/videos?part=statistics&id={vid}&key={apikey}", timeout=5).json()
                     viewCount = stats['items'][0]['statistics']['viewCount'] if stats.get('items') else '0'
                 except:
                     viewCount = '0'
@@ -286,12 +192,12 @@ def setup_additional_routes(config):
                                 continue
                             vid = rec['video_id']
                             try:
-                                stats = requests.get(f"https://www.googleapis.com/youtube/v3/videos?part=statistics&id={vid}&key={apikey}", timeout=5).json()
+                                stats = api_get(f"https://www.googleapis.com/youtube/v3/videos?part=statistics&id={vid}&key={apikey}", timeout=5).json()
                                 viewCount = stats['items'][0]['statistics']['viewCount'] if stats.get('items') else '0'
                             except:
                                 viewCount = '0'
                             try:
-                                ch = requests.get(f"https://www.googleapis.com/youtube/v3/videos?part=snippet&id={vid}&key={apikey}", timeout=5).json()
+                                ch = api_get(f"https://www.googleapis.com/youtube/v3/videos?part=snippet&id={vid}&key={apikey}", timeout=5).json()
                                 ch_thumb = get_channel_thumbnail(ch['items'][0]['snippet']['channelId'], apikey, config) if ch.get('items') else ''
                             except:
                                 ch_thumb = ''
@@ -381,7 +287,7 @@ def setup_additional_routes(config):
                 }
             }
             player_payload = {**context, "videoId": video_id, "cpn": generate_cpn()}
-            player_resp = requests.post(f"https://www.youtube.com/youtubei/v1/player?key={INNERTUBE_API_KEY}", headers=headers, json=player_payload, timeout=15)
+            player_resp = http_client.post(f"https://www.youtube.com/youtubei/v1/player?key={INNERTUBE_API_KEY}", headers=headers, json=player_payload, timeout=15)
             if player_resp.status_code != 200:
                 return jsonify({'error': 'Player failed', 'body': player_resp.text[:500]}), 400
 
@@ -398,7 +304,7 @@ def setup_additional_routes(config):
                 return jsonify({'error': 'No feedback token'}), 500
 
             feedback_payload = {**context, "feedbackTokens": [feedback_token]}
-            feedback_resp = requests.post(f"https://www.youtube.com/youtubei/v1/feedback?key={INNERTUBE_API_KEY}", headers=headers, json=feedback_payload, timeout=15)
+            feedback_resp = http_client.post(f"https://www.youtube.com/youtubei/v1/feedback?key={INNERTUBE_API_KEY}", headers=headers, json=feedback_payload, timeout=15)
             if feedback_resp.status_code == 200:
                 return jsonify({'status': 'success', 'message': f'Video {video_id} marked as watched'})
             else:
@@ -428,7 +334,7 @@ def setup_additional_routes(config):
             'Origin': 'https://www.youtube.com', 'Referer': 'https://www.youtube.com/'
         }
         try:
-            resp = requests.post(endpoint, json=payload, params=params, headers=headers, timeout=10)
+            resp = http_client.post(endpoint, json=payload, params=params, headers=headers, timeout=10)
             resp.raise_for_status()
             return resp.json()
         except:
@@ -518,7 +424,7 @@ def setup_additional_routes(config):
                 'User-Agent': payload["context"]["client"]["userAgent"],
                 'Origin': 'https://www.youtube.com', 'Referer': 'https://www.youtube.com/'
             }
-            resp = requests.post(endpoint, json=payload, params=params, headers=headers, timeout=30)
+            resp = http_client.post(endpoint, json=payload, params=params, headers=headers, timeout=30)
             resp.raise_for_status()
             return extract_innertube_data(resp.json(), max_count)
         except:
@@ -548,7 +454,7 @@ def setup_additional_routes(config):
             'Origin': 'https://www.youtube.com', 'Referer': 'https://www.youtube.com/'
         }
         try:
-            resp = requests.post(endpoint, json=payload, params=params, headers=headers, timeout=30)
+            resp = http_client.post(endpoint, json=payload, params=params, headers=headers, timeout=30)
             resp.raise_for_status()
             return resp.json()
         except:
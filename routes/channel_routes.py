@@ -1,7 +1,7 @@
 from flask import Blueprint, request, jsonify, redirect
-import requests
 from urllib.parse import quote
 from utils.helpers import get_channel_thumbnail, get_proxy_url, get_api_key, get_api_key_rotated, replace_youtube_thumbnail_domain
+from utils.api_cache import api_get
 
 # Create blueprint
 channel_bp = Blueprint('channel', __name__)
@@ -19,7 +19,7 @@ def setup_channel_routes(config):
             if not author:
                 return jsonify({'error': 'Author parameter is required'})
 
-            search_resp = requests.get(f"https://www.googleapis.com/youtube/v3/search?part=snippet&q={quote(author)}&type=channel&maxResults=1&key={apikey}")
+            search_resp = api_get(f"https://www.googleapis.com/youtube/v3/search?part=snippet&q={quote(author)}&type=channel&maxResults=1&key={apikey}")
             search_resp.raise_for_status()
             data = search_resp.json()
             channelId = data['items'][0]['id']['channelId'] if data.get('items') and data['items'] else None
@@ -42,7 +42,7 @@ def setup_channel_routes(config):
             if not channel_id:
                 return jsonify({'error': 'Channel ID parameter is required'})
 
-            channel_resp = requests.get(f"https://www.googleapis.com/youtube/v3/channels?part=snippet,statistics,brandingSettings&id={channel_id}&key={apikey}", timeout=config['request_timeout'])
+            channel_resp = api_get(f"https://www.googleapis.com/youtube/v3/channels?part=snippet,statistics,brandingSettings&id={channel_id}&key={apikey}", timeout=config['request_timeout'])
             channel_resp.raise_for_status()
             channel_data = channel_resp.json()
             channel_info = channel_data['items'][0] if channel_data['items'] else None
@@ -53,12 +53,14 @@ def setup_channel_routes(config):
             videos = []
             nextPageToken = ''
             totalVideos = 0
+            # У всех видео один канал
+            channelThumbnail = get_channel_thumbnail(channel_id, apikey, config)
 
             while totalVideos < count:
                 videos_url = f"https://www.googleapis.com/youtube/v3/search?part=snippet&channelId={channel_id}&maxResults=50&type=video&order=date&key={apikey}"
                 if nextPageToken:
                     videos_url += f"&pageToken={nextPageToken}"
-                videos_resp = requests.get(videos_url, timeout=config['request_timeout'])
+                videos_resp = api_get(videos_url, timeout=config['request_timeout'])
                 videos_resp.raise_for_status()
                 videos_data = videos_resp.json()
 
@@ -68,7 +70,7 @@ def setup_channel_routes(config):
                     video_ids_str = ','.join(video_ids)
                     
                     # Get video statistics (views, etc.)
-                    stats_resp = requests.get(f"https://www.googleapis.com/youtube/v3/videos?part=statistics&id={video_ids_str}&key={apikey}", timeout=config['request_timeout'])
+                    stats_resp = api_get(f"https://www.googleapis.com/youtube/v3/videos?part=statistics&id={video_ids_str}&key={apikey}", timeout=config['request_timeout'])
                     stats_resp.raise_for_status()
                     stats_data = stats_resp.json()
                     
@@ -83,7 +85,6 @@ def setup_channel_routes(config):
                             break
                         videoInfo = video['snippet']
                         videoId = video['id']['videoId']
-                        channelThumbnail = get_channel_thumbnail(channel_id, apikey, config)
                         videos.append({
                             'title': videoInfo['title'],
                             'author': channel_info['snippet']['title'],
@@ -125,7 +126,7 @@ def setup_channel_routes(config):
             if not apikey:
                 return jsonify({'channel_thumbnail': ''})
 
-            video_resp = requests.get(f"https://www.googleapis.com/youtube/v3/videos?id={video_id}&key={apikey}&part=snippet")
+            video_resp = api_get(f"https://www.googleapis.com/youtube/v3/videos?id={video_id}&key={apikey}&part=snippet")
             video_resp.raise_for_status()
             data = video_resp.json()
             channelId = data['items'][0]['snippet']['channelId'] if data.get('items') and data['items'] else None
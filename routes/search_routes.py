@@ -1,8 +1,10 @@
 from flask import Blueprint, request, jsonify, redirect
-import requests
 import json
 from urllib.parse import quote
-from utils.helpers import get_channel_thumbnail, get_api_key, get_api_key_rotated, get_proxy_url, replace_youtube_thumbnail_domain
+from utils.helpers import get_channel_thumbnail, get_channel_thumbnails, get_api_key, get_api_key_rotated, get_proxy_url, replace_youtube_thumbnail_domain
+from utils.prefetch import prefetch_feed
+from utils.api_cache import api_get
+from utils import http_client
 
 # Create blueprint
 search_bp = Blueprint('search', __name__)
@@ -25,10 +27,13 @@ def setup_search_routes(config):
             if search_type not in valid_types:
                 return jsonify({'error': f'Invalid type parameter. Must be one of: {", ".join(valid_types)}'})
             
-            resp = requests.get(f"https://www.googleapis.com/youtube/v3/search?part=snippet&q={quote(query)}&maxResults={count}&type={search_type}&key={apikey}")
+            resp = api_get(f"https://www.googleapis.com/youtube/v3/search?part=snippet&q={quote(query)}&maxResults={count}&type={search_type}&key={apikey}")
             resp.raise_for_status()
             data = resp.json()
             searchResults = []
+            # Аватары всех каналов страницы - одним запросом
+            channelThumbnails = get_channel_thumbnails(
+                [item['snippet'].get('channelId') for item in data.get('items', []) if 'snippet' in item], apikey, config)
             
             for item in data.get('items', []):
                 if 'id' not in item:
@@ -47,7 +52,7 @@ def setup_search_routes(config):
                         'author': itemInfo['channelTitle'],
                         'video_id': itemId,
                         'thumbnail': f"{config['mainurl']}thumbnail/{itemId}",
-                        'channel_thumbnail': get_channel_thumbnail(itemInfo['channelId'], apikey, config) if itemInfo.get('channelId') else '',
+                        'channel_thumbnail': channelThumbnails.get(itemInfo.get('channelId'), ''),
                     }
                 elif search_type == 'channel':
                     if 'channelId' not in item['id']:
@@ -79,7 +84,7 @@ def setup_search_routes(config):
                         'author': itemInfo['channelTitle'],
                         'playlist_id': itemId,
                         'thumbnail': f"{config['mainurl']}thumbnail/{video_id}" if video_id else thumbnail_url,
-                        'channel_thumbnail': get_channel_thumbnail(itemInfo['channelId'], apikey, config) if itemInfo.get('channelId') else '',
+                        'channel_thumbnail': channelThumbnails.get(itemInfo.get('channelId'), ''),
                     }
                 
                 # Only append if we have a valid result
@@ -96,14 +101,16 @@ def setup_search_routes(config):
         try:
             count = int(request.args.get('count', str(config.get('default_count', 50))))
             apikey = get_api_key_rotated(config)
-            resp = requests.get(f"https://www.googleapis.com/youtube/v3/videos?part=snippet&chart=mostPopular&maxResults={count}&key={apikey}")
+            resp = api_get(f"https://www.googleapis.com/youtube/v3/videos?part=snippet&chart=mostPopular&maxResults={count}&key={apikey}")
             resp.raise_for_status()
             data = resp.json()
             topVideos = []
+            channelThumbnails = get_channel_thumbnails(
+                [video['snippet']['channelId'] for video in data.get('items', [])], apikey, config)
             for video in data.get('items', []):
                 videoInfo = video['snippet']
                 videoId = video['id']
-                channelThumbnail = get_channel_thumbnail(videoInfo['channelId'], apikey, config)
+                channelThumbnail = channelThumbnails.get(videoInfo['channelId'], '')
                 topVideos.append({
                     'title': videoInfo['title'],
                     'author': videoInfo['channelTitle'],
@@ -111,6 +118,7 @@ def setup_search_routes(config):
                     'thumbnail': f"{config['mainurl']}thumbnail/{videoId}",
                     'channel_thumbnail': channelThumbnail,
                 })
+            prefetch_feed([v['video_id'] for v in topVideos], 'top')
             return jsonify(topVideos)
         except Exception as e:
             print('Error in get_top_videos:', e)
@@ -125,14 +133,16 @@ def setup_search_routes(config):
             url = f"https://www.googleapis.com/youtube/v3/videos?part=snippet&chart=mostPopular&maxResults={count}&key={apikey}"
             if categoryId:
                 url += f"&videoCategoryId={categoryId}"
-            resp = requests.get(url)
+            resp = api_get(url)
             resp.raise_for_status()
             data = resp.json()
             topVideos = []
+            channelThumbnails = get_channel_thumbnails(
+                [video['snippet']['channelId'] for video in data.get('items', [])], apikey, config)
             for video in data.get('items', []):
                 videoInfo = video['snippet']
                 videoId = video['id']
-                channelThumbnail = get_channel_thumbnail(videoInfo['channelId'], apikey, config)
+                channelThumbnail = channelThumbnails.get(videoInfo['channelId'], '')
                 topVideos.append({
                     'title': videoInfo['title'],
                     'author': videoInfo['channelTitle'],
@@ -140,6 +150,7 @@ def setup_search_routes(config):
                     'thumbnail': f"{config['mainurl']}thumbnail/{videoId}",
                     'channel_thumbnail': channelThumbnail,
                 })
+            prefetch_feed([v['video_id'] for v in topVideos], f'category {categoryId or "all"}')
             return jsonify(topVideos)
         except Exception as e:
             print('Error in get-categories_videos:', e)
@@ -150,7 +161,7 @@ def setup_search_routes(config):
         try:
             region = request.args.get('region', 'US')
             apikey = get_api_key_rotated(config)
-            resp = requests.get(f"https://www.googleapis.com/youtube/v3/videoCategories?part=snippet&regionCode={region}&key={apikey}")
+            resp = api_get(f"https://www.googleapis.com/youtube/v3/videoCategories?part=snippet&regionCode={region}&key={apikey}")
             resp.raise_for_status()
             data = resp.json()
             categories = [{
@@ -176,7 +187,7 @@ def setup_search_routes(config):
                 return jsonify({'error': 'Playlist ID parameter is required'})
 
             # Get playlist information
-            playlist_resp = requests.get(f"https://www.googleapis.com/youtube/v3/playlists?part=snippet,contentDetails&id={playlist_id}&key={apikey}", timeout=config['request_timeout'])
+            playlist_resp = api_get(f"https://www.googleapis.com/youtube/v3/playlists?part=snippet,contentDetails&id={playlist_id}&key={apikey}", timeout=config['request_timeout'])
             playlist_resp.raise_for_status()
             playlist_data = playlist_resp.json()
             playlist_info = playlist_data['items'][0] if playlist_data.get('items') else None
@@ -186,7 +197,7 @@ def setup_search_routes(config):
 
             # Get channel information for channel thumbnail
             channel_id = playlist_info['snippet']['channelId']
-            channel_resp = requests.get(f"https://www.googleapis.com/youtube/v3/channels?part=snippet,statistics&id={channel_id}&key={apikey}", timeout=config['request_timeout'])
+            channel_resp = api_get(f"https://www.googleapis.com/youtube/v3/channels?part=snippet,statistics&id={channel_id}&key={apikey}", timeout=config['request_timeout'])
             channel_resp.raise_for_status()
             channel_data = channel_resp.json()
             channel_info = channel_data['items'][0] if channel_data.get('items') else None
@@ -194,13 +205,15 @@ def setup_search_routes(config):
             videos = []
             nextPageToken = ''
             totalVideos = 0
+            # У всех видео плейлиста один канал
+            channelThumbnail = get_channel_thumbnail(channel_id, apikey, config)
 
             while totalVideos < count:
                 # Get playlist items
                 playlist_items_url = f"https://www.googleapis.com/youtube/v3/playlistItems?part=snippet,contentDetails&playlistId={playlist_id}&maxResults=50&key={apikey}"
                 if nextPageToken:
                     playlist_items_url += f"&pageToken={nextPageToken}"
-                playlist_items_resp = requests.get(playlist_items_url, timeout=config['request_timeout'])
+                playlist_items_resp = api_get(playlist_items_url, timeout=config['request_timeout'])
                 playlist_items_resp.raise_for_status()
                 playlist_items_data = playlist_items_resp.json()
 
@@ -210,7 +223,6 @@ def setup_search_routes(config):
                             break
                         videoInfo = item['snippet']
                         videoId = item['contentDetails']['videoId']
-                        channelThumbnail = get_channel_thumbnail(channel_id, apikey, config)
                         videos.append({
                             'title': videoInfo['title'],
                             'author': channel_info['snippet']['title'] if channel_info else videoInfo['channelTitle'],
@@ -256,7 +268,7 @@ def setup_search_routes(config):
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
             }
-            resp = requests.get(f"https://clients1.google.com/complete/search?client=youtube&hl=en&ds=yt&q={quote(query)}", headers=headers)
+            resp = http_client.get(f"https://clients1.google.com/complete/search?client=youtube&hl=en&ds=yt&q={quote(query)}", headers=headers)
             data = resp.text.replace('window.google.ac.h(', '').rstrip(')')
             suggestions = json.loads(data)[1][:10]
             return jsonify({'query': query, 'suggestions': suggestions})
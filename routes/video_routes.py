@@ -1,31 +1,598 @@
 from flask import Blueprint, request, jsonify, Response, redirect, stream_with_context
 import json
 import requests
-import subprocess
 import threading
 import os
 import re
-import time
 from urllib.parse import quote
 from datetime import datetime
 from typing import Any, Dict, List, Optional, Tuple
-from utils.video_processing import get_direct_video_url, get_real_direct_video_url, get_video_url, get_video_info_ytdlp
-from utils.helpers import run_yt_dlp, get_channel_thumbnail, get_proxy_url, get_video_proxy_url, get_cookies_files, select_random_cookie_file, get_api_key, get_api_key_rotated
+from utils.video_processing import get_direct_video_url, get_real_direct_video_url, get_video_formats
+from utils.helpers import get_video_info, get_cached_video_info, refresh_video_info, get_format_table, get_channel_thumbnails, get_proxy_url, get_cookies_files, get_api_key, get_api_key_rotated
+from utils.api_cache import api_get, get_api_cache
+from utils.api_keys import get_key_scheduler
 from utils.video_cache import (
-    get_cache_path, is_video_cached, get_cached_video_size, should_cache_video,
-    increment_video_view_count, check_and_cleanup_cache
+    get_cache_path, is_video_cached, should_cache_video, increment_video_view_count,
+    start_cache_entry, get_in_progress_entry, discard_partial_cache_files, init_cache_index,
+    record_cache_miss, get_cache_stats, load_cache_manifest
+)
+from utils.format_table import codec_family, parse_codec_list, configure as configure_format_table
+from utils.hot_cache import get_hot_tier, configure as configure_hot_tier
+from utils.stream_pipeline import StreamPipeline, configure as configure_stream_pipeline
+from utils.passthrough import (
+    PassthroughSource, PassthroughPipeline, UpstreamError, can_passthrough, configure as configure_passthrough
+)
+from utils.file_serving import send_cached_file, configure as configure_file_serving
+from utils.quality_ladder import (
+    parse_height, find_rendition, downscale_source, build_downscale_cmd, maybe_pregenerate,
+    pregenerator_metrics, configure as configure_quality_ladder
+)
+from utils.prefetch import prefetcher_metrics, configure as configure_prefetch
+from utils.url_store import get_url_store, configure as configure_url_store
+from utils import http_client
+from utils.http_client import STREAM_TIMEOUT
+from utils.fanout import Deadline, submit, wait, configure as configure_fanout
+from utils.transcode_scheduler import (
+    PRIORITY_INTERACTIVE, PRIORITY_DOWNLOAD,
+    init_transcode_scheduler, get_transcode_scheduler, get_retry_after
 )
 
 # Create blueprint
 video_bp = Blueprint('video', __name__)
 
-# Dictionary to track ongoing downloads
+# Параметры FFmpeg для чтения потоков googlevideo
+FFMPEG_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0 Safari/537.36'
+FFMPEG_HEADERS = 'Referer: https://www.youtube.com\r\nOrigin: https://www.youtube.com'
+
+# Seek within this many seconds past the last written fragment waits for the
+# writer instead of starting a separate FFmpeg
+SEEK_AHEAD_WAIT_SECONDS = 15
+
+# Аудио (/direct_audio_url) хранится в том же кэше под своими «качествами»;
+# в названиях нет цифр, чтобы parse_height не принял их за высоту кадра
+AUDIO_FORMATS = {
+    'm4a': {'quality': 'audio-aac', 'mimetype': 'audio/mp4'},
+    'mp3': {'quality': 'audio-mpeg', 'mimetype': 'audio/mpeg'},
+}
+AUDIO_AAC_BITRATE = '160k'
+AUDIO_MP3_BITRATE = '128k'
+
+def _ffmpeg_input_options(seek=None):
+    """Параметры FFmpeg для чтения входа с googlevideo (переподключение, заголовки, -ss)."""
+    input_options = [
+        '-reconnect', '1',
+        '-reconnect_streamed', '1',
+        '-reconnect_at_eof', '1',
+        '-reconnect_delay_max', '10',
+        '-user_agent', FFMPEG_USER_AGENT,
+        '-headers', FFMPEG_HEADERS,
+    ]
+    if seek:
+        input_options += ['-ss', f'{seek:.3f}']
+    return input_options
+
+def _build_ffmpeg_cmd(video_url, audio_url=None, seek=None, copyts=False):
+    """Собирает команду FFmpeg, отдающую фрагментированный MP4 в stdout.
+
+    С audio_url объединяет отдельные потоки видео и аудио. seek (секунды)
+    добавляет -ss перед каждым входом: FFmpeg начинает с ближайшего
+    предшествующего ключевого кадра. copyts сохраняет исходные метки
+    времени - так продолжение потока стыкуется с уже отданными фрагментами.
+    """
+    input_options = _ffmpeg_input_options(seek)
+
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin']
+    if copyts:
+        cmd.append('-copyts')
+    cmd += input_options + ['-i', video_url]
+    if audio_url:
+        cmd += input_options + ['-i', audio_url, '-map', '0:v:0', '-map', '1:a:0']
+    cmd += [
+        '-c:v', 'copy',
+        '-c:a', 'aac',
+        '-b:a', '160k',
+        '-movflags', 'frag_keyframe+empty_moov',
+        '-f', 'mp4',
+        '-'
+    ]
+    return cmd
+
+def _build_audio_cmd(audio_input, audio_name, remote=True):
+    """Команда FFmpeg, перекодирующая аудио в stdout: m4a - AAC во фрагментированном MP4, mp3 - MP3.
+
+    remote - вход читается с googlevideo; иначе audio_input - путь к файлу кэша.
+    """
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin']
+    if remote:
+        cmd += _ffmpeg_input_options()
+    cmd += ['-i', audio_input, '-vn']
+    if audio_name == 'mp3':
+        cmd += ['-c:a', 'libmp3lame', '-b:a', AUDIO_MP3_BITRATE, '-f', 'mp3', '-']
+    else:
+        # Каждый кадр аудио - ключевой, поэтому фрагменты не короче 2 секунд
+        cmd += ['-c:a', 'aac', '-b:a', AUDIO_AAC_BITRATE,
+                '-movflags', 'frag_keyframe+empty_moov', '-min_frag_duration', '2000000',
+                '-f', 'mp4', '-']
+    return cmd
+
+def _parse_range_header():
+    """Разбирает заголовок Range: возвращает (start, end) или None; end может быть None."""
+    range_header = request.headers.get('Range', None)
+    if not range_header:
+        return None
+    match = re.search(r'(\d+)-(\d*)', range_header)
+    if not match:
+        return None
+    return int(match.group(1)), (int(match.group(2)) if match.group(2) else None)
+
+def _parse_seek_time():
+    """Читает параметр t (секунды) для перемотки по времени."""
+    try:
+        seek_time = float(request.args.get('t', ''))
+    except ValueError:
+        return None
+    return seek_time if seek_time > 0 else None
+
+def _seek_stream_response(video_id, quality, seek_time, codecs=None):
+    """Запускает отдельный FFmpeg с -ss для позиции, которой ещё нет в кэше.
+
+    Такой поток не кэшируется. Возвращает None, если не удалось получить ссылки.
+    """
+    desired_height = parse_height(quality)
+    quality_str = str(desired_height) if desired_height else 'standard'
+    video_format, audio_format = get_video_formats(video_id, quality_str, codecs=codecs)
+    if not video_format:
+        return None
+    video_url = video_format['url']
+    audio_url = audio_format['url'] if audio_format else None
+
+    print(f"Starting seek stream for {video_id} ({quality}) at {seek_time:.1f}s")
+    response = _ffmpeg_stream_response(_build_ffmpeg_cmd(video_url, audio_url, seek=seek_time))
+    if response.status_code == 200:
+        response.headers['X-Seek-Start'] = f'{seek_time:.3f}'
+    return response
+
+def _fragment_response(chunks, start_seconds, mimetype='video/mp4'):
+    """Ответ с init-сегментом и фрагментами начиная с ближайшего ключевого кадра."""
+    response = Response(chunks, mimetype=mimetype)
+    response.headers['Content-Type'] = mimetype
+    response.headers['X-Seek-Start'] = f'{start_seconds:.3f}'
+    return response
+
+# Dictionary to track ongoing downloads (single-flight по ключу (video_id, quality))
+# Значение: {'key': ..., 'event': threading.Event, 'streaming': bool}
+# Запись живёт, пока ведущий запрос извлекает ссылки и запускает FFmpeg; после этого
+# файл кэша становится InProgressCacheEntry, к которому подключаются остальные запросы.
 ongoing_downloads = {}
 download_lock = threading.Lock()
 
-# Создаем сессию requests без таймаутов для потоковой передачи
-streaming_session = requests.Session()
-streaming_session.timeout = None
+def _join_download(key):
+    """Регистрирует запрос на извлечение и mux видео (video_id, quality).
+
+    Возвращает (is_leader, entry). Первый запрос становится ведущим: он выполняет
+    извлечение и запускает mux в файл кэша. Остальные ждут entry['event'].
+    """
+    with download_lock:
+        entry = ongoing_downloads.get(key)
+        if entry is not None:
+            return False, entry
+        entry = {'key': key, 'event': threading.Event(), 'streaming': False}
+        ongoing_downloads[key] = entry
+        return True, entry
+
+def _finish_download(entry):
+    """Снимает ведущий запрос с регистрации и будит всех ожидающих."""
+    with download_lock:
+        if ongoing_downloads.get(entry['key']) is entry:
+            del ongoing_downloads[entry['key']]
+    entry['event'].set()
+
+def _wait_for_download(entry, timeout):
+    """Ждёт, пока ведущий запрос начнёт запись в кэш или завершится ошибкой."""
+    return entry['event'].wait(timeout)
+
+def _stream_pipeline_output(pipeline, cache_path=None, flight=None, manifest=None):
+    """Отдаёт stdout запущенного StreamPipeline клиенту, параллельно записывая его в кэш.
+
+    При записи в кэш процесс читается отдельным потоком, а клиент (как и все
+    подключившиеся позже) читает растущий файл. Файл попадает в кэш только
+    если FFmpeg завершился с кодом 0; manifest сохраняется рядом с ним.
+    Если передан flight, ожидающие запросы будятся, как только файл кэша
+    начал писаться.
+    """
+    if not cache_path:
+        return pipeline.iter_chunks()
+
+    cache_entry = start_cache_entry(cache_path, on_abandon=pipeline.cancel, manifest=manifest)
+    pipeline.tee_to_cache(cache_entry)
+    if flight is not None:
+        flight['streaming'] = True
+        _finish_download(flight)
+    return cache_entry.iter_from(0)
+
+def _overloaded_response():
+    """503 с Retry-After, когда планировщик FFmpeg не допустил запрос."""
+    response = jsonify({'error': 'Сервер перегружен, повторите запрос позже.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(get_retry_after())
+    response.headers['Content-Length'] = str(len(response.get_data()))
+    return response
+
+def _passthrough_response(source, byte_range=None, cache_path=None, flight=None, manifest=None, mimetype='video/mp4'):
+    """Отдаёт прогрессивный MP4 с googlevideo без FFmpeg; None, если googlevideo его не отдал.
+
+    byte_range (Range клиента) передаётся googlevideo, ответ - 206 с его
+    Content-Range. Файл кэша пишется только с начала, поэтому частичный
+    ответ не кэшируется.
+    """
+    if byte_range == (0, None):
+        byte_range = None
+    if byte_range is not None:
+        cache_path = None
+    pipeline = PassthroughPipeline(source, byte_range=byte_range)
+    try:
+        pipeline.start()
+    except UpstreamError as e:
+        print(f"Passthrough failed: {e}")
+        return None
+    if cache_path and manifest is not None:
+        manifest['passthrough'] = True
+
+    partial = byte_range is not None and pipeline.status == 206
+    response = Response(_stream_pipeline_output(pipeline, cache_path, flight, manifest), 206 if partial else 200,
+                        mimetype=mimetype)
+    response.headers['Content-Type'] = mimetype
+    response.headers['Accept-Ranges'] = 'bytes'
+    if partial:
+        response.headers['Content-Range'] = pipeline.content_range
+    if pipeline.length is not None:
+        response.headers['Content-Length'] = str(pipeline.length)
+    return response
+
+def _ffmpeg_stream_response(cmd, cache_path=None, flight=None, manifest=None, priority=PRIORITY_INTERACTIVE,
+                            resume=None, mimetype='video/mp4'):
+    """Запускает FFmpeg (cmd пишет fMP4 в stdout) и возвращает потоковый ответ.
+
+    Перед запуском ждёт слот в планировщике FFmpeg; если слот не получен, возвращает 503.
+    resume - см. StreamPipeline (продолжение потока после истечения ссылок).
+    PassthroughSource вместо cmd отдаётся без FFmpeg и без слота (с Range
+    клиента); FFmpeg запускается, только если googlevideo не отдал файл.
+    """
+    if isinstance(cmd, PassthroughSource):
+        response = _passthrough_response(cmd, _parse_range_header(), cache_path, flight, manifest, mimetype)
+        if response is not None:
+            return response
+        print("Falling back to FFmpeg")
+        cmd, resume = cmd.cmd, cmd.resume
+
+    slot = get_transcode_scheduler().acquire(priority)
+    if slot is None:
+        print(f"Transcode scheduler rejected request (priority {priority})")
+        return _overloaded_response()
+    pipeline = StreamPipeline(cmd, slot=slot, resume=resume)
+    try:
+        pipeline.start()
+    except FileNotFoundError:
+        response = jsonify({'error': 'FFmpeg не найден. Пожалуйста, установите FFmpeg и добавьте его в PATH.'})
+        response.status_code = 500
+        return response
+    except Exception as e:
+        print(f'Error starting FFmpeg process: {e}')
+        response = jsonify({'error': f'Ошибка запуска FFmpeg: {str(e)}'})
+        response.status_code = 500
+        return response
+
+    response = Response(_stream_pipeline_output(pipeline, cache_path, flight, manifest), mimetype=mimetype)
+    response.headers['Content-Type'] = mimetype
+    return response
+
+def _resolve_stream_formats(video_id, quality_str, codecs=None):
+    """Форматы видео и аудио для качества; при неудаче перебирает файлы cookies."""
+    video_format, audio_format = get_video_formats(video_id, quality_str, codecs=codecs)
+    if not video_format and not audio_format:
+        for cookie_file in get_cookies_files():
+            video_format, audio_format = get_video_formats(video_id, quality_str, cookie_file, codecs=codecs)
+            if video_format or audio_format:
+                break
+    return video_format, audio_format
+
+def _stream_resume(video_id, video_format_id, audio_format_id=None):
+    """resume для StreamPipeline: продолжение потока тех же форматов по заново подписанным ссылкам.
+
+    Те же format_id дают побайтно тот же поток, поэтому ключевые кадры
+    продолжения совпадают с уже отданными.
+    """
+    def resume(seconds):
+        store = get_url_store()
+        if not store.refresh(video_id):
+            return None
+        video_url = store.url(video_id, video_format_id)
+        audio_url = store.url(video_id, audio_format_id) if audio_format_id else None
+        if not video_url or (audio_format_id and not audio_url):
+            print(f"[ERROR] Formats {video_format_id}/{audio_format_id} of {video_id} are gone after refresh")
+            return None
+        return _build_ffmpeg_cmd(video_url, audio_url, seek=seconds, copyts=True)
+    return resume
+
+def _resolve_audio_format(video_id, acodec=None):
+    """Лучший аудиоформат видео (acodec - префикс кодека, иначе любой); при неудаче перебирает файлы cookies."""
+    for cookie_file in [None] + get_cookies_files():
+        table = get_format_table(video_id, cookie_file)
+        if not table:
+            continue
+        audio_format = table.best_audio(acodec=acodec) or table.best_audio()
+        if audio_format:
+            get_url_store().touch(video_id, audio_format.get('format_id'))
+            return audio_format
+    return None
+
+def _audio_source_cmd(video_id, audio_name):
+    """Команда для аудио в формате audio_name ('m4a' или 'mp3'): (cmd, resume), как _source_cmd.
+
+    AAC-поток googlevideo отдаётся как есть (PassthroughSource), остальное
+    перекодирует FFmpeg; mp3 делается из закэшированного m4a, если он есть.
+    (None, None), если ссылку получить не удалось.
+    """
+    if audio_name == 'mp3':
+        m4a_quality = AUDIO_FORMATS['m4a']['quality']
+        if is_video_cached(video_id, m4a_quality):
+            print(f"Encoding mp3 of {video_id} from cached m4a")
+            return _build_audio_cmd(get_cache_path(video_id, m4a_quality), 'mp3', remote=False), None
+
+    audio_format = _resolve_audio_format(video_id, 'mp4a' if audio_name == 'm4a' else None)
+    if not audio_format:
+        return None, None
+    cmd = _build_audio_cmd(audio_format['url'], audio_name)
+    if audio_name == 'm4a' and can_passthrough(audio_format):
+        return PassthroughSource(audio_format['url'], refresh=_passthrough_refresh(video_id, audio_format.get('format_id')),
+                                 cmd=cmd), None
+    return cmd, None
+
+def _passthrough_refresh(video_id, format_id):
+    """refresh для PassthroughSource: новая подписанная ссылка того же формата."""
+    def refresh():
+        store = get_url_store()
+        if not store.refresh(video_id):
+            return None
+        return store.url(video_id, format_id)
+    return refresh
+
+def _source_cmd(video_id, quality, manifest, codecs=None):
+    """Команда FFmpeg для видео в качестве quality: (cmd, resume).
+
+    Если в кэше есть то же видео в более высоком качестве, оно уменьшается
+    локально (manifest получает derived_from, resume - None); иначе ссылки
+    извлекаются через yt-dlp и потоки объединяются из сети, а resume
+    продолжает поток, если ссылки истекут. Прогрессивный MP4 с H.264 и AAC
+    отдаётся как есть: вместо команды возвращается PassthroughSource (с
+    командой FFmpeg как запасным вариантом) и resume None. codecs -
+    видеокодеки, которые поддерживает клиент, в порядке предпочтения.
+    (None, None), если ссылок получить не удалось.
+    """
+    desired_height = parse_height(quality)
+    # Уменьшенные копии всегда в H.264
+    source = downscale_source(video_id, desired_height) if _accepts_codecs(codecs, ['avc1']) else None
+    if source is not None:
+        print(f"Deriving {video_id} {desired_height}p from cached {source['quality']}")
+        manifest['derived_from'] = source['quality']
+        return build_downscale_cmd(source['path'], desired_height), None
+
+    # Получаем форматы видео и аудио для указанного качества (без quality - стандартный комбинированный поток)
+    quality_str = str(desired_height) if desired_height else 'standard'
+    video_format, audio_format = _resolve_stream_formats(video_id, quality_str, codecs)
+    if not video_format:
+        return None, None
+    # Отдельные видео и аудио объединяются FFmpeg, комбинированный поток перепаковывается в fMP4
+    cmd = _build_ffmpeg_cmd(video_format['url'], audio_format['url'] if audio_format else None)
+    resume = _stream_resume(video_id, video_format.get('format_id'), audio_format.get('format_id') if audio_format else None)
+    if can_passthrough(video_format, audio_format):
+        source = PassthroughSource(video_format['url'], refresh=_passthrough_refresh(video_id, video_format.get('format_id')),
+                                   cmd=cmd, resume=resume)
+        return source, None
+    return cmd, resume
+
+def _set_duration_headers(response, duration_value):
+    if duration_value:
+        duration_str = str(int(duration_value)) if isinstance(duration_value, (int, float)) else str(duration_value)
+        response.headers['X-Content-Duration'] = duration_str
+        response.headers['Content-Duration'] = duration_str
+        response.headers['X-Video-Duration'] = duration_str
+        response.headers['X-Duration-Seconds'] = duration_str
+
+def _tail_response(cache_entry, video_title=None, seek_fallback=None, range_fallback=None, mimetype='video/mp4'):
+    """Подключает клиента к файлу кэша, который ещё пишется.
+
+    Range и перемотка по времени (t) внутри уже записанных данных отдаются
+    сразу: байтовые диапазоны как 206, время - с ближайшего фрагмента по
+    индексу moof. Для позиций дальше записанного вызывается seek_fallback(t),
+    а для диапазонов дальше записанного - range_fallback(byte_range).
+    """
+    if request.method == 'HEAD':
+        return Response(None, mimetype=mimetype)
+
+    if video_title is None:
+        index = cache_entry.fragment_index
+
+        seek_time = _parse_seek_time()
+        if seek_time is not None:
+            last = index.last_fragment()
+            if last and seek_time <= last[1] + SEEK_AHEAD_WAIT_SECONDS:
+                offset, start = index.fragment_for_time(seek_time)
+                return _fragment_response(cache_entry.iter_ranges([(0, index.init_end), (offset, None)]), start, mimetype)
+            if seek_fallback:
+                response = seek_fallback(seek_time)
+                if response is not None:
+                    return response
+
+        byte_range = _parse_range_header()
+        if byte_range and byte_range != (0, None):
+            byte1, byte2 = byte_range
+            produced = cache_entry.size
+            if byte1 < produced:
+                # Total size is unknown until the writer finishes
+                if byte2 is None:
+                    byte2 = produced - 1
+                response = Response(cache_entry.iter_from(byte1, end=byte2 + 1), 206, mimetype=mimetype)
+                response.headers['Content-Range'] = f'bytes {byte1}-{byte2}/*'
+                response.headers['Accept-Ranges'] = 'bytes'
+                response.headers['Content-Length'] = str(byte2 - byte1 + 1)
+                response.headers['Content-Type'] = mimetype
+                return response
+            if range_fallback:
+                response = range_fallback(byte_range)
+                if response is not None:
+                    return response
+            seek_time = index.estimate_time_for_offset(byte1)
+            if seek_time is not None and seek_fallback:
+                response = seek_fallback(seek_time)
+                if response is not None:
+                    return response
+
+    response = Response(cache_entry.iter_from(0), mimetype=mimetype)
+    response.headers['Content-Type'] = mimetype
+    if video_title is not None:
+        response.headers['Content-Disposition'] = f'attachment; filename="{video_title}.mp4"'
+    return response
+
+def _range_passthrough_response(video_id, quality, byte_range, codecs=None):
+    """Диапазон прогрессивного MP4 прямо с googlevideo (206) или None, если формат не прогрессивный."""
+    desired_height = parse_height(quality)
+    quality_str = str(desired_height) if desired_height else 'standard'
+    video_format, audio_format = _resolve_stream_formats(video_id, quality_str, codecs)
+    if not can_passthrough(video_format, audio_format):
+        return None
+    source = PassthroughSource(video_format['url'], refresh=_passthrough_refresh(video_id, video_format.get('format_id')))
+    return _passthrough_response(source, byte_range)
+
+def _closest_quality_requested():
+    """Параметр closest=1 разрешает отдать ближайшее закэшированное качество вместо запрошенного."""
+    value = request.args.get('closest')
+    if value is None:
+        return None
+    return value.lower() in ('1', 'true', 'yes')
+
+def _requested_codecs():
+    """Видеокодеки из параметра codecs (например, codecs=vp9,avc1), или None - по умолчанию."""
+    return parse_codec_list(request.args.get('codecs'))
+
+def _accepts_codecs(codecs, file_codecs):
+    """Может ли клиент, объявивший codecs, воспроизвести файл с кодеками file_codecs.
+
+    Без объявленного списка или без сведений о кодеках файла подходит любой файл.
+    """
+    if not codecs or not file_codecs:
+        return True
+    families = [codec_family(codec) for codec in file_codecs]
+    return all(family in codecs for family in families if family)
+
+def _cached_codecs(cache_path):
+    """Кодеки файла кэша (из манифеста или moov пишущегося файла), или None, если неизвестны."""
+    cache_entry = get_in_progress_entry(cache_path)
+    if cache_entry is not None:
+        return cache_entry.fragment_index.codecs or None
+    if os.path.exists(cache_path):
+        return (load_cache_manifest(cache_path) or {}).get('codecs')
+    return None
+
+def _serve_existing(video_id, quality, video_title=None, codecs=None):
+    """Отдаёт готовый файл кэша или подключает к пишущемуся.
+
+    Если запрошенного качества нет, подходит файл той же высоты кадра, а с
+    closest=1 - ближайшего закэшированного качества (заголовок X-Served-Quality).
+    С video_title ответ отдаётся как вложение (/download). Файлы в кодеке,
+    которого нет в codecs, пропускаются. Возвращает None, если подходящего
+    видео нет ни в кэше, ни в процессе записи.
+    """
+    cache_path = get_cache_path(video_id, quality)
+    if not _accepts_codecs(codecs, _cached_codecs(cache_path)):
+        return None
+    if is_video_cached(video_id, quality):
+        increment_video_view_count(video_id, quality)
+        maybe_pregenerate(video_id, quality)
+        if video_title is not None:
+            return _cached_download_response(cache_path, video_title)
+        return _cached_video_response(cache_path)
+    cache_entry = get_in_progress_entry(cache_path)
+    if cache_entry is not None:
+        print(f"Following in-progress cache file {cache_path}")
+        increment_video_view_count(video_id, quality)
+        seek_fallback = range_fallback = None
+        if video_title is None:
+            seek_fallback = lambda seek_time: _seek_stream_response(video_id, quality, seek_time, codecs)
+            # Прогрессивный файл пишется в исходном виде - диапазон дальше записанного читается с googlevideo
+            if cache_entry.manifest.get('passthrough'):
+                range_fallback = lambda byte_range: _range_passthrough_response(video_id, quality, byte_range, codecs)
+        return _tail_response(cache_entry, video_title, seek_fallback, range_fallback)
+
+    # Same height cached under another spelling of quality, or the closest cached quality
+    desired_height = parse_height(quality)
+    if desired_height:
+        rendition = find_rendition(video_id, desired_height, allow_closest=_closest_quality_requested())
+        if rendition is not None and _accepts_codecs(codecs, _cached_codecs(rendition['path'])):
+            increment_video_view_count(video_id, rendition['quality'])
+            if video_title is not None:
+                response = _cached_download_response(rendition['path'], video_title)
+            else:
+                response = _cached_video_response(rendition['path'])
+            response.headers['X-Served-Quality'] = str(rendition['height'])
+            return response
+    return None
+
+def _cached_video_response(cache_path):
+    """Отдаёт закэшированное видео с поддержкой HEAD, Range и условных запросов."""
+    # Time-based seek: init segment + fragments from the nearest keyframe
+    seek_time = _parse_seek_time() if request.method != 'HEAD' else None
+    if seek_time is not None:
+        stat = os.stat(cache_path)
+        file_size = stat.st_size
+        # The fragment index and the init segment of hot files are kept in memory
+        hot_tier = get_hot_tier()
+        index = hot_tier.get_index(cache_path, stat)
+        fragment = index.fragment_for_time(seek_time)
+        if index.init_end is not None and fragment:
+            offset, start = fragment
+            prefix = hot_tier.get_prefix(cache_path, stat)
+            file_ranges = ((offset, file_size),)
+            if prefix is None or len(prefix) < index.init_end:
+                file_ranges = ((0, index.init_end),) + file_ranges
+
+            def generate_fragments():
+                if len(file_ranges) == 1:
+                    hot_tier.record_served(index.init_end)
+                    yield prefix[:index.init_end]
+                with open(cache_path, 'rb') as f:
+                    for range_start, range_end in file_ranges:
+                        f.seek(range_start)
+                        remaining = range_end - range_start
+                        while remaining > 0:
+                            chunk = f.read(min(65536, remaining))
+                            if not chunk:
+                                break
+                            yield chunk
+                            remaining -= len(chunk)
+
+            response = _fragment_response(generate_fragments(), start)
+            response.headers['Content-Length'] = str(index.init_end + file_size - offset)
+            return response
+
+    return send_cached_file(cache_path, 'video/mp4')
+
+def _cached_download_response(cache_path, video_title):
+    """Отдаёт закэшированное видео как вложение для скачивания."""
+    return send_cached_file(cache_path, 'video/mp4', download_name=f'{video_title}.mp4')
+
+def _get_download_title(video_id):
+    """Получает название видео для имени скачиваемого файла."""
+    video_title = "video"
+    try:
+        info = get_video_info(video_id)
+        if info:
+            video_title = info.get('title', 'video')
+            # Очищаем название файла от недопустимых символов
+            video_title = re.sub(r'[<>:"/\\|?*]', '_', video_title)
+    except Exception as e:
+        print(f"Error fetching video info for video_id {video_id}: {e}")
+    return video_title
 
 # InnerTube helper functions for channel avatar
 INNERTUBE_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
@@ -106,7 +673,7 @@ def _choose_best_thumbnail(thumbnails: List[Dict[str, Any]]) -> Optional[str]:
 
 def _get_innertube_config(session: Optional[requests.Session] = None) -> Tuple[str, Dict[str, Any]]:
     """Get InnerTube API key and context from YouTube page"""
-    sess = session or requests.Session()
+    sess = session or http_client.get_session()
     # Get any YouTube page to extract config
     r = sess.get("https://www.youtube.com", headers={"User-Agent": INNERTUBE_USER_AGENT}, timeout=30)
     r.raise_for_status()
@@ -204,7 +771,7 @@ def _resolve_handle_to_browse_id(handle: str, session: Optional[requests.Session
     if not handle:
         raise ValueError("handle is required")
     
-    sess = session or requests.Session()
+    sess = session or http_client.get_session()
     handle = handle.strip()
     if not handle.startswith("@"):
         handle = "@" + handle
@@ -295,7 +862,7 @@ def get_channel_avatar_url_innertube(identifier: str, session: Optional[requests
     - channel_id: YouTube channel ID (starts with UC)
     - username: Channel username (starts with @)
     """
-    sess = session or requests.Session()
+    sess = session or http_client.get_session()
     
     try:
         # Get InnerTube config
@@ -333,7 +900,62 @@ def get_channel_avatar_url_innertube(identifier: str, session: Optional[requests
 
 def setup_video_routes(config):
     """Configure video routes with application config"""
+
+    # Drop cache files left behind by writes interrupted by a crash or restart
+    discard_partial_cache_files()
+    init_cache_index(config)
+    configure_stream_pipeline(config)
+    configure_passthrough(config)
+    configure_file_serving(config)
+    configure_hot_tier(config)
+    configure_quality_ladder(config)
+    configure_format_table(config)
+    configure_fanout(config)
+    init_transcode_scheduler(config)
+    configure_url_store(config, refresh=refresh_video_info)
+    configure_prefetch(config, build_cmd=_source_cmd, join=_join_download, finish=_finish_download)
+
+    @video_bp.route('/transcode_stats', methods=['GET'])
+    def transcode_stats():
+        """Состояние планировщика FFmpeg: запущенные процессы, глубина очереди, отказы."""
+        return jsonify(get_transcode_scheduler().metrics())
+
+    @video_bp.route('/cache_stats', methods=['GET'])
+    def cache_stats():
+        """Размер кэша по качествам, доля попаданий и счётчики вытеснения."""
+        stats = get_cache_stats()
+        stats['pregenerate'] = pregenerator_metrics()
+        stats['hot_tier'] = get_hot_tier().metrics()
+        stats['prefetch'] = prefetcher_metrics()
+        stats['urls'] = get_url_store().metrics()
+        stats['api'] = get_api_cache().metrics()
+        stats['api_keys'] = get_key_scheduler().metrics()
+        return jsonify(stats)
     
+    def _fetch_video_item(video_id, apikey):
+        """Элемент videos (snippet, contentDetails, statistics) или None, если видео нет."""
+        resp = api_get(f"https://www.googleapis.com/youtube/v3/videos?id={video_id}&key={apikey}&part=snippet,contentDetails,statistics", timeout=config['request_timeout'])
+        resp.raise_for_status()
+        data = resp.json()
+        return data['items'][0] if data.get('items') and data['items'] else None
+
+    def _fetch_subscriber_count(channel_id, apikey):
+        r = api_get(
+            f"https://www.googleapis.com/youtube/v3/channels?id={channel_id}&key={apikey}&part=snippet,statistics",
+            timeout=config['request_timeout']
+        )
+        r.raise_for_status()
+        data = r.json()
+        print(f"DEBUG: API response: {json.dumps(data, ensure_ascii=False)[:200]}...")
+        if data.get('items') and data['items']:
+            return data['items'][0]['statistics'].get('subscriberCount', '0')
+        return '0'
+
+    def _fetch_comment_items(video_id, apikey):
+        comments_resp = api_get(f"https://www.googleapis.com/youtube/v3/commentThreads?key={apikey}&textFormat=plainText&part=snippet&videoId={video_id}&maxResults=25", timeout=config['request_timeout'])
+        comments_resp.raise_for_status()
+        return comments_resp.json().get('items', [])
+
     @video_bp.route('/get-ytvideo-info.php', methods=['GET'])
     def get_ytvideo_info():
         try:
@@ -346,11 +968,16 @@ def setup_video_routes(config):
             if not video_id:
                 return jsonify({'error': 'ID видео не был передан.'})
             
+            # Независимые запросы к апстриму идут параллельно под общим сроком:
+            # videos, комментарии и (без прокси) извлечение yt-dlp - сразу,
+            # канал и аватары авторов - как только известны их ID
+            deadline = Deadline()
+            video_future = submit(_fetch_video_item, video_id, apikey)
+            comments_future = submit(_fetch_comment_items, video_id, apikey)
+            url_future = submit(get_real_direct_video_url, video_id) if not use_video_proxy else None
+            
             # API call to YouTube Data API v3, including 'contentDetails' part
-            resp = requests.get(f"https://www.googleapis.com/youtube/v3/videos?id={video_id}&key={apikey}&part=snippet,contentDetails,statistics", timeout=config['request_timeout'])
-            resp.raise_for_status()
-            data = resp.json()
-            videoData = data['items'][0] if data.get('items') and data['items'] else None
+            videoData = video_future.result(timeout=deadline.remaining())
             
             if not videoData:
                 return jsonify({'error': 'Видео не найдено.'})
@@ -359,28 +986,19 @@ def setup_video_routes(config):
             contentDetails = videoData['contentDetails'] # This is where duration is found
             statistics = videoData['statistics']
             channelId = videoInfo['channelId']
+            channel_future = submit(_fetch_subscriber_count, channelId, apikey)
             
-            # Initialize variables with default values
-            subscriberCount = "0"
-            
-            r = requests.get(
-                f"https://www.googleapis.com/youtube/v3/channels?id={channelId}&key={apikey}&part=snippet,statistics", 
-                timeout=config['request_timeout']
-            )
-            r.raise_for_status()
-            data = r.json()
-            
-            print(f"DEBUG: API response: {json.dumps(data, ensure_ascii=False)[:200]}...")
-            
-            if data.get('items') and data['items']:
-                # Get subscriber count from channel data
-                subscriberCount = data['items'][0]['statistics'].get('subscriberCount', '0')
-                print(subscriberCount)
+            comment_items = wait(comments_future, deadline, default=[], name='commentThreads')
+            thumbnails_future = submit(
+                get_channel_thumbnails,
+                [item['snippet']['topLevelComment']['snippet'].get('authorChannelId', {}).get('value')
+                 for item in comment_items], apikey, config)
             
             # Rest of your code remains the same...
             finalVideoUrl = ''
             if not use_video_proxy:
-                finalVideoUrlWithProxy = get_real_direct_video_url(video_id)
+                # Ссылка нужна клиенту обязательно, поэтому ждём извлечения без срока
+                finalVideoUrlWithProxy = url_future.result()
             else:
                 if config['video_source'] == 'direct':
                     finalVideoUrl = f"{config['mainurl']}direct_url?video_id={video_id}"
@@ -391,22 +1009,22 @@ def setup_video_routes(config):
                     if config['use_video_proxy'] and finalVideoUrl:
                         finalVideoUrlWithProxy = f"{config['mainurl']}video.proxy?url={quote(finalVideoUrl)}"
             
+            # Необязательные части: не успели к сроку - отдаём без них
+            subscriberCount = wait(channel_future, deadline, default='0', name='channels')
+            authorThumbnails = wait(thumbnails_future, deadline, default={}, name='comment author thumbnails')
             comments = []
-            try:
-                comments_resp = requests.get(f"https://www.googleapis.com/youtube/v3/commentThreads?key={apikey}&textFormat=plainText&part=snippet&videoId={video_id}&maxResults=25", timeout=config['request_timeout'])
-                comments_resp.raise_for_status()
-                comments_data = comments_resp.json()
-                for item in comments_data.get('items', []):
+            for item in comment_items:
+                try:
                     commentAuthorId = item['snippet']['topLevelComment']['snippet']['authorChannelId']['value']
-                    commentAuthorThumbnail = get_channel_thumbnail(commentAuthorId, apikey, config)
+                    commentAuthorThumbnail = authorThumbnails.get(commentAuthorId, '')
                     comments.append({
                         'author': item['snippet']['topLevelComment']['snippet']['authorDisplayName'],
                         'text': item['snippet']['topLevelComment']['snippet']['textDisplay'],
                         'published_at': item['snippet']['topLevelComment']['snippet']['publishedAt'],
                         'author_thumbnail': get_proxy_url(commentAuthorThumbnail, config['use_channel_thumbnail_proxy'])
                     })
-            except Exception as e:
-                print('Error loading comments:', e)
+                except Exception as e:
+                    print('Error loading comments:', e)
             
             publishedAt = datetime.strptime(videoInfo['publishedAt'], '%Y-%m-%dT%H:%M:%SZ')
             publishedAtFormatted = publishedAt.strftime('%d.%m.%Y, %H:%M:%S')
@@ -437,9 +1055,11 @@ def setup_video_routes(config):
 
     @video_bp.route('/direct_url', methods=['GET', 'HEAD'])
     def direct_url():
+        flight = None
         try:
             video_id = request.args.get('video_id')
             quality = request.args.get('quality')
+            codecs = _requested_codecs()
             
             if not video_id:
                 response = jsonify({'error': 'ID видео не был передан.'})
@@ -447,1066 +1067,253 @@ def setup_video_routes(config):
                 response.headers['Content-Length'] = str(len(response.get_data()))
                 return response
 
-            # Check if video is already cached
-            if is_video_cached(video_id, quality):
-                # Serve from cache
-                cache_path = get_cache_path(video_id, quality)
-                file_size = os.path.getsize(cache_path)
-                
-                if request.method == 'HEAD':
-                    response = Response(None, mimetype='video/mp4')
-                    response.headers['Accept-Ranges'] = 'bytes'
-                    response.headers['Content-Type'] = 'video/mp4'
-                    response.headers['Content-Length'] = str(file_size)
-                    return response
-                
-                # Handle range requests for partial content
-                range_header = request.headers.get('Range', None)
-                if range_header:
-                    byte1, byte2 = 0, None
-                    match = re.search(r'(\d+)-(\d*)', range_header)
-                    if match:
-                        byte1 = int(match.group(1))
-                        if match.group(2):
-                            byte2 = int(match.group(2))
-                    
-                    with open(cache_path, 'rb') as f:
-                        f.seek(0, 2)  # Seek to end
-                        file_length = f.tell()
-                        
-                    if byte2 is None:
-                        byte2 = file_length - 1
-                        
-                    chunk_size = byte2 - byte1 + 1
-                    
-                    def generate_range():
-                        with open(cache_path, 'rb') as f:
-                            f.seek(byte1)
-                            remaining = chunk_size
-                            while remaining > 0:
-                                chunk = f.read(min(65536, remaining))
-                                if not chunk:
-                                    break
-                                yield chunk
-                                remaining -= len(chunk)
-                    
-                    response = Response(generate_range(), 206, mimetype='video/mp4')
-                    response.headers['Content-Range'] = f'bytes {byte1}-{byte2}/{file_length}'
-                    response.headers['Accept-Ranges'] = 'bytes'
-                    response.headers['Content-Length'] = str(chunk_size)
-                    response.headers['Content-Type'] = 'video/mp4'
-                    return response
-                else:
-                    # Full file streaming
-                    def generate_full():
-                        with open(cache_path, 'rb') as f:
-                            while True:
-                                chunk = f.read(65536)
-                                if not chunk:
-                                    break
-                                yield chunk
-                    
-                    response = Response(generate_full(), mimetype='video/mp4')
-                    response.headers['Accept-Ranges'] = 'bytes'
-                    response.headers['Content-Length'] = str(file_size)
-                    response.headers['Content-Type'] = 'video/mp4'
-                    return response
+            # Serve from cache, or follow the cache file that is still being written
+            existing = _serve_existing(video_id, quality, codecs=codecs)
+            if existing is not None:
+                return existing
 
             # Получаем информацию о длительности видео
             duration_value = None
             try:
-                url = f'https://www.youtube.com/watch?v={video_id}'
-                info_output = run_yt_dlp(['--dump-json', '--no-warnings', url])
-                
-                if info_output:
-                    try:
-                        info = json.loads(info_output)
-                        duration_value = info.get('duration')
-                    except json.JSONDecodeError as e:
-                        print(f"Error parsing JSON for duration: {e}")
+                info = get_video_info(video_id)
+                if info:
+                    duration_value = info.get('duration')
             except Exception as e:
                 print(f"Error fetching duration for video_id {video_id}: {e}")
 
             # Обработка HEAD запроса
             if request.method == 'HEAD':
                 response = Response(None, mimetype='video/mp4')
-                if duration_value:
-                    duration_str = str(int(duration_value)) if isinstance(duration_value, (int, float)) else str(duration_value)
-                    response.headers['X-Content-Duration'] = duration_str
-                    response.headers['Content-Duration'] = duration_str
-                    response.headers['X-Video-Duration'] = duration_str
-                    response.headers['X-Duration-Seconds'] = duration_str
+                _set_duration_headers(response, duration_value)
                 response.headers['Accept-Ranges'] = 'bytes'
                 response.headers['Content-Type'] = 'video/mp4'
                 return response
 
-            # Check if we should cache this video (based on frequency)
-            # For testing purposes, we'll cache every video
-            should_cache = True  # should_cache_video(video_id)
-            cache_path = None
-            if should_cache and video_id:
-                cache_path = get_cache_path(video_id, quality)
-                print(f"Caching video {video_id} at {cache_path}")
-
-            # Получаем URL видео и аудио для указанного качества
-            if quality:
-                try:
-                    def parse_desired_height(qval):
-                        if not qval:
-                            return None
-                        s = str(qval).strip().lower()
-                        try:
-                            return int(s)
-                        except Exception:
-                            pass
-                        digits = ''.join(ch for ch in s if ch.isdigit())
-                        if digits:
-                            try:
-                                return int(digits)
-                            except Exception:
-                                pass
-                        aliases = {
-                            'tiny': 144, 'small': 240, 'medium': 360, 'large': 480,
-                            'hd': 720, 'hd720': 720, '720p': 720,
-                            'hd1080': 1080, '1080p': 1080,
-                            '144p': 144, '240p': 240, '360p': 360, '480p': 480,
-                            '2160p': 2160, '1440p': 1440
-                        }
-                        return aliases.get(s)
-
-                    # Используем качество по умолчанию из конфигурации, если не указано
-                    if not quality:
-                        quality = config.get('default_quality', '360')
-                    
-                    desired_height = parse_desired_height(quality)
-                    
-                    # Преобразуем высоту в строку для функции get_video_url
-                    if desired_height:
-                        quality_str = str(desired_height)
-                    else:
-                        quality_str = 'standard'
-                    
-                    # Получаем URL видео и аудио
-                    video_url, audio_url = get_video_url(video_id, quality_str)
-                    
-                    # Если не удалось получить URL, пробуем с другим cookie файлом
-                    if not video_url and not audio_url:
-                        # Попробуем все доступные cookie файлы
-                        cookies_files = get_cookies_files()
-                        for cookie_file in cookies_files:
-                            video_url, audio_url = get_video_url(video_id, quality_str, cookie_file)
-                            if video_url or audio_url:
-                                break
-                    
-                    # Если получили отдельные потоки видео и аудио, используем FFmpeg для объединения
-                    if video_url and audio_url:
-                        # Комбинируем потоки через FFmpeg
-                        user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0 Safari/537.36'
-                        common_headers = 'Referer: https://www.youtube.com\r\nOrigin: https://www.youtube.com'
-                        ffmpeg_cmd = [
-                            'ffmpeg',
-                            '-hide_banner',
-                            '-loglevel', 'error',
-                            '-nostdin',
-                            '-reconnect', '1',
-                            '-reconnect_streamed', '1',
-                            '-reconnect_at_eof', '1',
-                            '-reconnect_delay_max', '10',
-                            '-user_agent', user_agent,
-                            '-headers', common_headers,
-                            '-i', video_url,
-                            '-user_agent', user_agent,
-                            '-headers', common_headers,
-                            '-i', audio_url,
-                            '-map', '0:v:0',
-                            '-map', '1:a:0',
-                            '-c:v', 'copy',
-                            '-c:a', 'aac',
-                            '-b:a', '160k',
-                            '-movflags', 'frag_keyframe+empty_moov',
-                            '-f', 'mp4',
-                            '-'
-                        ]
-
-                        try:
-                            ffmpeg_process = subprocess.Popen(
-                                ffmpeg_cmd,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                bufsize=0
-                            )
-                        except FileNotFoundError:
-                            return jsonify({'error': 'FFmpeg не найден. Пожалуйста, установите FFmpeg и добавьте его в PATH.'}), 500
-                        except Exception as e:
-                            print(f'Error starting FFmpeg process: {e}')
-                            return jsonify({'error': f'Ошибка запуска FFmpeg: {str(e)}'}), 500
-
-                        def _drain_stderr():
-                            try:
-                                if ffmpeg_process and ffmpeg_process.stderr:
-                                    while True:
-                                        line = ffmpeg_process.stderr.readline()
-                                        if not line:
-                                            break
-                            except Exception:
-                                pass
-                        try:
-                            threading.Thread(target=_drain_stderr, daemon=True).start()
-                        except Exception as e:
-                            print(f"Error starting stderr drain thread: {e}")
-
-                        def generate_and_cache_ffmpeg():
-                            try:
-                                if cache_path:
-                                    # Ensure directory exists
-                                    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-                                    with open(cache_path, 'wb') as cache_file:
-                                        if ffmpeg_process and ffmpeg_process.stdout:
-                                            while True:
-                                                chunk = ffmpeg_process.stdout.read(65536)
-                                                if not chunk:
-                                                    break
-                                                cache_file.write(chunk)
-                                                yield chunk
-                                else:
-                                    if ffmpeg_process and ffmpeg_process.stdout:
-                                        while True:
-                                            chunk = ffmpeg_process.stdout.read(65536)
-                                            if not chunk:
-                                                break
-                                            yield chunk
-                            except Exception as e:
-                                print(f"Error in generate_and_cache_ffmpeg: {e}")
-                            finally:
-                                try:
-                                    if ffmpeg_process:
-                                        ffmpeg_process.terminate()
-                                except Exception:
-                                    pass
-
-                        response = Response(generate_and_cache_ffmpeg(), mimetype='video/mp4')
-                        response.headers['Content-Type'] = 'video/mp4'
-                        if duration_value:
-                            duration_str = str(int(duration_value)) if isinstance(duration_value, (int, float)) else str(duration_value)
-                            response.headers['X-Content-Duration'] = duration_str
-                            response.headers['Content-Duration'] = duration_str
-                            response.headers['X-Video-Duration'] = duration_str
-                            response.headers['X-Duration-Seconds'] = duration_str
-                        return response
-                    # Если получили комбинированный поток (только video_url, audio_url = None)
-                    elif video_url and not audio_url:
-                        # Process single stream through FFmpeg to ensure proper format
-                        user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0 Safari/537.36'
-                        common_headers = 'Referer: https://www.youtube.com\r\nOrigin: https://www.youtube.com'
-                        ffmpeg_cmd = [
-                            'ffmpeg',
-                            '-hide_banner',
-                            '-loglevel', 'error',
-                            '-nostdin',
-                            '-reconnect', '1',
-                            '-reconnect_streamed', '1',
-                            '-reconnect_at_eof', '1',
-                            '-reconnect_delay_max', '10',
-                            '-user_agent', user_agent,
-                            '-headers', common_headers,
-                            '-i', video_url,
-                            '-c:v', 'copy',
-                            '-c:a', 'aac',
-                            '-b:a', '160k',
-                            '-movflags', 'frag_keyframe+empty_moov',
-                            '-f', 'mp4',
-                            '-'
-                        ]
-
-                        try:
-                            ffmpeg_process = subprocess.Popen(
-                                ffmpeg_cmd,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                bufsize=0
-                            )
-                        except FileNotFoundError:
-                            return jsonify({'error': 'FFmpeg не найден. Пожалуйста, установите FFmpeg и добавьте его в PATH.'}), 500
-                        except Exception as e:
-                            print(f'Error starting FFmpeg process: {e}')
-                            return jsonify({'error': f'Ошибка запуска FFmpeg: {str(e)}'}), 500
-
-                        def _drain_stderr_single():
-                            try:
-                                if ffmpeg_process and ffmpeg_process.stderr:
-                                    while True:
-                                        line = ffmpeg_process.stderr.readline()
-                                        if not line:
-                                            break
-                            except Exception:
-                                pass
-                        try:
-                            threading.Thread(target=_drain_stderr_single, daemon=True).start()
-                        except Exception as e:
-                            print(f"Error starting stderr drain thread: {e}")
-
-                        def generate_and_cache_single():
-                            try:
-                                if cache_path:
-                                    # Ensure directory exists
-                                    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-                                    with open(cache_path, 'wb') as cache_file:
-                                        if ffmpeg_process and ffmpeg_process.stdout:
-                                            while True:
-                                                chunk = ffmpeg_process.stdout.read(65536)
-                                                if not chunk:
-                                                    break
-                                                cache_file.write(chunk)
-                                                yield chunk
-                                else:
-                                    if ffmpeg_process and ffmpeg_process.stdout:
-                                        while True:
-                                            chunk = ffmpeg_process.stdout.read(65536)
-                                            if not chunk:
-                                                break
-                                            yield chunk
-                            except Exception as e:
-                                print(f"Error in generate_and_cache_single: {e}")
-                            finally:
-                                try:
-                                    if ffmpeg_process:
-                                        ffmpeg_process.terminate()
-                                except Exception:
-                                    pass
-
-                        response = Response(generate_and_cache_single(), mimetype='video/mp4')
-                        response.headers['Accept-Ranges'] = 'bytes'
-                        response.headers['Content-Type'] = 'video/mp4'
-                        if duration_value:
-                            duration_str = str(int(duration_value)) if isinstance(duration_value, (int, float)) else str(duration_value)
-                            response.headers['X-Content-Duration'] = duration_str
-                            response.headers['Content-Duration'] = duration_str
-                            response.headers['X-Video-Duration'] = duration_str
-                            response.headers['X-Duration-Seconds'] = duration_str
-                        return response
-                    
-                    # Если не удалось получить URL
-                    else:
-                        response = jsonify({'error': 'Не удалось получить ссылки на потоки.'})
-                        response.status_code = 500
-                        response.headers['Content-Length'] = str(len(response.get_data()))
-                        return response
-
-                except Exception as e:
-                    print(f'Error in direct_url (new approach): {e}')
-                    response = jsonify({'error': f'Internal server error: {str(e)}'})
-                    response.status_code = 500
-                    response.headers['Content-Length'] = str(len(response.get_data()))
+            # Перемотка в ещё не закэшированное видео - отдельный поток с -ss без кэширования
+            seek_time = _parse_seek_time()
+            if seek_time is not None:
+                response = _seek_stream_response(video_id, quality, seek_time, codecs)
+                if response is not None:
                     return response
 
-            # Fallback: прямой прокси без FFmpeg
-            video_url, audio_url = get_video_url(video_id, 'standard')
-            
-            # Если не удалось получить URL, пробуем с другим cookie файлом
-            if not video_url and not audio_url:
-                # Попробуем все доступные cookie файлы
-                cookies_files = get_cookies_files()
-                for cookie_file in cookies_files:
-                    video_url, audio_url = get_video_url(video_id, 'standard', cookie_file)
-                    if video_url or audio_url:
-                        break
-            
-            # Если получили отдельные потоки видео и аудио, используем FFmpeg для объединения
-            if video_url and audio_url:
-                # Комбинируем потоки через FFmpeg
-                user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0 Safari/537.36'
-                common_headers = 'Referer: https://www.youtube.com\r\nOrigin: https://www.youtube.com'
-                ffmpeg_cmd = [
-                    'ffmpeg',
-                    '-hide_banner',
-                    '-loglevel', 'error',
-                    '-nostdin',
-                    '-reconnect', '1',
-                    '-reconnect_streamed', '1',
-                    '-reconnect_at_eof', '1',
-                    '-reconnect_delay_max', '10',
-                    '-user_agent', user_agent,
-                    '-headers', common_headers,
-                    '-i', video_url,
-                    '-user_agent', user_agent,
-                    '-headers', common_headers,
-                    '-i', audio_url,
-                    '-map', '0:v:0',
-                    '-map', '1:a:0',
-                    '-c:v', 'copy',
-                    '-c:a', 'aac',
-                    '-b:a', '160k',
-                    '-movflags', 'frag_keyframe+empty_moov',
-                    '-f', 'mp4',
-                    '-'
-                ]
-
-                try:
-                    ffmpeg_process = subprocess.Popen(
-                        ffmpeg_cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        bufsize=0
-                    )
-                except FileNotFoundError:
-                    return jsonify({'error': 'FFmpeg не найден. Пожалуйста, установите FFmpeg и добавьте его в PATH.'}), 500
-                except Exception as e:
-                    print(f'Error starting FFmpeg process: {e}')
-                    return jsonify({'error': f'Ошибка запуска FFmpeg: {str(e)}'}), 500
-
-                def _drain_stderr_fallback():
-                    try:
-                        if ffmpeg_process and ffmpeg_process.stderr:
-                            while True:
-                                line = ffmpeg_process.stderr.readline()
-                                if not line:
-                                    break
-                    except Exception:
-                        pass
-                try:
-                    threading.Thread(target=_drain_stderr_fallback, daemon=True).start()
-                except Exception as e:
-                    print(f"Error starting stderr drain thread: {e}")
-
-                def generate_and_cache_ffmpeg_fallback():
-                    try:
-                        if cache_path:
-                            # Ensure directory exists
-                            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-                            with open(cache_path, 'wb') as cache_file:
-                                if ffmpeg_process and ffmpeg_process.stdout:
-                                    while True:
-                                        chunk = ffmpeg_process.stdout.read(65536)
-                                        if not chunk:
-                                            break
-                                        cache_file.write(chunk)
-                                        yield chunk
-                        else:
-                            if ffmpeg_process and ffmpeg_process.stdout:
-                                while True:
-                                    chunk = ffmpeg_process.stdout.read(65536)
-                                    if not chunk:
-                                        break
-                                    yield chunk
-                    except Exception as e:
-                        print(f"Error in generate_and_cache_ffmpeg_fallback: {e}")
-                    finally:
-                        try:
-                            if ffmpeg_process:
-                                ffmpeg_process.terminate()
-                        except Exception:
-                            pass
-
-                response = Response(generate_and_cache_ffmpeg_fallback(), mimetype='video/mp4')
-                response.headers['Content-Type'] = 'video/mp4'
-                if duration_value:
-                    duration_str = str(int(duration_value)) if isinstance(duration_value, (int, float)) else str(duration_value)
-                    response.headers['X-Content-Duration'] = duration_str
-                    response.headers['Content-Duration'] = duration_str
-                    response.headers['X-Video-Duration'] = duration_str
-                    response.headers['X-Duration-Seconds'] = duration_str
-                return response
-            # Если получили комбинированный поток (только video_url, audio_url = None)
-            elif video_url and not audio_url:
-                # Process single stream through FFmpeg to ensure proper format
-                user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0 Safari/537.36'
-                common_headers = 'Referer: https://www.youtube.com\r\nOrigin: https://www.youtube.com'
-                ffmpeg_cmd = [
-                    'ffmpeg',
-                    '-hide_banner',
-                    '-loglevel', 'error',
-                    '-nostdin',
-                    '-reconnect', '1',
-                    '-reconnect_streamed', '1',
-                    '-reconnect_at_eof', '1',
-                    '-reconnect_delay_max', '10',
-                    '-user_agent', user_agent,
-                    '-headers', common_headers,
-                    '-i', video_url,
-                    '-c:v', 'copy',
-                    '-c:a', 'aac',
-                    '-b:a', '160k',
-                    '-movflags', 'frag_keyframe+empty_moov',
-                    '-f', 'mp4',
-                    '-'
-                ]
-
-                try:
-                    ffmpeg_process = subprocess.Popen(
-                        ffmpeg_cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        bufsize=0
-                    )
-                except FileNotFoundError:
-                    return jsonify({'error': 'FFmpeg не найден. Пожалуйста, установите FFmpeg и добавьте его в PATH.'}), 500
-                except Exception as e:
-                    print(f'Error starting FFmpeg process: {e}')
-                    return jsonify({'error': f'Ошибка запуска FFmpeg: {str(e)}'}), 500
-
-                def _drain_stderr_single_fallback():
-                    try:
-                        if ffmpeg_process and ffmpeg_process.stderr:
-                            while True:
-                                line = ffmpeg_process.stderr.readline()
-                                if not line:
-                                    break
-                    except Exception:
-                        pass
-                try:
-                    threading.Thread(target=_drain_stderr_single_fallback, daemon=True).start()
-                except Exception as e:
-                    print(f"Error starting stderr drain thread: {e}")
+            # Check if we should cache this video (admission filter based on request frequency)
+            should_cache = should_cache_video(video_id, quality)
+            cache_path = None
+            # Файл кэша в кодеке, который клиент не поддерживает, не перезаписывается - поток отдаётся без кэширования
+            if should_cache and video_id and _accepts_codecs(codecs, _cached_codecs(get_cache_path(video_id, quality))):
+                cache_path = get_cache_path(video_id, quality)
+            cache_manifest = {'video_id': video_id, 'quality': quality, 'duration': duration_value}
+
+            # Single-flight: одновременные запросы одного видео не запускают
+            # собственные извлечение и mux в один и тот же файл кэша
+            if cache_path:
+                is_leader, flight = _join_download((video_id, quality))
+                if not is_leader:
+                    print(f"Waiting for in-progress download of {video_id} ({quality})")
+                    _wait_for_download(flight, config.get('singleflight_wait_timeout', 60))
+                    flight = None
+                # Предыдущий ведущий мог успеть начать или закончить запись
+                existing = _serve_existing(video_id, quality, codecs=codecs)
+                if existing is not None:
+                    return existing
+                if is_leader:
+                    print(f"Caching video {video_id} at {cache_path}")
+                else:
+                    # Ведущий запрос не успел или завершился ошибкой - отдаём поток без записи в кэш
+                    cache_path = None
 
-                def generate_and_cache_single_fallback():
-                    try:
-                        if cache_path:
-                            # Ensure directory exists
-                            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-                            with open(cache_path, 'wb') as cache_file:
-                                if ffmpeg_process and ffmpeg_process.stdout:
-                                    while True:
-                                        chunk = ffmpeg_process.stdout.read(65536)
-                                        if not chunk:
-                                            break
-                                        cache_file.write(chunk)
-                                        yield chunk
-                        else:
-                            if ffmpeg_process and ffmpeg_process.stdout:
-                                while True:
-                                    chunk = ffmpeg_process.stdout.read(65536)
-                                    if not chunk:
-                                        break
-                                    yield chunk
-                    except Exception as e:
-                        print(f"Error in generate_and_cache_single_fallback: {e}")
-                    finally:
-                        try:
-                            if ffmpeg_process:
-                                ffmpeg_process.terminate()
-                        except Exception:
-                            pass
-
-                response = Response(generate_and_cache_single_fallback(), mimetype='video/mp4')
-                response.headers['Accept-Ranges'] = 'bytes'
-                response.headers['Content-Type'] = 'video/mp4'
-                if duration_value:
-                    duration_str = str(int(duration_value)) if isinstance(duration_value, (int, float)) else str(duration_value)
-                    response.headers['X-Content-Duration'] = duration_str
-                    response.headers['Content-Duration'] = duration_str
-                    response.headers['X-Video-Duration'] = duration_str
-                    response.headers['X-Duration-Seconds'] = duration_str
-                return response
-            
-            # Если не удалось получить URL
-            else:
+            cmd, resume = _source_cmd(video_id, quality, cache_manifest, codecs)
+            if not cmd:
                 response = jsonify({'error': 'Не удалось получить прямую ссылку на видео.'})
                 response.status_code = 500
                 response.headers['Content-Length'] = str(len(response.get_data()))
                 return response
 
+            record_cache_miss(video_id, quality)
+            response = _ffmpeg_stream_response(cmd, cache_path, flight, cache_manifest, resume=resume)
+            if response.status_code in (200, 206):
+                response.headers['Accept-Ranges'] = 'bytes'
+                _set_duration_headers(response, duration_value)
+            return response
+
         except Exception as e:
             print(f'Error in direct_url: {e}')
             response = jsonify({'error': f'Internal server error: {str(e)}'})
             response.status_code = 500
             response.headers['Content-Length'] = str(len(response.get_data()))
             return response
+        finally:
+            # Ведущий запрос, не дошедший до потоковой отдачи, освобождает ожидающих
+            if flight is not None and not flight['streaming']:
+                _finish_download(flight)
 
     @video_bp.route('/download', methods=['GET'])
     def download_video():
+        flight = None
         try:
             video_id = request.args.get('video_id')
             quality = request.args.get('quality')
+            codecs = _requested_codecs()
             
             if not video_id:
                 return jsonify({'error': 'ID видео не был передан.'}), 400
 
-            # Check if video is already cached
-            if is_video_cached(video_id, quality):
-                # Serve from cache for download
-                cache_path = get_cache_path(video_id, quality)
-                file_size = os.path.getsize(cache_path)
-                
-                # Получаем информацию о видео для названия файла
-                video_title = "video"
-                try:
-                    # Получаем информацию о видео в формате JSON
-                    url = f'https://www.youtube.com/watch?v={video_id}'
-                    info_output = run_yt_dlp(['--dump-json', '--no-warnings', url])
-                    
-                    if info_output:
-                        info = json.loads(info_output)
-                        video_title = info.get('title', 'video')
-                        # Очищаем название файла от недопустимых символов
-                        video_title = re.sub(r'[<>:"/\\|?*]', '_', video_title)
-                except Exception as e:
-                    print(f"Error fetching video info for video_id {video_id}: {e}")
-                
-                def generate_from_cache():
-                    with open(cache_path, 'rb') as f:
-                        while True:
-                            chunk = f.read(65536)
-                            if not chunk:
-                                break
-                            yield chunk
-                
-                response = Response(generate_from_cache(), mimetype='video/mp4')
-                response.headers['Content-Disposition'] = f'attachment; filename="{video_title}.mp4"'
-                response.headers['Content-Length'] = str(file_size)
-                return response
-
             # Получаем информацию о видео для названия файла
-            video_title = "video"
-            try:
-                # Получаем информацию о видео в формате JSON
-                url = f'https://www.youtube.com/watch?v={video_id}'
-                info_output = run_yt_dlp(['--dump-json', '--no-warnings', url])
-                
-                if info_output:
-                    info = json.loads(info_output)
-                    video_title = info.get('title', 'video')
-                    # Очищаем название файла от недопустимых символов
-                    video_title = re.sub(r'[<>:"/\\|?*]', '_', video_title)
-            except Exception as e:
-                print(f"Error fetching video info for video_id {video_id}: {e}")
+            video_title = _get_download_title(video_id)
 
-            # Check if we should cache this video (based on frequency)
-            # For testing purposes, we'll cache every video
-            should_cache = True  # should_cache_video(video_id)
+            # Serve from cache, or follow the cache file that is still being written
+            existing = _serve_existing(video_id, quality, video_title, codecs)
+            if existing is not None:
+                return existing
+
+            # Check if we should cache this video (admission filter based on request frequency)
+            should_cache = should_cache_video(video_id, quality)
             cache_path = None
-            if should_cache and video_id:
+            if should_cache and video_id and _accepts_codecs(codecs, _cached_codecs(get_cache_path(video_id, quality))):
                 cache_path = get_cache_path(video_id, quality)
-                print(f"Caching video {video_id} at {cache_path} for download")
-
-            # Получаем URL видео и аудио для указанного качества
-            if quality:
-                try:
-                    def parse_desired_height(qval):
-                        if not qval:
-                            return None
-                        s = str(qval).strip().lower()
-                        try:
-                            return int(s)
-                        except Exception:
-                            pass
-                        digits = ''.join(ch for ch in s if ch.isdigit())
-                        if digits:
-                            try:
-                                return int(digits)
-                            except Exception:
-                                pass
-                        aliases = {
-                            'tiny': 144, 'small': 240, 'medium': 360, 'large': 480,
-                            'hd': 720, 'hd720': 720, '720p': 720,
-                            'hd1080': 1080, '1080p': 1080,
-                            '144p': 144, '240p': 240, '360p': 360, '480p': 480,
-                            '2160p': 2160, '1440p': 1440
-                        }
-                        return aliases.get(s)
-
-                    # Используем качество по умолчанию из конфигурации, если не указано
-                    if not quality:
-                        quality = config.get('default_quality', '360')
-                    
-                    desired_height = parse_desired_height(quality)
-                    
-                    # Преобразуем высоту в строку для функции get_video_url
-                    if desired_height:
-                        quality_str = str(desired_height)
-                    else:
-                        quality_str = 'standard'
-                    
-                    # Получаем URL видео и аудио
-                    video_url, audio_url = get_video_url(video_id, quality_str)
-                    
-                    # Если не удалось получить URL, пробуем с другим cookie файлом
-                    if not video_url and not audio_url:
-                        # Попробуем все доступные cookie файлы
-                        cookies_files = get_cookies_files()
-                        for cookie_file in cookies_files:
-                            video_url, audio_url = get_video_url(video_id, quality_str, cookie_file)
-                            if video_url or audio_url:
-                                break
-                    
-                    # Если получили отдельные потоки видео и аудио, используем FFmpeg для объединения
-                    if video_url and audio_url:
-                        # Комбинируем потоки через FFmpeg
-                        user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0 Safari/537.36'
-                        common_headers = 'Referer: https://www.youtube.com\r\nOrigin: https://www.youtube.com'
-                        ffmpeg_cmd = [
-                            'ffmpeg',
-                            '-hide_banner',
-                            '-loglevel', 'error',
-                            '-nostdin',
-                            '-reconnect', '1',
-                            '-reconnect_streamed', '1',
-                            '-reconnect_at_eof', '1',
-                            '-reconnect_delay_max', '10',
-                            '-user_agent', user_agent,
-                            '-headers', common_headers,
-                            '-i', video_url,
-                            '-user_agent', user_agent,
-                            '-headers', common_headers,
-                            '-i', audio_url,
-                            '-map', '0:v:0',
-                            '-map', '1:a:0',
-                            '-c:v', 'copy',
-                            '-c:a', 'aac',
-                            '-b:a', '160k',
-                            '-movflags', 'frag_keyframe+empty_moov',
-                            '-f', 'mp4',
-                            '-'
-                        ]
-
-                        try:
-                            ffmpeg_process = subprocess.Popen(
-                                ffmpeg_cmd,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                bufsize=0
-                            )
-                        except FileNotFoundError:
-                            return jsonify({'error': 'FFmpeg не найден. Пожалуйста, установите FFmpeg и добавьте его в PATH.'}), 500
-                        except Exception as e:
-                            print(f'Error starting FFmpeg process: {e}')
-                            return jsonify({'error': f'Ошибка запуска FFmpeg: {str(e)}'}), 500
-
-                        def _drain_stderr():
-                            try:
-                                if ffmpeg_process and ffmpeg_process.stderr:
-                                    while True:
-                                        line = ffmpeg_process.stderr.readline()
-                                        if not line:
-                                            break
-                            except Exception:
-                                pass
-                        try:
-                            threading.Thread(target=_drain_stderr, daemon=True).start()
-                        except Exception as e:
-                            print(f"Error starting stderr drain thread: {e}")
-
-                        def generate_and_cache_ffmpeg_download():
-                            try:
-                                if cache_path:
-                                    # Ensure directory exists
-                                    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-                                    with open(cache_path, 'wb') as cache_file:
-                                        if ffmpeg_process and ffmpeg_process.stdout:
-                                            while True:
-                                                chunk = ffmpeg_process.stdout.read(65536)
-                                                if not chunk:
-                                                    break
-                                                cache_file.write(chunk)
-                                                yield chunk
-                                else:
-                                    if ffmpeg_process and ffmpeg_process.stdout:
-                                        while True:
-                                            chunk = ffmpeg_process.stdout.read(65536)
-                                            if not chunk:
-                                                break
-                                            yield chunk
-                            except Exception as e:
-                                print(f"Error in generate_and_cache_ffmpeg_download: {e}")
-                            finally:
-                                try:
-                                    if ffmpeg_process:
-                                        ffmpeg_process.terminate()
-                                except Exception:
-                                    pass
-
-                        response = Response(generate_and_cache_ffmpeg_download(), mimetype='video/mp4')
-                        response.headers['Content-Disposition'] = f'attachment; filename="{video_title}.mp4"'
-                        return response
-                    # Если получили комбинированный поток (только video_url, audio_url = None)
-                    elif video_url and not audio_url:
-                        # Process single stream through FFmpeg to ensure proper format
-                        user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0 Safari/537.36'
-                        common_headers = 'Referer: https://www.youtube.com\r\nOrigin: https://www.youtube.com'
-                        ffmpeg_cmd = [
-                            'ffmpeg',
-                            '-hide_banner',
-                            '-loglevel', 'error',
-                            '-nostdin',
-                            '-reconnect', '1',
-                            '-reconnect_streamed', '1',
-                            '-reconnect_at_eof', '1',
-                            '-reconnect_delay_max', '10',
-                            '-user_agent', user_agent,
-                            '-headers', common_headers,
-                            '-i', video_url,
-                            '-c:v', 'copy',
-                            '-c:a', 'aac',
-                            '-b:a', '160k',
-                            '-movflags', 'frag_keyframe+empty_moov',
-                            '-f', 'mp4',
-                            '-'
-                        ]
-
-                        try:
-                            ffmpeg_process = subprocess.Popen(
-                                ffmpeg_cmd,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                bufsize=0
-                            )
-                        except FileNotFoundError:
-                            return jsonify({'error': 'FFmpeg не найден. Пожалуйста, установите FFmpeg и добавьте его в PATH.'}), 500
-                        except Exception as e:
-                            print(f'Error starting FFmpeg process: {e}')
-                            return jsonify({'error': f'Ошибка запуска FFmpeg: {str(e)}'}), 500
-
-                        def _drain_stderr_single():
-                            try:
-                                if ffmpeg_process and ffmpeg_process.stderr:
-                                    while True:
-                                        line = ffmpeg_process.stderr.readline()
-                                        if not line:
-                                            break
-                            except Exception:
-                                pass
-                        try:
-                            threading.Thread(target=_drain_stderr_single, daemon=True).start()
-                        except Exception as e:
-                            print(f"Error starting stderr drain thread: {e}")
-
-                        def generate_and_cache_single_download():
-                            try:
-                                if cache_path:
-                                    # Ensure directory exists
-                                    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-                                    with open(cache_path, 'wb') as cache_file:
-                                        if ffmpeg_process and ffmpeg_process.stdout:
-                                            while True:
-                                                chunk = ffmpeg_process.stdout.read(65536)
-                                                if not chunk:
-                                                    break
-                                                cache_file.write(chunk)
-                                                yield chunk
-                                else:
-                                    if ffmpeg_process and ffmpeg_process.stdout:
-                                        while True:
-                                            chunk = ffmpeg_process.stdout.read(65536)
-                                            if not chunk:
-                                                break
-                                            yield chunk
-                            except Exception as e:
-                                print(f"Error in generate_and_cache_single_download: {e}")
-                            finally:
-                                try:
-                                    if ffmpeg_process:
-                                        ffmpeg_process.terminate()
-                                except Exception:
-                                    pass
-
-                        response = Response(generate_and_cache_single_download(), mimetype='video/mp4')
-                        response.headers['Content-Disposition'] = f'attachment; filename="{video_title}.mp4"'
-                        return response
-                    
-                    # Если не удалось получить URL
-                    else:
-                        response = jsonify({'error': 'Не удалось получить ссылки на потоки.'})
-                        response.status_code = 500
-                        return response
-
-                except Exception as e:
-                    print(f'Error in download (new approach): {e}')
-                    return jsonify({'error': f'Internal server error: {str(e)}'}), 500
+            cached_info = get_cached_video_info(video_id) or {}
+            cache_manifest = {'video_id': video_id, 'quality': quality, 'duration': cached_info.get('duration')}
+
+            # Single-flight: общий ключ с /direct_url, так как файл кэша тот же
+            if cache_path:
+                is_leader, flight = _join_download((video_id, quality))
+                if not is_leader:
+                    print(f"Waiting for in-progress download of {video_id} ({quality})")
+                    _wait_for_download(flight, config.get('singleflight_wait_timeout', 60))
+                    flight = None
+                # Предыдущий ведущий мог успеть начать или закончить запись
+                existing = _serve_existing(video_id, quality, video_title, codecs)
+                if existing is not None:
+                    return existing
+                if is_leader:
+                    print(f"Caching video {video_id} at {cache_path} for download")
+                else:
+                    # Ведущий запрос не успел или завершился ошибкой - отдаём поток без записи в кэш
+                    cache_path = None
 
-            # Fallback: прямой прокси без FFmpeg
-            video_url, audio_url = get_video_url(video_id, 'standard')
-            
-            # Если не удалось получить URL, пробуем с другим cookie файлом
-            if not video_url and not audio_url:
-                # Попробуем все доступные cookie файлы
-                cookies_files = get_cookies_files()
-                for cookie_file in cookies_files:
-                    video_url, audio_url = get_video_url(video_id, 'standard', cookie_file)
-                    if video_url or audio_url:
-                        break
-            
-            # Если получили отдельные потоки видео и аудио, используем FFmpeg для объединения
-            if video_url and audio_url:
-                # Комбинируем потоки через FFmpeg
-                user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0 Safari/537.36'
-                common_headers = 'Referer: https://www.youtube.com\r\nOrigin: https://www.youtube.com'
-                ffmpeg_cmd = [
-                    'ffmpeg',
-                    '-hide_banner',
-                    '-loglevel', 'error',
-                    '-nostdin',
-                    '-reconnect', '1',
-                    '-reconnect_streamed', '1',
-                    '-reconnect_at_eof', '1',
-                    '-reconnect_delay_max', '10',
-                    '-user_agent', user_agent,
-                    '-headers', common_headers,
-                    '-i', video_url,
-                    '-user_agent', user_agent,
-                    '-headers', common_headers,
-                    '-i', audio_url,
-                    '-map', '0:v:0',
-                    '-map', '1:a:0',
-                    '-c:v', 'copy',
-                    '-c:a', 'aac',
-                    '-b:a', '160k',
-                    '-movflags', 'frag_keyframe+empty_moov',
-                    '-f', 'mp4',
-                    '-'
-                ]
+            cmd, resume = _source_cmd(video_id, quality, cache_manifest, codecs)
+            if not cmd:
+                return jsonify({'error': 'Не удалось получить прямую ссылку на видео.'}), 500
 
-                try:
-                    ffmpeg_process = subprocess.Popen(
-                        ffmpeg_cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        bufsize=0
-                    )
-                except FileNotFoundError:
-                    return jsonify({'error': 'FFmpeg не найден. Пожалуйста, установите FFmpeg и добавьте его в PATH.'}), 500
-                except Exception as e:
-                    print(f'Error starting FFmpeg process: {e}')
-                    return jsonify({'error': f'Ошибка запуска FFmpeg: {str(e)}'}), 500
+            record_cache_miss(video_id, quality)
+            response = _ffmpeg_stream_response(cmd, cache_path, flight, cache_manifest, priority=PRIORITY_DOWNLOAD,
+                                               resume=resume)
+            if response.status_code in (200, 206):
+                response.headers['Content-Disposition'] = f'attachment; filename="{video_title}.mp4"'
+            return response
 
-                def _drain_stderr_fallback():
-                    try:
-                        if ffmpeg_process and ffmpeg_process.stderr:
-                            while True:
-                                line = ffmpeg_process.stderr.readline()
-                                if not line:
-                                    break
-                    except Exception:
-                        pass
-                try:
-                    threading.Thread(target=_drain_stderr_fallback, daemon=True).start()
-                except Exception as e:
-                    print(f"Error starting stderr drain thread: {e}")
+        except Exception as e:
+            print('Error in download:', e)
+            return jsonify({'error': 'Internal server error'}), 500
+        finally:
+            # Ведущий запрос, не дошедший до потоковой отдачи, освобождает ожидающих
+            if flight is not None and not flight['streaming']:
+                _finish_download(flight)
+
+    @video_bp.route('/direct_audio_url', methods=['GET', 'HEAD'])
+    def direct_audio_url():
+        flight = None
+        try:
+            video_id = request.args.get('video_id')
+            proxy_param = request.args.get('proxy', 'true').lower()
+            use_proxy = proxy_param != 'false'
+            # m4a (AAC) по умолчанию, mp3 - для старых устройств
+            audio_name = (request.args.get('format') or 'm4a').lower()
+            if audio_name not in AUDIO_FORMATS:
+                audio_name = 'm4a'
+            quality = AUDIO_FORMATS[audio_name]['quality']
+            mimetype = AUDIO_FORMATS[audio_name]['mimetype']
 
-                def generate_and_cache_ffmpeg_download_fallback():
-                    try:
-                        if cache_path:
-                            # Ensure directory exists
-                            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-                            with open(cache_path, 'wb') as cache_file:
-                                if ffmpeg_process and ffmpeg_process.stdout:
-                                    while True:
-                                        chunk = ffmpeg_process.stdout.read(65536)
-                                        if not chunk:
-                                            break
-                                        cache_file.write(chunk)
-                                        yield chunk
-                        else:
-                            if ffmpeg_process and ffmpeg_process.stdout:
-                                while True:
-                                    chunk = ffmpeg_process.stdout.read(65536)
-                                    if not chunk:
-                                        break
-                                    yield chunk
-                    except Exception as e:
-                        print(f"Error in generate_and_cache_ffmpeg_download_fallback: {e}")
-                    finally:
-                        try:
-                            if ffmpeg_process:
-                                ffmpeg_process.terminate()
-                        except Exception:
-                            pass
-
-                response = Response(generate_and_cache_ffmpeg_download_fallback(), mimetype='video/mp4')
-                response.headers['Content-Disposition'] = f'attachment; filename="{video_title}.mp4"'
+            if not video_id:
+                response = jsonify({'error': 'ID видео не был передан.'})
+                response.status_code = 400
+                response.headers['Content-Length'] = str(len(response.get_data()))
                 return response
-            # Если получили комбинированный поток (только video_url, audio_url = None)
-            elif video_url and not audio_url:
-                # Process single stream through FFmpeg to ensure proper format
-                user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0 Safari/537.36'
-                common_headers = 'Referer: https://www.youtube.com\r\nOrigin: https://www.youtube.com'
-                ffmpeg_cmd = [
-                    'ffmpeg',
-                    '-hide_banner',
-                    '-loglevel', 'error',
-                    '-nostdin',
-                    '-reconnect', '1',
-                    '-reconnect_streamed', '1',
-                    '-reconnect_at_eof', '1',
-                    '-reconnect_delay_max', '10',
-                    '-user_agent', user_agent,
-                    '-headers', common_headers,
-                    '-i', video_url,
-                    '-c:v', 'copy',
-                    '-c:a', 'aac',
-                    '-b:a', '160k',
-                    '-movflags', 'frag_keyframe+empty_moov',
-                    '-f', 'mp4',
-                    '-'
-                ]
 
-                try:
-                    ffmpeg_process = subprocess.Popen(
-                        ffmpeg_cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        bufsize=0
-                    )
-                except FileNotFoundError:
-                    return jsonify({'error': 'FFmpeg не найден. Пожалуйста, установите FFmpeg и добавьте его в PATH.'}), 500
-                except Exception as e:
-                    print(f'Error starting FFmpeg process: {e}')
-                    return jsonify({'error': f'Ошибка запуска FFmpeg: {str(e)}'}), 500
+            # Если proxy=false, перенаправляем на прямую ссылку
+            if not use_proxy:
+                audio_format = _resolve_audio_format(video_id, 'mp4a')
+                if not audio_format:
+                    response = jsonify({'error': 'Не удалось получить ссылку на аудио поток.'})
+                    response.status_code = 500
+                    response.headers['Content-Length'] = str(len(response.get_data()))
+                    return response
+                return redirect(audio_format['url'])
 
-                def _drain_stderr_single_fallback():
-                    try:
-                        if ffmpeg_process and ffmpeg_process.stderr:
-                            while True:
-                                line = ffmpeg_process.stderr.readline()
-                                if not line:
-                                    break
-                    except Exception:
-                        pass
-                try:
-                    threading.Thread(target=_drain_stderr_single_fallback, daemon=True).start()
-                except Exception as e:
-                    print(f"Error starting stderr drain thread: {e}")
+            # Serve from cache (with Range), or follow the cache file that is still being written
+            cache_path = get_cache_path(video_id, quality)
+            if is_video_cached(video_id, quality):
+                increment_video_view_count(video_id, quality)
+                return send_cached_file(cache_path, mimetype)
+            cache_entry = get_in_progress_entry(cache_path)
+            if cache_entry is not None:
+                increment_video_view_count(video_id, quality)
+                return _tail_response(cache_entry, mimetype=mimetype)
+
+            # Длительность берётся из того же извлечения, что и ссылка
+            duration_value = None
+            try:
+                info = get_video_info(video_id)
+                if info:
+                    duration_value = info.get('duration')
+            except Exception as e:
+                print(f"Error fetching duration for video_id {video_id}: {e}")
 
-                def generate_and_cache_single_download_fallback():
-                    try:
-                        if cache_path:
-                            # Ensure directory exists
-                            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-                            with open(cache_path, 'wb') as cache_file:
-                                if ffmpeg_process and ffmpeg_process.stdout:
-                                    while True:
-                                        chunk = ffmpeg_process.stdout.read(65536)
-                                        if not chunk:
-                                            break
-                                        cache_file.write(chunk)
-                                        yield chunk
-                        else:
-                            if ffmpeg_process and ffmpeg_process.stdout:
-                                while True:
-                                    chunk = ffmpeg_process.stdout.read(65536)
-                                    if not chunk:
-                                        break
-                                    yield chunk
-                    except Exception as e:
-                        print(f"Error in generate_and_cache_single_download_fallback: {e}")
-                    finally:
-                        try:
-                            if ffmpeg_process:
-                                ffmpeg_process.terminate()
-                        except Exception:
-                            pass
-
-                response = Response(generate_and_cache_single_download_fallback(), mimetype='video/mp4')
-                response.headers['Content-Disposition'] = f'attachment; filename="{video_title}.mp4"'
+            # Обработка HEAD запроса
+            if request.method == 'HEAD':
+                response = Response(None, mimetype=mimetype)
+                _set_duration_headers(response, duration_value)
+                response.headers['Accept-Ranges'] = 'bytes'
+                response.headers['Content-Type'] = mimetype
                 return response
-            
-            # Если не удалось получить URL
-            else:
-                response = jsonify({'error': 'Не удалось получить прямую ссылку на видео.'})
+
+            should_cache = should_cache_video(video_id, quality)
+            if not should_cache:
+                cache_path = None
+            cache_manifest = {'video_id': video_id, 'quality': quality, 'duration': duration_value}
+
+            # Single-flight, как у видео: одна запись файла кэша на трек
+            if cache_path:
+                is_leader, flight = _join_download((video_id, quality))
+                if not is_leader:
+                    print(f"Waiting for in-progress download of {video_id} ({quality})")
+                    _wait_for_download(flight, config.get('singleflight_wait_timeout', 60))
+                    flight = None
+                if is_video_cached(video_id, quality):
+                    increment_video_view_count(video_id, quality)
+                    return send_cached_file(cache_path, mimetype)
+                cache_entry = get_in_progress_entry(cache_path)
+                if cache_entry is not None:
+                    increment_video_view_count(video_id, quality)
+                    return _tail_response(cache_entry, mimetype=mimetype)
+                if is_leader:
+                    print(f"Caching audio {video_id} ({audio_name}) at {cache_path}")
+                else:
+                    cache_path = None
+
+            cmd, resume = _audio_source_cmd(video_id, audio_name)
+            if not cmd:
+                response = jsonify({'error': 'Не удалось получить ссылку на аудио поток.'})
                 response.status_code = 500
+                response.headers['Content-Length'] = str(len(response.get_data()))
                 return response
 
+            record_cache_miss(video_id, quality)
+            response = _ffmpeg_stream_response(cmd, cache_path, flight, cache_manifest, resume=resume, mimetype=mimetype)
+            if response.status_code in (200, 206):
+                response.headers['Accept-Ranges'] = 'bytes'
+                _set_duration_headers(response, duration_value)
+            return response
         except Exception as e:
-            print('Error in download:', e)
-            return jsonify({'error': 'Internal server error'}), 500
+            print(f'Error in direct_audio_url: {e}')
+            response = jsonify({'error': f'Internal server error: {str(e)}'})
+            response.status_code = 500
+            response.headers['Content-Length'] = str(len(response.get_data()))
+            return response
+        finally:
+            # Ведущий запрос, не дошедший до потоковой отдачи, освобождает ожидающих
+            if flight is not None and not flight['streaming']:
+                _finish_download(flight)
 
     @video_bp.route('/thumbnail/<video_id>')
     def thumbnail_proxy(video_id):
@@ -1527,12 +1334,12 @@ def setup_video_routes(config):
             thumbnail_type = quality_map.get(quality, 'mqdefault.jpg')
             url = f'https://i.ytimg.com/vi/{video_id}/{thumbnail_type}'
             
-            resp = requests.get(url, stream=True, timeout=10)
+            resp = http_client.get(url, stream=True, timeout=10)
             
             # If the requested thumbnail is not found, fallback to medium quality
             if resp.status_code == 404 and thumbnail_type != 'mqdefault.jpg':
                 fallback_url = f'https://i.ytimg.com/vi/{video_id}/mqdefault.jpg'
-                resp = requests.get(fallback_url, stream=True, timeout=10)
+                resp = http_client.get(fallback_url, stream=True, timeout=10)
             
             return Response(resp.content, mimetype=resp.headers.get('Content-Type', 'image/jpeg'))
         except Exception as e:
@@ -1551,7 +1358,7 @@ def setup_video_routes(config):
                 
                 # Proxy the image directly
                 try:
-                    image_resp = requests.get(video_id, timeout=30, headers=headers)
+                    image_resp = http_client.get(video_id, timeout=30, headers=headers)
                     image_resp.raise_for_status()
                     
                     return Response(
@@ -1562,7 +1369,7 @@ def setup_video_routes(config):
                 except requests.exceptions.SSLError as ssl_error:
                     print(f'SSL Error fetching image: {ssl_error}')
                     # Try again without SSL verification as a fallback
-                    image_resp = requests.get(video_id, timeout=30, headers=headers, verify=False)
+                    image_resp = http_client.get(video_id, timeout=30, headers=headers, verify=False)
                     image_resp.raise_for_status()
                     
                     return Response(
@@ -1592,7 +1399,7 @@ def setup_video_routes(config):
             
             # Proxy the thumbnail image
             try:
-                thumbnail_resp = requests.get(thumbnail_url, timeout=30, headers=headers)
+                thumbnail_resp = http_client.get(thumbnail_url, timeout=30, headers=headers)
                 thumbnail_resp.raise_for_status()
                 
                 return Response(
@@ -1603,7 +1410,7 @@ def setup_video_routes(config):
             except requests.exceptions.SSLError as ssl_error:
                 print(f'SSL Error fetching thumbnail: {ssl_error}')
                 # Try again without SSL verification as a fallback
-                thumbnail_resp = requests.get(thumbnail_url, timeout=30, headers=headers, verify=False)
+                thumbnail_resp = http_client.get(thumbnail_url, timeout=30, headers=headers, verify=False)
                 thumbnail_resp.raise_for_status()
                 
                 return Response(
@@ -1634,8 +1441,8 @@ def setup_video_routes(config):
                 'Range': request.headers.get('Range', 'bytes=0-'),
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
             }
-            # Используем сессию без таймаутов для потоковой передачи
-            resp = streaming_session.get(url, headers=headers, stream=True)
+            # Для потока таймаут - на ожидание очередного куска, а не на весь ответ
+            resp = http_client.get(url, headers=headers, stream=True, timeout=STREAM_TIMEOUT)
             def generate():
                 try:
                     resp.raise_for_status()
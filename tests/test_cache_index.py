@@ -0,0 +1,37 @@
+import os
+
+from utils.cache_index import CacheIndex
+
+
+def _index(tmp_path):
+    root = str(tmp_path / 'cache')
+    os.makedirs(root)
+    return CacheIndex(os.path.join(root, 'cache_index.sqlite3'), root), root
+
+
+def test_add_same_path_twice_replaces_row(tmp_path):
+    index, root = _index(tmp_path)
+    path = os.path.join(root, 'ab', 'cd', 'video.mp4')
+    index.add(path, 'vid', '360', 1000)
+    index.record_hit(path)
+    index.add(path, 'vid', '360', 2500)
+
+    entry = index.get(path)
+    assert entry['size'] == 2500
+    assert entry['hits'] == 1
+    assert index.total_size() == 2500
+    assert index.count() == 1
+    assert index.quality_size('360') == 2500
+    index.close()
+
+
+def test_re_add_with_new_quality_moves_totals(tmp_path):
+    index, root = _index(tmp_path)
+    path = os.path.join(root, 'video.mp4')
+    index.add(path, 'vid', '360', 1000)
+    index.add(path, 'vid', '720', 3000)
+
+    assert index.quality_size('360') == 0
+    assert index.quality_size('720') == 3000
+    assert index.quality_sizes() == {'720': (3000, 1)}
+    index.close()
@@ -0,0 +1,40 @@
+import os
+
+from utils import video_cache
+from utils.cache_index import CacheIndex
+
+
+def _entry(tmp_path, monkeypatch):
+    root = tmp_path / 'cache'
+    root.mkdir()
+    monkeypatch.setattr(video_cache, '_cache_index', CacheIndex(str(root / 'index.sqlite3'), str(root)))
+    monkeypatch.setattr(video_cache, 'check_and_cleanup_cache', lambda *args, **kwargs: None)
+    path = str(root / 'ab' / 'cd' / 'video.mp4')
+    return video_cache.start_cache_entry(path, manifest={'video_id': 'vid', 'quality': '360'}), path
+
+
+def test_commit_copies_when_rename_is_blocked_by_a_reader(tmp_path, monkeypatch):
+    entry, path = _entry(tmp_path, monkeypatch)
+    entry.append(b'x' * 1000)
+    reader = entry.iter_from(0, chunk_size=100)
+    assert next(reader) == b'x' * 100
+
+    # Windows refuses to rename a file another handle has open
+    real_replace = os.replace
+
+    def replace(src, dst):
+        if src == entry.partial_path:
+            raise PermissionError(32, 'The process cannot access the file')
+        return real_replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', replace)
+    entry.finish(True)
+
+    assert entry.ok
+    with open(path, 'rb') as f:
+        assert f.read() == b'x' * 1000
+    assert video_cache.get_cache_index().get(path)['size'] == 1000
+    assert os.path.exists(entry.partial_path)
+
+    assert b''.join(reader) == b'x' * 900
+    assert not os.path.exists(entry.partial_path)
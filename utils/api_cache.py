@@ -0,0 +1,237 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+from .api_keys import get_key_scheduler
+
+try:
+    import redis
+except ImportError:  # общий кэш не используется, если модуль redis не установлен
+    redis = None
+
+# Время жизни ответа по методу Data API, секунды (переопределяется api_cache_ttl в config.json)
+DEFAULT_TTLS = {
+    'videoCategories': 3 * 24 * 3600,
+    'videos:mostPopular': 10 * 60,
+    'videos': 30 * 60,
+    'channels': 3600,
+    'playlists': 3600,
+    'playlistItems': 15 * 60,
+    'search': 15 * 60,
+    'commentThreads': 10 * 60,
+}
+DEFAULT_TTL = 5 * 60
+# После истечения TTL ответ ещё столько же (но не дольше DEFAULT_MAX_STALE) отдаётся, пока обновляется в фоне
+DEFAULT_MAX_STALE = 24 * 3600
+DEFAULT_MAX_ENTRIES = 5000
+DEFAULT_TIMEOUT = 30
+REDIS_PREFIX = 'ytapi:'
+# Параметры запроса, не влияющие на ответ: ключ API (у всех ключей одни и те же данные)
+IGNORED_PARAMS = ('key',)
+
+
+def _normalize(url):
+    """Ключ кэша: метод Data API и отсортированные параметры без ключа API."""
+    parts = urlsplit(url)
+    params = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in IGNORED_PARAMS)
+    return f"{parts.path.rstrip('/')}?{urlencode(params)}"
+
+
+def _endpoint(url):
+    """Метод Data API ('videos', 'channels', ...); чарты популярного - отдельно ('videos:mostPopular')."""
+    parts = urlsplit(url)
+    method = parts.path.rstrip('/').rsplit('/', 1)[-1]
+    if method == 'videos' and ('chart', 'mostPopular') in parse_qsl(parts.query):
+        return 'videos:mostPopular'
+    return method
+
+
+class CachedResponse:
+    """Ответ 200 из кэша с тем же интерфейсом, что у requests.Response, который используют маршруты."""
+
+    status_code = 200
+    ok = True
+
+    def __init__(self, body):
+        self.text = body
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        pass
+
+
+class MemoryBackend:
+    """Кэш в памяти процесса: LRU не больше max_entries ответов."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max(1, int(max_entries))
+        self._entries = OrderedDict()  # key -> (body, fresh_until, stale_until)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, fresh_until, stale_until):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (body, fresh_until, stale_until)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class RedisBackend:
+    """Общий кэш для нескольких процессов (воркеров) в Redis; запись живёт до stale_until."""
+
+    def __init__(self, url):
+        self._client = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+
+    def get(self, key):
+        try:
+            raw = self._client.get(REDIS_PREFIX + key)
+        except redis.RedisError as e:
+            print(f"[ERROR] API cache: Redis read failed: {e}")
+            return None
+        if raw is None:
+            return None
+        try:
+            entry = json.loads(raw)
+            return entry['body'], entry['fresh_until'], entry['stale_until']
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def set(self, key, body, fresh_until, stale_until):
+        ttl = max(1, int(stale_until - time.time()))
+        value = json.dumps({'body': body, 'fresh_until': fresh_until, 'stale_until': stale_until})
+        try:
+            self._client.setex(REDIS_PREFIX + key, ttl, value)
+        except redis.RedisError as e:
+            print(f"[ERROR] API cache: Redis write failed: {e}")
+
+    def size(self):
+        return None
+
+
+class APICache:
+    """Кэш ответов YouTube Data API v3 для GET-запросов маршрутов.
+
+    Ключ - метод и параметры запроса без ключа API, поэтому одинаковые
+    запросы через разные ключи делят один ответ. Кэшируются только ответы
+    200, время жизни зависит от метода (ttls). Истёкший ответ ещё до
+    max_stale секунд отдаётся сразу, а обновляется фоновым запросом
+    (stale-while-revalidate, один на ключ).
+    """
+
+    def __init__(self, backend, ttls=None, max_stale=DEFAULT_MAX_STALE, enabled=True):
+        self.backend = backend
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.max_stale = max_stale
+        self.enabled = enabled
+        self._revalidating = set()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'revalidations': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _fetch(self, url, key, endpoint, timeout):
+        """Запрос к API (с заменой ключа при исчерпанной квоте); ответ 200 сохраняется в кэше."""
+        response = get_key_scheduler().get(url, timeout=timeout)
+        if response.status_code == 200:
+            ttl = self.ttls.get(endpoint, DEFAULT_TTL)
+            now = time.time()
+            self.backend.set(key, response.text, now + ttl, now + ttl + min(ttl, self.max_stale))
+        return response
+
+    def _revalidate(self, url, key, endpoint, timeout):
+        with self._lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+            self._stats['revalidations'] += 1
+
+        def run():
+            try:
+                self._fetch(url, key, endpoint, timeout)
+            except Exception as e:
+                self._count('errors')
+                print(f"[ERROR] API cache: revalidation of {endpoint} failed: {e}")
+            finally:
+                with self._lock:
+                    self._revalidating.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get(self, url, timeout=DEFAULT_TIMEOUT):
+        """GET к Data API через кэш: CachedResponse или requests.Response (промах, не 200)."""
+        if not self.enabled:
+            return get_key_scheduler().get(url, timeout=timeout)
+        key = _normalize(url)
+        endpoint = _endpoint(url)
+        entry = self.backend.get(key)
+        if entry is not None:
+            body, fresh_until, _ = entry
+            if fresh_until > time.time():
+                self._count('hits')
+            else:
+                self._count('stale_hits')
+                self._revalidate(url, key, endpoint, timeout)
+            return CachedResponse(body)
+        self._count('misses')
+        return self._fetch(url, key, endpoint, timeout)
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._stats)
+        metrics['backend'] = type(self.backend).__name__
+        metrics['entries'] = self.backend.size()
+        return metrics
+
+
+_api_cache = APICache(MemoryBackend())
+
+
+def init_api_cache(config):
+    """Читает api_cache_* из config.json: TTL по методам, хранилище (память процесса или Redis)."""
+    global _api_cache
+    backend = MemoryBackend(config.get('api_cache_max_entries', DEFAULT_MAX_ENTRIES))
+    redis_url = config.get('api_cache_redis_url')
+    if redis_url:
+        if redis is None:
+            print("[ERROR] api_cache_redis_url задан, но модуль redis не установлен. Используется кэш в памяти.")
+        else:
+            backend = RedisBackend(redis_url)
+    _api_cache = APICache(
+        backend,
+        ttls=config.get('api_cache_ttl'),
+        max_stale=config.get('api_cache_max_stale', DEFAULT_MAX_STALE),
+        enabled=config.get('api_cache_enabled', True),
+    )
+    print(f"[DEBUG] Data API cache: {'on' if _api_cache.enabled else 'off'}, {type(backend).__name__}")
+    return _api_cache
+
+
+def get_api_cache():
+    return _api_cache
+
+
+def api_get(url, timeout=DEFAULT_TIMEOUT):
+    """GET к YouTube Data API v3 через общий кэш ответов."""
+    return _api_cache.get(url, timeout=timeout)
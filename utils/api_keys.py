@@ -0,0 +1,220 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from . import http_client
+
+try:
+    from zoneinfo import ZoneInfo
+    PACIFIC = ZoneInfo('America/Los_Angeles')
+except Exception:  # нет zoneinfo или базы часовых поясов - без учёта летнего времени
+    PACIFIC = timezone(timedelta(hours=-8))
+
+# Суточная квота Data API на ключ и стоимость запросов в единицах квоты
+DAILY_QUOTA = 10000
+METHOD_COSTS = {
+    'search': 100,
+}
+DEFAULT_COST = 1
+# Причины ошибок Data API: квота исчерпана до сброса, ключ недействителен, временное ограничение частоты
+QUOTA_REASONS = ('quotaExceeded', 'dailyLimitExceeded')
+INVALID_KEY_REASONS = ('keyInvalid', 'keyExpired', 'API_KEY_INVALID', 'accessNotConfigured', 'ipRefererBlocked')
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+RATE_LIMIT_QUARANTINE = 60
+
+
+class NoAPIKeyError(RuntimeError):
+    """В config.json нет ни одного ключа Data API (api_keys / api_key)."""
+
+
+def next_quota_reset(now=None):
+    """Unix-время ближайшей полуночи по тихоокеанскому времени - тогда Google обнуляет квоты."""
+    current = datetime.fromtimestamp(now if now is not None else time.time(), PACIFIC)
+    midnight = datetime(current.year, current.month, current.day, tzinfo=PACIFIC) + timedelta(days=1)
+    return midnight.timestamp()
+
+
+def method_cost(url):
+    """Стоимость запроса к Data API в единицах квоты по его методу."""
+    method = urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+    return METHOD_COSTS.get(method, DEFAULT_COST)
+
+
+def _url_key(url):
+    for name, value in parse_qsl(urlsplit(url).query, keep_blank_values=True):
+        if name == 'key':
+            return value
+    return None
+
+
+def _with_key(url, key):
+    parts = urlsplit(url)
+    params = [(name, key if name == 'key' else value) for name, value in parse_qsl(parts.query, keep_blank_values=True)]
+    return urlunsplit(parts._replace(query=urlencode(params)))
+
+
+def _error_reason(response):
+    """Причина ошибки из тела ответа Data API ('quotaExceeded', 'keyInvalid', ...) или None."""
+    try:
+        error = response.json().get('error') or {}
+    except ValueError:
+        return None
+    for item in error.get('errors') or []:
+        if item.get('reason'):
+            return item['reason']
+    for item in error.get('details') or []:
+        if item.get('reason'):
+            return item['reason']
+    return error.get('status')
+
+
+class _KeyState:
+    __slots__ = ('used', 'quarantined_until', 'reason', 'requests')
+
+    def __init__(self):
+        self.used = 0
+        self.quarantined_until = 0.0
+        self.reason = None
+        self.requests = 0
+
+
+class APIKeyScheduler:
+    """Выбор ключа Data API с учётом израсходованной квоты.
+
+    Для каждого ключа считается оценка израсходованных за сутки единиц
+    (search - 100, остальные методы - 1); счётчики обнуляются в полночь
+    по тихоокеанскому времени. pick() отдаёт ключ с наибольшим остатком.
+    Ключ, получивший quotaExceeded или ошибку недействительного ключа,
+    выводится из ротации до сброса квоты, при ограничении частоты - на
+    RATE_LIMIT_QUARANTINE секунд.
+
+    get() выполняет запрос и при такой ошибке незаметно для клиента
+    повторяет его с другим ключом, пока есть исправные.
+    """
+
+    def __init__(self, keys, daily_quota=DAILY_QUOTA):
+        self.keys = list(dict.fromkeys(k for k in keys if k))
+        self.daily_quota = daily_quota
+        self._state = {key: _KeyState() for key in self.keys}
+        self._reset_at = next_quota_reset()
+        self._lock = threading.Lock()
+        self._stats = {'retries': 0, 'quarantined': 0, 'exhausted': 0}
+
+    def _maybe_reset(self, now):
+        """Новые сутки по тихоокеанскому времени: счётчики и карантины квоты сбрасываются. Lock held."""
+        if now < self._reset_at:
+            return
+        for state in self._state.values():
+            state.used = 0
+            state.requests = 0
+            if state.quarantined_until <= self._reset_at:
+                state.quarantined_until = 0.0
+                state.reason = None
+        self._reset_at = next_quota_reset(now)
+
+    def pick(self, exclude=()):
+        """Исправный ключ с наибольшим остатком квоты, или None, если ключей нет."""
+        now = time.time()
+        with self._lock:
+            self._maybe_reset(now)
+            healthy = [k for k in self.keys if k not in exclude and self._state[k].quarantined_until <= now]
+            if not healthy:
+                if exclude:
+                    return None
+                # Все ключи в карантине - отдаём хоть какой-то, API сам вернёт ошибку
+                self._stats['exhausted'] += 1
+                return min(self.keys, key=lambda k: self._state[k].quarantined_until) if self.keys else None
+            return min(healthy, key=lambda k: self._state[k].used)
+
+    def is_managed(self, key):
+        return key in self._state
+
+    def record(self, key, cost):
+        with self._lock:
+            state = self._state.get(key)
+            if state is not None:
+                state.used += cost
+                state.requests += 1
+
+    def quarantine(self, key, reason):
+        """Выводит ключ из ротации; сообщение - один раз, а не на каждый запрос с этим ключом."""
+        now = time.time()
+        until = now + RATE_LIMIT_QUARANTINE if reason in RATE_LIMIT_REASONS else next_quota_reset(now)
+        with self._lock:
+            state = self._state.get(key)
+            if state is None:
+                return
+            changed = state.quarantined_until <= now or state.reason != reason
+            state.quarantined_until = max(state.quarantined_until, until)
+            state.reason = reason
+            if changed:
+                self._stats['quarantined'] += 1
+            until = state.quarantined_until
+        if changed:
+            print(f"[DEBUG] API key ...{key[-4:]} quarantined ({reason}) until "
+                  f"{datetime.fromtimestamp(until, PACIFIC).strftime('%Y-%m-%d %H:%M %Z')}")
+
+    def get(self, url, timeout=None):
+        """GET к Data API: при исчерпанной квоте или недействительном ключе повторяет запрос с другим ключом.
+
+        Ключ, переданный клиентом (параметр apikey), не подменяется. Квота
+        засчитывается только за ответ, который её расходует: 2xx или ошибку
+        запроса 4xx; сетевые ошибки, 5xx и отказы из-за квоты или ключа - нет.
+        """
+        key = _url_key(url)
+        if key is None or not self.is_managed(key):
+            # Запрос без ключа или с ключом клиента - без учёта квоты и повторов
+            return http_client.get(url, timeout=timeout)
+        tried = set()
+        cost = method_cost(url)
+        while True:
+            response = http_client.get(url, timeout=timeout)
+            reason = _error_reason(response) if response.status_code in (400, 403, 429) else None
+            if reason not in QUOTA_REASONS + INVALID_KEY_REASONS + RATE_LIMIT_REASONS:
+                if 200 <= response.status_code < 500:
+                    self.record(key, cost)
+                return response
+            self.quarantine(key, reason)
+            tried.add(key)
+            key = self.pick(exclude=tried)
+            if key is None:
+                return response
+            with self._lock:
+                self._stats['retries'] += 1
+            url = _with_key(url, key)
+
+    def metrics(self):
+        now = time.time()
+        with self._lock:
+            self._maybe_reset(now)
+            metrics = dict(self._stats)
+            metrics['reset_at'] = self._reset_at
+            metrics['keys'] = [{
+                'key': f"...{key[-4:]}",
+                'used': state.used,
+                'requests': state.requests,
+                'headroom': max(0, self.daily_quota - state.used),
+                'quarantined_until': state.quarantined_until if state.quarantined_until > now else None,
+                'reason': state.reason if state.quarantined_until > now else None,
+            } for key, state in self._state.items()]
+        return metrics
+
+
+_scheduler = APIKeyScheduler([])
+
+
+def init_api_keys(config):
+    """Ключи из api_keys (или одиночного api_key) и суточная квота api_daily_quota из config.json."""
+    global _scheduler
+    keys = config.get('api_keys') or ([config['api_key']] if config.get('api_key') else [])
+    _scheduler = APIKeyScheduler(keys, daily_quota=config.get('api_daily_quota', DAILY_QUOTA))
+    if not _scheduler.keys:
+        print("[ERROR] В config.json нет ключей Data API (api_keys / api_key)")
+    else:
+        print(f"[DEBUG] API key scheduler: {len(_scheduler.keys)} keys, {_scheduler.daily_quota} units/day each")
+    return _scheduler
+
+
+def get_key_scheduler():
+    return _scheduler
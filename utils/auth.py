@@ -9,6 +9,8 @@ import html
 from urllib.parse import quote
 from threading import Lock
 
+from . import http_client
+
 # Global dictionary to store tokens by session ID
 token_store = {}
 token_store_lock = Lock()
@@ -50,7 +52,7 @@ def get_access_token(auth_code):
         'redirect_uri': REDIRECT_URI,
         'grant_type': 'authorization_code'
     }
-    response = requests.post('https://oauth2.googleapis.com/token', data=data)
+    response = http_client.post('https://oauth2.googleapis.com/token', data=data)
     response.raise_for_status()
     return response.json()
 
@@ -62,7 +64,7 @@ def refresh_access_token(refresh_token):
         'refresh_token': refresh_token,
         'grant_type': 'refresh_token'
     }
-    response = requests.post('https://oauth2.googleapis.com/token', data=data)
+    response = http_client.post('https://oauth2.googleapis.com/token', data=data)
     response.raise_for_status()
     return response.json()
     
@@ -74,10 +76,10 @@ def get_account_info(access_token):
     }
     
     # Get basic profile info
-    profile_response = requests.get(
+    profile_response = http_client.get(
         'https://www.googleapis.com/oauth2/v2/userinfo',
         headers=headers,
-        timeout=30  # Assuming timeout from config
+        timeout=30
     )
     
     if profile_response.status_code != 200:
@@ -88,10 +90,10 @@ def get_account_info(access_token):
     # Get YouTube channel info if available
     youtube_data = None
     try:
-        youtube_response = requests.get(
+        youtube_response = http_client.get(
             'https://www.googleapis.com/youtube/v3/channels?part=snippet,statistics&mine=true',
             headers=headers,
-            timeout=30  # Assuming timeout from config
+            timeout=30
         )
         if youtube_response.status_code == 200:
             youtube_data = youtube_response.json()
@@ -0,0 +1,177 @@
+import threading
+import time
+
+MODES = ('always', 'nhits', 'tinylfu')
+DEFAULT_MODE = 'tinylfu'
+DEFAULT_MIN_HITS = 2
+DEFAULT_WINDOW = 3600
+DEFAULT_SKETCH_WIDTH = 65536
+
+SKETCH_DEPTH = 4
+# Counters are bytes, saturating here; aging halves them
+COUNTER_MAX = 255
+
+
+class CountMinSketch:
+    """Approximate per-key request counts in depth * width bytes.
+
+    Estimates never undercount; collisions can only make a key look more
+    popular. halve() ages every counter at once.
+    """
+
+    def __init__(self, width=DEFAULT_SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = max(64, int(width))
+        self.depth = depth
+        self._rows = [bytearray(self.width) for _ in range(depth)]
+
+    def _slots(self, key):
+        h = hash(key)
+        h1 = h & 0xffffffff
+        h2 = ((h >> 32) & 0xffffffff) | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key):
+        for row, slot in zip(self._rows, self._slots(key)):
+            if row[slot] < COUNTER_MAX:
+                row[slot] += 1
+
+    def estimate(self, key):
+        return min(row[slot] for row, slot in zip(self._rows, self._slots(key)))
+
+    def halve(self):
+        for i, row in enumerate(self._rows):
+            self._rows[i] = bytearray(value >> 1 for value in row)
+
+
+class Doorkeeper:
+    """Bloom filter that absorbs the first request of every key.
+
+    Keys seen once never reach the sketch, so one-hit wonders do not take up
+    counters. Cleared together with the sketch aging.
+    """
+
+    def __init__(self, bits, hashes=3):
+        self.bits = max(64, int(bits))
+        self.hashes = hashes
+        self._bits = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        h = hash(('doorkeeper', key))
+        h1 = h & 0xffffffff
+        h2 = ((h >> 32) & 0xffffffff) | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        """Set the key's bits; returns True if it was (probably) already present."""
+        present = True
+        for pos in self._positions(key):
+            byte, bit = divmod(pos, 8)
+            if not self._bits[byte] & (1 << bit):
+                present = False
+                self._bits[byte] |= 1 << bit
+        return present
+
+    def contains(self, key):
+        for pos in self._positions(key):
+            byte, bit = divmod(pos, 8)
+            if not self._bits[byte] & (1 << bit):
+                return False
+        return True
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+
+
+class AdmissionFilter:
+    """Decides whether a missed video is worth writing to the cache.
+
+    Every request (hit or miss) is recorded. Frequency is a TinyLFU
+    estimate: doorkeeper bit plus count-min sketch counter. Counts are
+    halved every `window` seconds or after 10 * width recorded requests,
+    whichever comes first, so the estimate follows recent popularity and
+    memory stays fixed (about depth * width bytes).
+
+    Modes:
+      always  - admit everything (previous behaviour)
+      nhits   - admit once a video was requested min_hits times recently
+      tinylfu - as nhits, and when the cache is full the candidate must
+                also be more frequent than the file that would be evicted
+    """
+
+    def __init__(self, mode=DEFAULT_MODE, min_hits=DEFAULT_MIN_HITS, window=DEFAULT_WINDOW,
+                 width=DEFAULT_SKETCH_WIDTH):
+        self.mode = mode
+        self.min_hits = max(1, int(min_hits))
+        self.window = window
+        self.sample_size = 10 * max(64, int(width))
+        self._sketch = CountMinSketch(width)
+        self._doorkeeper = Doorkeeper(8 * max(64, int(width)))
+        self._lock = threading.Lock()
+        self._recorded = 0
+        self._last_reset = time.monotonic()
+        self._stats = {'recorded': 0, 'admitted': 0, 'rejected_cold': 0, 'rejected_victim': 0, 'resets': 0}
+
+    def _age_if_due(self):
+        now = time.monotonic()
+        if self._recorded >= self.sample_size or (self.window and now - self._last_reset >= self.window):
+            self._sketch.halve()
+            self._doorkeeper.clear()
+            self._recorded = 0
+            self._last_reset = now
+            self._stats['resets'] += 1
+
+    def record(self, key):
+        with self._lock:
+            self._age_if_due()
+            if self._doorkeeper.add(key):
+                self._sketch.add(key)
+            self._recorded += 1
+            self._stats['recorded'] += 1
+
+    def _estimate(self, key):
+        return self._sketch.estimate(key) + (1 if self._doorkeeper.contains(key) else 0)
+
+    def estimate(self, key):
+        with self._lock:
+            return self._estimate(key)
+
+    def should_admit(self, key, victim_key=None):
+        """Admit key into the cache? victim_key is the file eviction would remove, if the cache is full."""
+        with self._lock:
+            if self.mode == 'always':
+                self._stats['admitted'] += 1
+                return True
+            frequency = self._estimate(key)
+            if frequency < self.min_hits:
+                self._stats['rejected_cold'] += 1
+                return False
+            if self.mode == 'tinylfu' and victim_key is not None and frequency <= self._estimate(victim_key):
+                self._stats['rejected_victim'] += 1
+                return False
+            self._stats['admitted'] += 1
+            return True
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._stats)
+        decided = metrics['admitted'] + metrics['rejected_cold'] + metrics['rejected_victim']
+        metrics.update({
+            'mode': self.mode,
+            'min_hits': self.min_hits,
+            'admit_ratio': metrics['admitted'] / decided if decided else 0.0,
+        })
+        return metrics
+
+
+def create_admission_filter(config):
+    """Admission filter configured by cache_admission_* in the config."""
+    mode = str(config.get('cache_admission', DEFAULT_MODE)).lower()
+    if mode not in MODES:
+        print(f"[ERROR] Unknown cache_admission '{mode}', using {DEFAULT_MODE}")
+        mode = DEFAULT_MODE
+    return AdmissionFilter(
+        mode,
+        config.get('cache_admission_min_hits', DEFAULT_MIN_HITS),
+        config.get('cache_admission_window', DEFAULT_WINDOW),
+        config.get('cache_admission_sketch_width', DEFAULT_SKETCH_WIDTH),
+    )
@@ -0,0 +1,209 @@
+import threading
+import time
+
+DEFAULT_POLICY = 'gdsf'
+DEFAULT_HIGH_WATERMARK = 0.95
+DEFAULT_LOW_WATERMARK = 0.85
+DEFAULT_JANITOR_INTERVAL = 60
+DEFAULT_LFU_HALF_LIFE = 24 * 3600
+
+# How many eviction candidates are fetched from the index per query
+EVICTION_BATCH = 64
+
+
+class EvictionPolicy:
+    """Which cache files go first when the cache is over its size limit.
+
+    order names one of the orders CacheIndex.eviction_candidates supports.
+    maintain() runs on every janitor pass, on_evict() after each removed file.
+    """
+
+    name = None
+    order = 'hits'
+
+    def maintain(self, index, now):
+        pass
+
+    def on_evict(self, index, entry):
+        pass
+
+
+class LRUPolicy(EvictionPolicy):
+    """Least recently accessed first. The limits are in bytes, so big files free more per eviction."""
+
+    name = 'lru'
+    order = 'last_access'
+
+
+class LFUPolicy(EvictionPolicy):
+    """Fewest hits first (ties by last access); hit counts are halved every half_life seconds.
+
+    Without aging a file that was popular once would never leave the cache.
+    """
+
+    name = 'lfu'
+    order = 'hits'
+
+    def __init__(self, half_life=DEFAULT_LFU_HALF_LIFE):
+        self.half_life = half_life
+        self._last_decay = None
+
+    def maintain(self, index, now):
+        if self._last_decay is None:
+            self._last_decay = index.get_meta('lfu_last_decay', now)
+        if self.half_life and now - self._last_decay >= self.half_life:
+            index.decay_hits()
+            self._last_decay = now
+            index.set_meta('lfu_last_decay', now)
+
+
+class GDSFPolicy(EvictionPolicy):
+    """Greedy-Dual-Size-Frequency: lowest clock + hits / size first.
+
+    Small popular files are kept over large rarely watched ones. Evicting a
+    file raises the clock to its priority, so files that are not hit again
+    fall behind newly accessed ones over time (aging without a decay pass).
+    """
+
+    name = 'gdsf'
+    order = 'priority'
+
+    def on_evict(self, index, entry):
+        index.advance_clock(entry['priority'])
+
+
+POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    'gdsf': GDSFPolicy,
+}
+
+
+def create_policy(config):
+    """Eviction policy named by cache_eviction_policy in the config."""
+    name = str(config.get('cache_eviction_policy', DEFAULT_POLICY)).lower()
+    if name not in POLICIES:
+        print(f"[ERROR] Unknown cache_eviction_policy '{name}', using {DEFAULT_POLICY}")
+        name = DEFAULT_POLICY
+    if name == 'lfu':
+        return LFUPolicy(config.get('cache_lfu_half_life', DEFAULT_LFU_HALF_LIFE))
+    return POLICIES[name]()
+
+
+class CacheJanitor:
+    """Background thread that keeps the cache within its size limits.
+
+    When the cache (or one quality tier with its own cap) goes above
+    high_watermark of its limit, files are evicted in policy order until it
+    is at or below low_watermark. The thread wakes up every interval seconds
+    and whenever wake() is called (after a cache file is committed).
+
+    remove(path) deletes a cache file with its index row; is_busy(path)
+    tells whether a file must not be evicted right now.
+    """
+
+    def __init__(self, index, policy, max_bytes, quality_caps=None, remove=None, is_busy=None,
+                 high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK,
+                 interval=DEFAULT_JANITOR_INTERVAL):
+        self.index = index
+        self.policy = policy
+        self.max_bytes = int(max_bytes)
+        self.quality_caps = dict(quality_caps or {})
+        self.remove = remove
+        self.is_busy = is_busy or (lambda path: False)
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.interval = interval
+        self._wake = threading.Event()
+        self._run_lock = threading.Lock()
+        self._thread = None
+        self._stats = {'runs': 0, 'evicted_files': 0, 'evicted_bytes': 0, 'last_run': None}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name='cache-janitor')
+            self._thread.start()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"[ERROR] Cache janitor pass failed: {e}")
+
+    def run_once(self):
+        """One pass: policy maintenance, then per-quality caps, then the overall limit."""
+        with self._run_lock:
+            self.policy.maintain(self.index, time.time())
+            for quality, cap in self.quality_caps.items():
+                self._enforce(self.index.quality_size(quality), cap, quality)
+            self._enforce(self.index.total_size(), self.max_bytes)
+            self._stats['runs'] += 1
+            self._stats['last_run'] = time.time()
+
+    def _enforce(self, current, limit, quality=None):
+        if current > limit * self.high_watermark:
+            self.evict_to(int(limit * self.low_watermark), quality)
+
+    def evict_to(self, target_bytes, quality=None):
+        """Evict files in policy order until the cache (or one quality) is at most target_bytes."""
+        size_of = (lambda: self.index.quality_size(quality)) if quality is not None else self.index.total_size
+        current = size_of()
+        start_size = current
+        evicted = 0
+        while current > target_bytes:
+            candidates = self.index.eviction_candidates(self.policy.order, EVICTION_BATCH, quality)
+            removed_in_batch = 0
+            for entry in candidates:
+                if current <= target_bytes:
+                    break
+                if self.is_busy(entry['path']):
+                    continue
+                self.remove(entry['path'])
+                self.policy.on_evict(self.index, entry)
+                current -= entry['size']
+                evicted += 1
+                removed_in_batch += 1
+                print(f"Evicted cached video file: {entry['path']} ({entry['size']} bytes, "
+                      f"{entry['hits']} hits, {self.policy.name})")
+            if not removed_in_batch:
+                break
+            current = size_of()
+        freed = start_size - current
+        if evicted:
+            self._stats['evicted_files'] += evicted
+            self._stats['evicted_bytes'] += freed
+            tier = f" (quality {quality or 'default'})" if quality is not None else ''
+            print(f"Cache cleanup completed{tier}. Deleted {evicted} files, freed {freed} bytes.")
+        return evicted
+
+    def victim(self):
+        """The file the next eviction would remove, or None while the cache has room.
+
+        In steady state the cache sits between the low and high watermarks,
+        so above the low watermark every new file displaces an existing one.
+        """
+        if self.index.total_size() <= self.max_bytes * self.low_watermark:
+            return None
+        candidates = self.index.eviction_candidates(self.policy.order, 1)
+        return candidates[0] if candidates else None
+
+    def metrics(self):
+        metrics = dict(self._stats)
+        metrics.update({
+            'policy': self.policy.name,
+            'max_bytes': self.max_bytes,
+            'high_watermark': self.high_watermark,
+            'low_watermark': self.low_watermark,
+            'quality_caps': self.quality_caps,
+        })
+        return metrics
@@ -0,0 +1,314 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Schema versions are applied in order and recorded in PRAGMA user_version
+SCHEMA_V1 = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    video_id TEXT NOT NULL,
+    quality TEXT,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_by_popularity ON entries (hits, last_access);
+CREATE INDEX IF NOT EXISTS entries_by_last_access ON entries (last_access);
+CREATE INDEX IF NOT EXISTS entries_by_video ON entries (video_id);
+
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    size INTEGER NOT NULL,
+    count INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals (id, size, count) VALUES (1, 0, 0);
+
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE totals SET size = size + NEW.size, count = count + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE totals SET size = size - OLD.size, count = count - 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_resize AFTER UPDATE OF size ON entries BEGIN
+    UPDATE totals SET size = size - OLD.size + NEW.size WHERE id = 1;
+END;
+"""
+
+# v2: per-quality totals for tier caps, GDSF priority, key/value state (GDSF clock)
+SCHEMA_V2 = """
+ALTER TABLE entries ADD COLUMN priority REAL NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS entries_by_priority ON entries (priority, last_access);
+
+CREATE TABLE IF NOT EXISTS quality_totals (
+    quality TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    count INTEGER NOT NULL
+);
+INSERT OR REPLACE INTO quality_totals (quality, size, count)
+    SELECT COALESCE(quality, ''), SUM(size), COUNT(*) FROM entries GROUP BY COALESCE(quality, '');
+
+CREATE TRIGGER IF NOT EXISTS entries_insert_quality AFTER INSERT ON entries BEGIN
+    INSERT OR IGNORE INTO quality_totals (quality, size, count) VALUES (COALESCE(NEW.quality, ''), 0, 0);
+    UPDATE quality_totals SET size = size + NEW.size, count = count + 1 WHERE quality = COALESCE(NEW.quality, '');
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete_quality AFTER DELETE ON entries BEGIN
+    UPDATE quality_totals SET size = size - OLD.size, count = count - 1 WHERE quality = COALESCE(OLD.quality, '');
+END;
+CREATE TRIGGER IF NOT EXISTS entries_update_quality AFTER UPDATE OF size, quality ON entries BEGIN
+    UPDATE quality_totals SET size = size - OLD.size, count = count - 1 WHERE quality = COALESCE(OLD.quality, '');
+    INSERT OR IGNORE INTO quality_totals (quality, size, count) VALUES (COALESCE(NEW.quality, ''), 0, 0);
+    UPDATE quality_totals SET size = size + NEW.size, count = count + 1 WHERE quality = COALESCE(NEW.quality, '');
+END;
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+SCHEMA_VERSIONS = [SCHEMA_V1, SCHEMA_V2]
+
+# GDSF priority = clock + frequency * cost / size; cost is 1 and size is in MiB
+GDSF_SIZE_UNIT = 1048576.0
+
+ENTRY_COLUMNS = 'path, video_id, quality, size, created_at, last_access, hits, priority'
+
+# Eviction orders a policy may ask for (column lists are never taken from the caller)
+EVICTION_ORDERS = {
+    'last_access': 'last_access',
+    'hits': 'hits, last_access',
+    'priority': 'priority, last_access',
+}
+
+
+class CacheIndex:
+    """Persistent index of the finished files in the video cache.
+
+    One row per cache file (path relative to root) with its size, video id,
+    quality, last access time and hit count. The total size and file count
+    are kept up to date by triggers, overall and per quality, so reading
+    them is a single-row lookup, and eviction candidates come from an index
+    instead of a directory scan.
+
+    priority is the Greedy-Dual-Size-Frequency value of a file, kept current
+    on every hit against the clock set by the GDSF eviction policy.
+
+    SQLite runs in WAL mode with synchronous=NORMAL: a hit is one small
+    UPDATE, and a crash can lose at most the last few hits, never corrupt
+    the index. A single connection is shared behind a lock.
+    """
+
+    def __init__(self, db_path, root):
+        self.db_path = db_path
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._migrate()
+        self._clock = self.get_meta('gdsf_clock', 0.0)
+
+    def _migrate(self):
+        version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, script in enumerate(SCHEMA_VERSIONS, 1):
+            if version < number:
+                # One transaction per step, so a crash never leaves a half-applied schema
+                self._conn.executescript(f'BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;')
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    @property
+    def clock(self):
+        return self._clock
+
+    def advance_clock(self, value):
+        """Raise the GDSF clock (L) to value; it never goes down."""
+        if value > self._clock:
+            self._clock = value
+            self.set_meta('gdsf_clock', value)
+
+    def _key(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def add(self, path, video_id, quality, size, hits=0, last_access=None):
+        """Register a finished cache file, replacing an older row for the same path."""
+        now = time.time()
+        key = self._key(path)
+        last_access = last_access or now
+        priority = self._priority(hits, size)
+        with self._lock:
+            # DELETE + INSERT rather than an upsert: the ON CONFLICT clause of an
+            # upsert overrides the INSERT OR IGNORE in the quality totals trigger.
+            # A re-added file keeps its hit count and last access time.
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT hits, last_access FROM entries WHERE path = ?', (key,)).fetchone()
+                if row is not None:
+                    hits, last_access = row
+                    self._conn.execute('DELETE FROM entries WHERE path = ?', (key,))
+                self._conn.execute(
+                    'INSERT INTO entries (path, video_id, quality, size, created_at, last_access, hits, priority) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (key, video_id, quality, int(size), now, last_access, int(hits), priority)
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def _priority(self, hits, size):
+        return self._clock + (int(hits) + 1) * GDSF_SIZE_UNIT / max(int(size), 1)
+
+    def remove(self, path):
+        with self._lock:
+            self._conn.execute('DELETE FROM entries WHERE path = ?', (self._key(path),))
+
+    def record_hit(self, path):
+        """Count a hit on a cache file. Returns False if the file is not indexed."""
+        with self._lock:
+            cursor = self._conn.execute(
+                'UPDATE entries SET hits = hits + 1, last_access = ?, '
+                'priority = ? + (hits + 2) * ? / MAX(size, 1) WHERE path = ?',
+                (time.time(), self._clock, GDSF_SIZE_UNIT, self._key(path))
+            )
+        return cursor.rowcount > 0
+
+    def get(self, path):
+        """Row for a cache file as a dict, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                f'SELECT {ENTRY_COLUMNS} FROM entries WHERE path = ?',
+                (self._key(path),)
+            ).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def entries_for_video(self, video_id):
+        """All cached files of one video (every quality)."""
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT {ENTRY_COLUMNS} FROM entries WHERE video_id = ?', (video_id,)
+            ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def sizes(self):
+        """path -> size of every indexed file."""
+        with self._lock:
+            rows = self._conn.execute('SELECT path, size FROM entries').fetchall()
+        return {self._path(key): size for key, size in rows}
+
+    def total_size(self):
+        with self._lock:
+            return self._conn.execute('SELECT size FROM totals WHERE id = 1').fetchone()[0]
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute('SELECT count FROM totals WHERE id = 1').fetchone()[0]
+
+    def quality_sizes(self):
+        """quality -> (total size, file count); files without a quality are under ''."""
+        with self._lock:
+            rows = self._conn.execute('SELECT quality, size, count FROM quality_totals WHERE count > 0').fetchall()
+        return {quality: (size, count) for quality, size, count in rows}
+
+    def quality_size(self, quality):
+        with self._lock:
+            row = self._conn.execute('SELECT size FROM quality_totals WHERE quality = ?', (quality or '',)).fetchone()
+        return row[0] if row else 0
+
+    def eviction_candidates(self, order='hits', limit=64, quality=None):
+        """Files to evict first under the given order (see EVICTION_ORDERS).
+
+        With quality, only files of that quality ('' for files without one).
+        """
+        order_by = EVICTION_ORDERS[order]
+        query = f'SELECT {ENTRY_COLUMNS} FROM entries'
+        params = []
+        if quality is not None:
+            query += " WHERE COALESCE(quality, '') = ?"
+            params.append(quality)
+        query += f' ORDER BY {order_by} LIMIT ?'
+        params.append(int(limit))
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def decay_hits(self, factor=2):
+        """LFU aging: divide every hit count so old popularity fades."""
+        with self._lock:
+            self._conn.execute('UPDATE entries SET hits = hits / ? WHERE hits > 0', (int(factor),))
+
+    def _row_to_dict(self, row):
+        return {
+            'path': self._path(row[0]),
+            'video_id': row[1],
+            'quality': row[2],
+            'size': row[3],
+            'created_at': row[4],
+            'last_access': row[5],
+            'hits': row[6],
+            'priority': row[7],
+        }
+
+    def reconcile(self, files, describe, views=None):
+        """Bring the index in line with the files actually on disk.
+
+        files maps path -> (size, mtime). Rows for missing files are dropped.
+        describe(path) -> (video_id, quality) is called only for files without
+        a row, which are then added; files it returns None for are skipped.
+        Their hit count and last access come from views
+        (video_id -> {'views', 'last_accessed'}) when given. Returns (added, removed).
+        """
+        views = views or {}
+        on_disk = {self._key(path): (path, size, mtime) for path, (size, mtime) in files.items()}
+        with self._lock:
+            indexed = {key: size for key, size in self._conn.execute('SELECT path, size FROM entries')}
+        stale = [(key,) for key in indexed if key not in on_disk]
+        now = time.time()
+        fresh = []
+        resized = []
+        for key, (path, size, mtime) in on_disk.items():
+            if key in indexed:
+                if indexed[key] != size:
+                    resized.append((size, key))
+                continue
+            described = describe(path)
+            if described is None:
+                continue
+            video_id, quality = described
+            view = views.get(video_id, {})
+            hits = view.get('views', 0)
+            fresh.append((key, video_id, quality, size, mtime,
+                          view.get('last_accessed', mtime), hits, self._priority(hits, size)))
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany('DELETE FROM entries WHERE path = ?', stale)
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO entries (path, video_id, quality, size, created_at, last_access, hits, '
+                    'priority) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', fresh
+                )
+                self._conn.executemany('UPDATE entries SET size = ? WHERE path = ?', resized)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        if fresh or stale:
+            print(f"Cache index reconciled in {time.time() - now:.2f}s: {len(fresh)} added, {len(stale)} removed")
+        return len(fresh), len(stale)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,68 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+DEFAULT_WORKERS = 32
+# Сколько секунд маршрут ждёт все запросы к апстриму вместе
+DEFAULT_DEADLINE = 10
+
+_workers = DEFAULT_WORKERS
+_deadline = DEFAULT_DEADLINE
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def configure(config):
+    """Читает fanout_workers и video_info_deadline из config.json."""
+    global _workers, _deadline, _executor
+    try:
+        _workers = max(1, int(config.get('fanout_workers', DEFAULT_WORKERS)))
+        _deadline = max(0.5, float(config.get('video_info_deadline', DEFAULT_DEADLINE)))
+    except (TypeError, ValueError):
+        _workers, _deadline = DEFAULT_WORKERS, DEFAULT_DEADLINE
+    with _executor_lock:
+        old, _executor = _executor, None
+    if old is not None:
+        old.shutdown(wait=False)
+    print(f"[DEBUG] Upstream fan-out: {_workers} workers, {_deadline}s deadline")
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_workers, thread_name_prefix='fanout')
+        return _executor
+
+
+def submit(fn, *args, **kwargs):
+    """Запускает fn(*args, **kwargs) в общем пуле потоков; возвращает Future."""
+    return _get_executor().submit(fn, *args, **kwargs)
+
+
+class Deadline:
+    """Общий срок для нескольких параллельных запросов одного ответа клиенту."""
+
+    __slots__ = ('expires_at',)
+
+    def __init__(self, seconds=None):
+        self.expires_at = time.monotonic() + (seconds if seconds is not None else _deadline)
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+def wait(future, deadline=None, default=None, name='task'):
+    """Результат future, если он готов до срока deadline; иначе (или при ошибке) - default.
+
+    Без deadline ждёт сколько нужно, но ошибку тоже заменяет на default.
+    Опоздавшая задача не прерывается: она доработает в фоне и заполнит
+    кэши (ответов API, миниатюр каналов) для следующих запросов.
+    """
+    try:
+        return future.result(timeout=deadline.remaining() if deadline is not None else None)
+    except FutureTimeoutError:
+        print(f"[DEBUG] Fan-out: {name} missed the deadline, responding without it")
+    except Exception as e:
+        print(f"[ERROR] Fan-out: {name} failed: {e}")
+    return default
@@ -0,0 +1,267 @@
+import os
+import uuid
+import zlib
+
+from flask import request, send_file, Response
+
+from .video_cache import CACHE_DIR
+from .hot_cache import get_hot_tier
+
+# Режимы отдачи готовых файлов кэша (cache_serve_mode в config.json):
+#   sendfile         - flask.send_file: wsgi.file_wrapper, сервер может отдать файл через sendfile()
+#   x-accel-redirect - пустой ответ с X-Accel-Redirect, файл отдаёт nginx (location internal)
+#   x-sendfile       - заголовок X-Sendfile для Apache/lighttpd (USE_X_SENDFILE во Flask)
+SERVE_MODES = ('sendfile', 'x-accel-redirect', 'x-sendfile')
+DEFAULT_SERVE_MODE = 'sendfile'
+DEFAULT_ACCEL_PREFIX = '/cache/'
+
+# Больше частей в multipart/byteranges не отдаём - защита от запросов из тысяч мелких диапазонов;
+# на такой Range отвечаем 200 с файлом целиком (RFC 9110, 14.2)
+MAX_RANGES = 16
+READ_CHUNK_SIZE = 65536
+
+_serve_mode = DEFAULT_SERVE_MODE
+_accel_prefix = DEFAULT_ACCEL_PREFIX
+
+
+def configure(config):
+    """Читает cache_serve_mode и cache_accel_prefix из конфигурации."""
+    global _serve_mode, _accel_prefix
+    mode = str(config.get('cache_serve_mode', DEFAULT_SERVE_MODE)).lower()
+    if mode not in SERVE_MODES:
+        print(f"[ERROR] Unknown cache_serve_mode '{mode}', using {DEFAULT_SERVE_MODE}")
+        mode = DEFAULT_SERVE_MODE
+    _serve_mode = mode
+    prefix = config.get('cache_accel_prefix', DEFAULT_ACCEL_PREFIX)
+    _accel_prefix = prefix if prefix.endswith('/') else prefix + '/'
+    print(f"[DEBUG] Cached files are served via {_serve_mode}")
+    return _serve_mode
+
+
+def uses_x_sendfile():
+    """Нужно ли включить USE_X_SENDFILE в конфигурации приложения Flask."""
+    return _serve_mode == 'x-sendfile'
+
+
+def _file_etag(path, stat):
+    # Файлы кэша только создаются и заменяются целиком (os.replace), поэтому
+    # пути, времени изменения и размера достаточно, чтобы отличить версии
+    key = f"{path}-{stat.st_mtime}-{stat.st_size}".encode('utf-8')
+    return f"{stat.st_mtime}-{stat.st_size}-{zlib.adler32(key)}"
+
+
+def _if_range_matches(etag, mtime):
+    """Проверяет If-Range: диапазоны отдаются, только если файл не изменился."""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return int(if_range.date.timestamp()) == int(mtime)
+    return True
+
+
+def _parse_byte_ranges(header):
+    """Разбирает Range: bytes=a-b,c-,-n в список (start, stop); для суффикса (-n, None).
+
+    В отличие от werkzeug.http.parse_range_header допускает пересекающиеся
+    и неупорядоченные диапазоны. None, если заголовок некорректен.
+    """
+    if not header:
+        return None
+    units, _, spec = header.partition('=')
+    if units.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for item in spec.split(','):
+        begin, sep, end = item.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if not begin:
+                suffix = int(end)
+                if suffix <= 0:
+                    return None
+                ranges.append((-suffix, None))
+                continue
+            start = int(begin)
+            stop = int(end) + 1 if end else None
+        except ValueError:
+            return None
+        if start < 0 or (stop is not None and stop <= start):
+            return None
+        ranges.append((start, stop))
+    return ranges or None
+
+
+def _resolve_ranges(ranges, length):
+    """Переводит диапазоны из Range в [start, stop), отбрасывает невыполнимые и сливает пересекающиеся."""
+    resolved = []
+    for start, stop in ranges:
+        if start < 0:
+            # Суффикс: последние -start байт
+            start, stop = max(0, length + start), length
+        else:
+            stop = length if stop is None else min(stop, length)
+        if start < stop:
+            resolved.append([start, stop])
+    resolved.sort()
+    merged = []
+    for start, stop in resolved:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+def _iter_file_ranges(path, ranges, parts=None):
+    """Читает диапазоны файла через pread; parts - заголовки частей multipart перед каждым диапазоном."""
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        for i, (start, stop) in enumerate(ranges):
+            if parts is not None:
+                yield parts[i]
+            offset = start
+            while offset < stop:
+                chunk = os.pread(fd, min(READ_CHUNK_SIZE, stop - offset), offset)
+                if not chunk:
+                    return
+                offset += len(chunk)
+                yield chunk
+            if parts is not None:
+                yield b'\r\n'
+        if parts is not None:
+            yield parts[-1]
+    finally:
+        os.close(fd)
+
+
+def _multi_range_response(path, ranges, length, mimetype, etag):
+    """206 для нескольких диапазонов: multipart/byteranges, либо одна часть, если диапазоны слились."""
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response = Response(_iter_file_ranges(path, ranges), 206, mimetype=mimetype)
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+        response.headers['Content-Length'] = str(stop - start)
+    else:
+        boundary = uuid.uuid4().hex
+        parts = [
+            (f'--{boundary}\r\nContent-Type: {mimetype}\r\n'
+             f'Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n').encode('ascii')
+            for start, stop in ranges
+        ]
+        parts.append(f'--{boundary}--\r\n'.encode('ascii'))
+        body_length = sum(len(part) for part in parts) + sum(stop - start + 2 for start, stop in ranges)
+        response = Response(_iter_file_ranges(path, ranges, parts), 206,
+                            content_type=f'multipart/byteranges; boundary={boundary}')
+        response.headers['Content-Length'] = str(body_length)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(etag)
+    return response
+
+
+def _hot_tier_response(path, stat, etag, requested, mimetype):
+    """Ответ из памяти, если запрошенные байты целиком лежат в горячем префиксе файла.
+
+    Подходит для запуска плеера: Range внутри первых мегабайт (ftyp/moov,
+    первые фрагменты) или целый файл, если он меньше префикса. Иначе None.
+    Условные запросы (If-None-Match, If-Modified-Since) остаются send_file.
+    """
+    if request.if_none_match or request.if_modified_since:
+        return None
+    if requested is not None and (len(requested) != 1 or not _if_range_matches(etag, stat.st_mtime)):
+        return None
+    prefix = get_hot_tier().get_prefix(path, stat)
+    if prefix is None:
+        return None
+
+    if requested is None:
+        if len(prefix) != stat.st_size:
+            return None
+        response = Response(prefix, 200, mimetype=mimetype)
+    else:
+        ranges = _resolve_ranges(requested, stat.st_size)
+        if not ranges or ranges[0][1] > len(prefix):
+            return None
+        start, stop = ranges[0]
+        response = Response(prefix[start:stop], 206, mimetype=mimetype)
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{stat.st_size}'
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(etag)
+    response.last_modified = stat.st_mtime
+    get_hot_tier().record_served(response.content_length or 0)
+    return response
+
+
+def _accel_redirect_response(path, mimetype, download_name):
+    """Пустой ответ, по которому nginx сам отдаёт файл (с Range и условными запросами)."""
+    relative = os.path.relpath(path, CACHE_DIR).replace(os.sep, '/')
+    response = Response(None, mimetype=mimetype)
+    response.headers['X-Accel-Redirect'] = _accel_prefix + relative
+    if download_name:
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    return response
+
+
+def send_cached_file(path, mimetype='video/mp4', download_name=None):
+    """Отдаёт готовый файл кэша, не пропуская его содержимое через Python.
+
+    Одиночный Range, If-Range, ETag/If-None-Match и HEAD обрабатывает
+    send_file (conditional=True), тело отдаётся через wsgi.file_wrapper.
+    Диапазоны внутри горячего префикса популярных файлов отдаются из памяти.
+    Несколько диапазонов в одном Range отдаются как multipart/byteranges,
+    больше MAX_RANGES - весь файл ответом 200.
+    В режимах x-accel-redirect и x-sendfile файл отдаёт фронтенд-сервер.
+    С download_name файл отдаётся как вложение.
+    """
+    if _serve_mode == 'x-accel-redirect':
+        return _accel_redirect_response(path, mimetype, download_name)
+
+    stat = os.stat(path)
+    etag = _file_etag(path, stat)
+
+    requested = _parse_byte_ranges(request.headers.get('Range'))
+    if _serve_mode == 'sendfile' and request.method == 'GET':
+        response = _hot_tier_response(path, stat, etag, requested, mimetype)
+        if response is not None:
+            if download_name:
+                response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+            return response
+
+    if requested and len(requested) > MAX_RANGES:
+        # Без conditional send_file не разбирает Range; ETag и 304 - через make_conditional
+        response = send_file(
+            path,
+            mimetype=mimetype,
+            as_attachment=download_name is not None,
+            download_name=download_name,
+            conditional=False,
+            etag=etag,
+            last_modified=stat.st_mtime,
+            max_age=None,
+        )
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response.make_conditional(request.environ, accept_ranges=False, complete_length=stat.st_size)
+
+    if (_serve_mode == 'sendfile' and request.method == 'GET' and requested and len(requested) > 1
+            and _if_range_matches(etag, stat.st_mtime)):
+        ranges = _resolve_ranges(requested, stat.st_size)
+        if not ranges:
+            response = Response(None, 416)
+            response.headers['Content-Range'] = f'bytes */{stat.st_size}'
+            return response
+        response = _multi_range_response(path, ranges, stat.st_size, mimetype, etag)
+        if download_name:
+            response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        return response
+
+    return send_file(
+        path,
+        mimetype=mimetype,
+        as_attachment=download_name is not None,
+        download_name=download_name,
+        conditional=True,
+        etag=etag,
+        last_modified=stat.st_mtime,
+        max_age=None,
+    )
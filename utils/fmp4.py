@@ -0,0 +1,230 @@
+import os
+import struct
+import threading
+
+# Boxes that are buffered whole and parsed; everything else (mdat) is skipped
+_PARSED_BOXES = (b'moov', b'moof')
+_CONTAINER_BOXES = (b'moov', b'trak', b'mdia', b'moof', b'traf')
+
+
+def _iter_boxes(data, start, end):
+    """Yield (type, payload_start, box_end) for the child boxes in data[start:end]."""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def _find_child(data, start, end, box_type):
+    for child_type, payload, child_end in _iter_boxes(data, start, end):
+        if child_type == box_type:
+            return payload, child_end
+    return None, None
+
+
+class FragmentIndex:
+    """Incremental index of a fragmented MP4 stream (ffmpeg -movflags frag_keyframe).
+
+    Fed with the bytes of the stream as they are produced, it records where
+    the initialization segment (ftyp + moov) ends and, for every moof, its
+    byte offset and start time in seconds. With frag_keyframe every fragment
+    starts on a keyframe, so a fragment offset is a valid seek point.
+    """
+
+    def __init__(self):
+        self.init_end = None
+        self.fragments = []  # [(offset, seconds)]
+        self._timescales = {}  # track_ID -> timescale
+        self.codecs = []  # sample entry types from stsd, e.g. ['avc1', 'mp4a']
+        self._video_track = None
+        self._lock = threading.Lock()
+        self._buffer = b''
+        self._buffer_offset = 0  # absolute offset of self._buffer[0]
+        self._skip = 0
+        self._broken = False
+
+    def feed(self, chunk):
+        """Consume the next chunk of the stream."""
+        if self._broken:
+            return
+        data = self._buffer + chunk if self._buffer else chunk
+        offset = self._buffer_offset
+        pos = 0
+        try:
+            while True:
+                if self._skip:
+                    step = min(self._skip, len(data) - pos)
+                    pos += step
+                    self._skip -= step
+                    if self._skip:
+                        break
+                if len(data) - pos < 8:
+                    break
+                size, box_type = struct.unpack_from('>I4s', data, pos)
+                header = 8
+                if size == 1:
+                    if len(data) - pos < 16:
+                        break
+                    size = struct.unpack_from('>Q', data, pos + 8)[0]
+                    header = 16
+                elif size == 0:
+                    # Box runs to the end of the stream, nothing more to index
+                    self._broken = True
+                    break
+                if size < header:
+                    self._broken = True
+                    break
+                if box_type in _PARSED_BOXES:
+                    if len(data) - pos < size:
+                        break
+                    self._parse_box(box_type, data, pos + header, pos + size, offset + pos)
+                    pos += size
+                else:
+                    pos += header
+                    self._skip = size - header
+        except struct.error:
+            self._broken = True
+        self._buffer_offset = offset + pos
+        self._buffer = data[pos:]
+
+    def feed_file(self, fd, end, chunk_size=4096):
+        """Consume the stream from a file up to offset end, reading only box headers, moov and moof."""
+        while not self._broken:
+            if self._skip:
+                # Nothing is buffered while skipping a box payload
+                step = min(self._skip, end - self._buffer_offset)
+                self._buffer_offset += step
+                self._skip -= step
+                if self._skip:
+                    return
+            pos = self._buffer_offset + len(self._buffer)
+            if pos >= end:
+                return
+            chunk = os.pread(fd, min(chunk_size, end - pos), pos)
+            if not chunk:
+                return
+            self.feed(chunk)
+
+    def _parse_box(self, box_type, data, payload, end, absolute_offset):
+        if box_type == b'moov':
+            self._parse_moov(data, payload, end)
+            return
+        with self._lock:
+            if self.init_end is None:
+                self.init_end = absolute_offset
+        seconds = self._parse_moof(data, payload, end)
+        if seconds is not None:
+            with self._lock:
+                self.fragments.append((absolute_offset, seconds))
+
+    def _parse_moov(self, data, payload, end):
+        for box_type, trak_payload, trak_end in _iter_boxes(data, payload, end):
+            if box_type != b'trak':
+                continue
+            track_id = None
+            tkhd, tkhd_end = _find_child(data, trak_payload, trak_end, b'tkhd')
+            if tkhd is not None:
+                version = data[tkhd]
+                track_id = struct.unpack_from('>I', data, tkhd + (20 if version == 1 else 12))[0]
+            mdia, mdia_end = _find_child(data, trak_payload, trak_end, b'mdia')
+            if mdia is None or track_id is None:
+                continue
+            mdhd, _ = _find_child(data, mdia, mdia_end, b'mdhd')
+            if mdhd is not None:
+                version = data[mdhd]
+                self._timescales[track_id] = struct.unpack_from('>I', data, mdhd + (20 if version == 1 else 12))[0]
+            hdlr, _ = _find_child(data, mdia, mdia_end, b'hdlr')
+            if hdlr is not None and data[hdlr + 8:hdlr + 12] == b'vide' and self._video_track is None:
+                self._video_track = track_id
+            codec = self._parse_codec(data, mdia, mdia_end)
+            if codec:
+                self.codecs.append(codec)
+
+    def _parse_codec(self, data, mdia, mdia_end):
+        """Type of the first sample entry in mdia/minf/stbl/stsd (avc1, vp09, av01, mp4a, Opus...)."""
+        minf, minf_end = _find_child(data, mdia, mdia_end, b'minf')
+        if minf is None:
+            return None
+        stbl, stbl_end = _find_child(data, minf, minf_end, b'stbl')
+        if stbl is None:
+            return None
+        stsd, stsd_end = _find_child(data, stbl, stbl_end, b'stsd')
+        if stsd is None or stsd + 16 > stsd_end:
+            return None
+        return data[stsd + 12:stsd + 16].decode('ascii', 'replace')
+
+    def _parse_moof(self, data, payload, end):
+        first = None
+        for box_type, traf, traf_end in _iter_boxes(data, payload, end):
+            if box_type != b'traf':
+                continue
+            tfhd, _ = _find_child(data, traf, traf_end, b'tfhd')
+            tfdt, _ = _find_child(data, traf, traf_end, b'tfdt')
+            if tfhd is None or tfdt is None:
+                continue
+            track_id = struct.unpack_from('>I', data, tfhd + 4)[0]
+            timescale = self._timescales.get(track_id)
+            if not timescale:
+                continue
+            version = data[tfdt]
+            if version == 1:
+                decode_time = struct.unpack_from('>Q', data, tfdt + 4)[0]
+            else:
+                decode_time = struct.unpack_from('>I', data, tfdt + 4)[0]
+            seconds = decode_time / timescale
+            if track_id == self._video_track:
+                return seconds
+            if first is None:
+                first = seconds
+        return first
+
+    def fragment_for_time(self, seconds):
+        """Return (offset, start_seconds) of the last fragment starting at or before seconds."""
+        with self._lock:
+            best = None
+            for offset, start in self.fragments:
+                if start > seconds:
+                    break
+                best = (offset, start)
+            if best is None and self.fragments:
+                best = self.fragments[0]
+            return best
+
+    @property
+    def at_box_boundary(self):
+        """True if everything fed so far ends exactly at the end of a top-level box."""
+        return not self._broken and not self._skip and not self._buffer
+
+    def last_fragment(self):
+        with self._lock:
+            return self.fragments[-1] if self.fragments else None
+
+    def estimate_time_for_offset(self, offset):
+        """Estimate the media time at a byte offset from the average bitrate so far."""
+        with self._lock:
+            if self.init_end is None or len(self.fragments) < 2:
+                return None
+            last_offset, last_time = self.fragments[-1]
+        if last_time <= 0 or last_offset <= self.init_end:
+            return None
+        bytes_per_second = (last_offset - self.init_end) / last_time
+        return max(0.0, (offset - self.init_end) / bytes_per_second)
+
+
+def index_file(path):
+    """Build a FragmentIndex for a complete file, reading only box headers, moov and moof."""
+    index = FragmentIndex()
+    with open(path, 'rb') as f:
+        index.feed_file(f.fileno(), os.fstat(f.fileno()).st_size, chunk_size=65536)
+    return index
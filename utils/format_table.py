@@ -0,0 +1,163 @@
+import re
+
+# Семейства видеокодеков по префиксу vcodec yt-dlp ('avc1.64001F', 'vp09.00.40.08', 'av01.0.08M.08')
+# и по типу sample entry в MP4 ('avc1', 'vp09', 'av01', 'hvc1')
+CODEC_FAMILIES = (
+    ('avc', 'avc1'),
+    ('h264', 'avc1'),
+    ('vp09', 'vp9'),
+    ('vp9', 'vp9'),
+    ('av01', 'av1'),
+    ('av1', 'av1'),
+    ('hev', 'hevc'),
+    ('hvc', 'hevc'),
+    ('h265', 'hevc'),
+)
+KNOWN_FAMILIES = ('avc1', 'vp9', 'av1', 'hevc')
+# Старые устройства декодируют только H.264; vp9/av1 - для клиентов, которые их объявили
+DEFAULT_CODEC_PREFERENCE = ['avc1', 'vp9', 'av1']
+DEFAULT_LANGUAGE = 'en'
+# Стандартное качество - лучший комбинированный поток не выше этой высоты
+STANDARD_MAX_HEIGHT = 480
+
+_default_preference = list(DEFAULT_CODEC_PREFERENCE)
+
+
+def codec_family(codec):
+    """'avc1' / 'vp9' / 'av1' / 'hevc' для строки кодека, None для аудио и неизвестных."""
+    if not codec or codec == 'none':
+        return None
+    codec = codec.lower()
+    for prefix, family in CODEC_FAMILIES:
+        if codec.startswith(prefix):
+            return family
+    return None
+
+
+def parse_codec_list(value):
+    """Список семейств из параметра вида 'vp9,av01,h264' (порядок сохраняется), или None."""
+    if not value:
+        return None
+    families = []
+    for item in re.split(r'[\s,;]+', str(value)):
+        family = codec_family(item)
+        if family and family not in families:
+            families.append(family)
+    return families or None
+
+
+def configure(config):
+    """Читает video_codec_preference из config.json."""
+    global _default_preference
+    _default_preference = parse_codec_list(','.join(config.get('video_codec_preference') or [])) \
+        or list(DEFAULT_CODEC_PREFERENCE)
+    print(f"[DEBUG] Video codec preference: {_default_preference}")
+
+
+def default_codec_preference():
+    return list(_default_preference)
+
+
+def _is_https(f):
+    return (f.get('protocol') or '').startswith('https') and bool(f.get('url'))
+
+
+def _language(f):
+    language = f.get('language')
+    if language:
+        return language.lower()
+    m = re.search(r'\[([A-Za-z]{2,3}(?:-[A-Za-z]+)?)\]', f.get('format') or '')
+    return m.group(1).lower() if m else ''
+
+
+class FormatTable:
+    """Форматы одного извлечения yt-dlp, разложенные за один проход.
+
+    Только форматы с прямой https-ссылкой: видео без звука по высоте,
+    аудио по языку (в каждой группе по убыванию tbr) и комбинированные по
+    убыванию (высота, tbr). Ответ на «лучшее видео высоты H в кодеке из
+    списка + лучшее аудио на языке L» - просмотр пары коротких списков.
+    """
+
+    __slots__ = ('video', 'audio', 'combined')
+
+    def __init__(self, formats):
+        self.video = {}  # height -> [format]
+        self.audio = {}  # language ('' - не указан) -> [format]
+        self.combined = []
+        for f in formats or []:
+            if not _is_https(f):
+                continue
+            has_video = f.get('vcodec') != 'none'
+            has_audio = f.get('acodec') != 'none'
+            if has_video and has_audio:
+                self.combined.append(f)
+            elif has_video:
+                self.video.setdefault(f.get('height') or 0, []).append(f)
+            elif has_audio:
+                self.audio.setdefault(_language(f), []).append(f)
+        for group in list(self.video.values()) + list(self.audio.values()):
+            group.sort(key=lambda f: f.get('tbr') or 0, reverse=True)
+        self.combined.sort(key=lambda f: (f.get('height') or 0, f.get('tbr') or 0), reverse=True)
+
+    def best_video(self, height, codecs=None):
+        """Видео без звука высоты height: первый кодек из codecs с наибольшим tbr.
+
+        codecs - кодеки, которые объявил клиент: если ни одного из них нет,
+        возвращается None (старое устройство не декодирует vp9/av1). Без
+        codecs берётся порядок по умолчанию, а при отсутствии всех его
+        кодеков - формат с наибольшим tbr.
+        """
+        candidates = self.video.get(height)
+        if not candidates:
+            return None
+        rank = {family: i for i, family in enumerate(codecs or _default_preference)}
+        if codecs:
+            candidates = [f for f in candidates if codec_family(f.get('vcodec')) in rank]
+            if not candidates:
+                return None
+        # Списки отсортированы по tbr, поэтому min по рангу - лучший tbr внутри кодека
+        return min(candidates, key=lambda f: rank.get(codec_family(f.get('vcodec')), len(rank)))
+
+    def best_audio(self, language=DEFAULT_LANGUAGE, acodec=None):
+        """Аудио с наибольшим tbr на языке language (en совпадает с en-US), иначе на любом.
+
+        acodec - префикс кодека ('mp4a'): учитываются только такие форматы.
+        """
+        tops = {}  # язык -> лучший формат группы
+        for lang, group in self.audio.items():
+            for f in group:
+                if not acodec or (f.get('acodec') or '').startswith(acodec):
+                    tops[lang] = f
+                    break
+        if language:
+            language = language.lower()
+            matching = [f for lang, f in tops.items() if lang == language or lang.split('-')[0] == language]
+            if matching:
+                return max(matching, key=lambda f: f.get('tbr') or 0)
+        return max(tops.values(), key=lambda f: f.get('tbr') or 0) if tops else None
+
+    def best_combined(self, max_height=None):
+        """Комбинированный поток с наибольшей высотой (не выше max_height), затем tbr."""
+        for f in self.combined:
+            if max_height is None or (f.get('height') or 0) <= max_height:
+                return f
+        return None
+
+    def select(self, height=None, codecs=None, language=DEFAULT_LANGUAGE):
+        """Форматы (видео, аудио) для высоты height; аудио None, если поток комбинированный.
+
+        Без height - стандартное качество (комбинированный поток до
+        STANDARD_MAX_HEIGHT, иначе лучший комбинированный). Если отдельных
+        видео и аудио нужной высоты нет, берётся комбинированный поток не выше height.
+        """
+        if height is None:
+            return self.best_combined(STANDARD_MAX_HEIGHT) or self.best_combined(), None
+        video_format = self.best_video(height, codecs)
+        audio_format = self.best_audio(language)
+        if video_format and audio_format:
+            return video_format, audio_format
+        combined = self.best_combined(height)
+        if combined:
+            return combined, None
+        return video_format, audio_format
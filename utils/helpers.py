@@ -1,20 +1,67 @@
 import os
 import subprocess
 import json
-import requests
-import re
-from urllib.parse import quote
+import time
+from urllib.parse import quote, urlencode
 from datetime import datetime
 import random
 import threading
+from . import ytdlp_pool
+from . import http_client
+from .url_store import get_url_expire, get_url_store
+from .format_table import FormatTable
+from .api_keys import NoAPIKeyError, get_key_scheduler, init_api_keys
 
-# Global counter for API key rotation
-_api_key_counter = 0
-_api_key_lock = threading.Lock()
+# Кэш результатов извлечения yt-dlp (--dump-json), ключ - (video_id, cookie_file):
+# извлечение с файлом cookies может вернуть форматы, которых нет без него.
+# Значение: {'info': dict, 'expires_at': float, 'table': FormatTable}
+_extraction_cache = {}
+_extraction_cache_lock = threading.Lock()
+
+# TTL по умолчанию, если в ссылках форматов не найден параметр expire
+EXTRACTION_CACHE_DEFAULT_TTL = 3600
+# Запас до истечения подписанных ссылок, чтобы не отдавать почти протухшие URL
+EXTRACTION_CACHE_EXPIRY_MARGIN = 300
+EXTRACTION_CACHE_MAX_ENTRIES = 2000
+
+# Извлечения, выполняющиеся прямо сейчас: (video_id, cookie_file) -> threading.Event.
+# Параллельные запросы одного видео ждут результат первого вместо запуска своего yt-dlp.
+_inflight_extractions = {}
+EXTRACTION_WAIT_TIMEOUT = 120
+
+# Кэш аватаров каналов: channel_id -> (url, expires_at)
+_channel_thumbnail_cache = {}
+_channel_thumbnail_lock = threading.Lock()
+CHANNEL_THUMBNAIL_TTL = 6 * 3600
+CHANNEL_THUMBNAIL_CACHE_MAX_ENTRIES = 20000
+# Data API принимает до 50 id в одном запросе channels?id=
+CHANNELS_PER_REQUEST = 50
+DEFAULT_CHANNEL_THUMBNAIL = 'https://yt3.ggpht.com/a/default-user=s88-c-k-c0x00ffffff-no-rj'
+
+# Движок извлечения: 'subprocess' (бинарник yt-dlp) или 'pool' (прогретые YoutubeDL в процессе)
+_ytdlp_backend = 'subprocess'
+_ytdlp_pool = None
 
 # We'll need to pass config to this function or import it
 # For now, we'll modify the function signature to accept config
 
+def init_ytdlp_backend(config):
+    """Настраивает движок извлечения yt-dlp по параметрам config.json."""
+    global _ytdlp_backend, _ytdlp_pool
+    backend = config.get('ytdlp_backend', 'subprocess')
+    if backend == 'pool':
+        if not ytdlp_pool.is_available():
+            print("[ERROR] ytdlp_backend=pool, но модуль yt_dlp не установлен. Используется бинарник.")
+            backend = 'subprocess'
+        else:
+            _ytdlp_pool = ytdlp_pool.YoutubeDLPool(size=config.get('ytdlp_pool_size', 2))
+            if config.get('ytdlp_pool_warmup', True):
+                threading.Thread(
+                    target=_ytdlp_pool.warm_up, args=(get_cookies_files(),), daemon=True
+                ).start()
+    _ytdlp_backend = backend
+    print(f"[DEBUG] yt-dlp backend: {_ytdlp_backend}")
+
 def get_script_directory():
     """Возвращает путь к папке, в которой находится текущий скрипт."""
     return os.path.dirname(os.path.abspath(__file__))
@@ -118,21 +165,139 @@ def run_yt_dlp(args, cookie_file=None):
         print(f"[ERROR] Unexpected error in run_yt_dlp: {e}")
         return None
 
-def get_available_formats(video_id, cookie_file=None):
-    """Получает список доступных форматов видео."""
+def _get_info_expires_at(info):
+    """Вычисляет момент, до которого можно использовать закэшированный info dict."""
+    expires = [get_url_expire(f.get('url')) for f in info.get('formats') or []]
+    expires = [e for e in expires if e]
+    now = time.time()
+    if not expires:
+        return now + EXTRACTION_CACHE_DEFAULT_TTL
+    return max(now, min(expires) - EXTRACTION_CACHE_EXPIRY_MARGIN)
+
+def _store_video_info(video_id, info, cookie_file=None):
+    """Сохраняет info dict в кэше извлечений, вытесняя протухшие записи."""
+    expires_at = _get_info_expires_at(info)
+    table = FormatTable(info.get('formats'))
+    with _extraction_cache_lock:
+        now = time.time()
+        for key in [k for k, v in _extraction_cache.items() if v['expires_at'] <= now]:
+            del _extraction_cache[key]
+        if len(_extraction_cache) >= EXTRACTION_CACHE_MAX_ENTRIES:
+            oldest = min(_extraction_cache, key=lambda k: _extraction_cache[k]['expires_at'])
+            del _extraction_cache[oldest]
+        _extraction_cache[(video_id, cookie_file)] = {'info': info, 'expires_at': expires_at, 'table': table}
+    get_url_store().put_formats(video_id, info.get('formats'))
+
+def get_cached_video_info(video_id, cookie_file=None):
+    """Возвращает info dict из кэша, если он ещё действителен, иначе None."""
+    with _extraction_cache_lock:
+        entry = _extraction_cache.get((video_id, cookie_file))
+        if entry and entry['expires_at'] > time.time():
+            return entry['info']
+    return None
+
+def invalidate_video_info(video_id, cookie_file=None):
+    """Удаляет info dict видео из кэша (например, если ссылки перестали работать)."""
+    with _extraction_cache_lock:
+        _extraction_cache.pop((video_id, cookie_file), None)
+
+def extract_video_info(video_id, cookie_file=None):
+    """Выполняет полное извлечение info dict выбранным движком, без кэша.
+
+    При движке 'pool' неудачное извлечение повторяется через бинарник yt-dlp.
+    """
     url = f'https://www.youtube.com/watch?v={video_id}'
-    formats_output = run_yt_dlp(['--dump-json', url], cookie_file)
-    if not formats_output:
+
+    if _ytdlp_backend == 'pool' and _ytdlp_pool is not None:
+        pool_cookie = cookie_file if cookie_file and os.path.isfile(cookie_file) else select_random_cookie_file()
+        info = _ytdlp_pool.extract_info(url, pool_cookie)
+        if info:
+            return info
+        print(f"[DEBUG] yt-dlp pool failed for {video_id}, falling back to subprocess")
+
+    info_output = run_yt_dlp(['--dump-json', '--no-warnings', url], cookie_file)
+    if not info_output:
         return None
-    
+
     try:
-        video_info = json.loads(formats_output)
-        formats = video_info.get('formats', [])
-        return formats
+        return json.loads(info_output)
     except json.JSONDecodeError:
         print("[ERROR] Не удалось разобрать JSON от yt-dlp.")
         return None
 
+def get_video_info(video_id, cookie_file=None):
+    """Получает полный info dict yt-dlp (--dump-json) для видео.
+
+    Результат извлечения кэшируется до истечения подписанных ссылок форматов,
+    поэтому все маршруты читают ссылки и метаданные из одного извлечения.
+    Параллельные вызовы для одного видео объединяются в одно извлечение.
+    Извлечения с разными cookie_file кэшируются отдельно.
+    """
+    info = get_cached_video_info(video_id, cookie_file)
+    if info is not None:
+        return info
+
+    flight_key = (video_id, cookie_file)
+    with _extraction_cache_lock:
+        event = _inflight_extractions.get(flight_key)
+        is_leader = event is None
+        if is_leader:
+            event = threading.Event()
+            _inflight_extractions[flight_key] = event
+
+    if not is_leader:
+        # Ждём результат уже идущего извлечения этого же видео
+        if event.wait(EXTRACTION_WAIT_TIMEOUT):
+            return get_cached_video_info(video_id, cookie_file)
+        print(f"[DEBUG] Timed out waiting for in-flight extraction of {video_id}, extracting again")
+        return _extract_and_store(video_id, cookie_file)
+
+    try:
+        # Извлечение могло завершиться между проверкой кэша и регистрацией
+        info = get_cached_video_info(video_id, cookie_file)
+        if info is not None:
+            return info
+        return _extract_and_store(video_id, cookie_file)
+    finally:
+        with _extraction_cache_lock:
+            _inflight_extractions.pop(flight_key, None)
+        event.set()
+
+def _extract_and_store(video_id, cookie_file=None):
+    """Извлекает info dict и сохраняет его в кэше извлечений."""
+    info = extract_video_info(video_id, cookie_file)
+    if not info:
+        return None
+
+    _store_video_info(video_id, info, cookie_file)
+    return info
+
+def refresh_video_info(video_id, cookie_file=None):
+    """Переизвлекает info dict видео (новые подписанные ссылки).
+
+    Действующая запись кэша заменяется только при успешном извлечении, так
+    что параллельные запросы всё это время получают старые ссылки.
+    """
+    return _extract_and_store(video_id, cookie_file)
+
+def get_format_table(video_id, cookie_file=None):
+    """FormatTable форматов видео, построенная один раз на извлечение."""
+    info = get_video_info(video_id, cookie_file)
+    if not info:
+        return None
+    with _extraction_cache_lock:
+        entry = _extraction_cache.get((video_id, cookie_file))
+        if entry is not None and entry['info'] is info:
+            return entry['table']
+    return FormatTable(info.get('formats'))
+
+def get_available_formats(video_id, cookie_file=None):
+    """Получает список доступных форматов видео."""
+    info = get_video_info(video_id, cookie_file)
+    if not info:
+        return None
+    return info.get('formats', [])
+
 def get_proxy_url(url, use_proxy):
     """Получает прокси URL если включено проксирование."""
     if not use_proxy:
@@ -152,7 +317,7 @@ def get_video_proxy_url(url, use_proxy):
 def get_final_url(url):
     """Получает финальный URL после всех редиректов."""
     try:
-        r = requests.get(url, allow_redirects=True, timeout=30)  # Assuming timeout from config
+        r = http_client.get(url, allow_redirects=True)
         return r.url
     except Exception as e:
         print('get_final_url error:', e)
@@ -161,7 +326,7 @@ def get_final_url(url):
 def url_exists(url):
     """Проверяет существует ли URL."""
     try:
-        r = requests.head(url, timeout=30)  # Assuming timeout from config
+        r = http_client.head(url)
         return r.status_code == 200
     except Exception as e:
         print('url_exists error:', e)
@@ -173,39 +338,77 @@ def replace_youtube_thumbnail_domain(url):
         return url
     return url.replace('https://yt3.ggpht.com', 'https://yt3.googleusercontent.com')
 
+def _fetch_channel_thumbnails(channel_ids, api_key, config):
+    """Один запрос channels?id=a,b,c (до CHANNELS_PER_REQUEST id): {channel_id: url} найденных каналов."""
+    query = urlencode({'part': 'snippet', 'id': ','.join(channel_ids), 'maxResults': CHANNELS_PER_REQUEST, 'key': api_key})
+    r = get_key_scheduler().get(
+        f"https://www.googleapis.com/youtube/v3/channels?{query}",
+        timeout=config.get('request_timeout', 30)
+    )
+    r.raise_for_status()
+    thumbnails = {}
+    for item in r.json().get('items', []):
+        try:
+            thumbnails[item['id']] = replace_youtube_thumbnail_domain(item['snippet']['thumbnails']['default']['url'])
+        except (KeyError, TypeError):
+            continue
+    return thumbnails
+
+def get_channel_thumbnails(channel_ids, api_key, config):
+    """Аватары каналов {channel_id: url} для всех элементов ответа сразу.
+
+    id без повторов берутся из кэша (channel_thumbnail_cache_ttl секунд),
+    остальные запрашиваются пачками по CHANNELS_PER_REQUEST - страница из
+    50 видео стоит один запрос к Data API вместо 50. Для ненайденных
+    каналов отдаётся аватар по умолчанию; если запрос не удался, он не кэшируется.
+    """
+    ids = list(dict.fromkeys(cid for cid in channel_ids if cid))
+    if not config.get('fetch_channel_thumbnails', False):
+        return {cid: '' for cid in ids}
+
+    thumbnails = {}
+    now = time.time()
+    with _channel_thumbnail_lock:
+        for cid in ids:
+            cached = _channel_thumbnail_cache.get(cid)
+            if cached and cached[1] > now:
+                thumbnails[cid] = cached[0]
+    missing = [cid for cid in ids if cid not in thumbnails]
+
+    default = replace_youtube_thumbnail_domain(DEFAULT_CHANNEL_THUMBNAIL)
+    ttl = config.get('channel_thumbnail_cache_ttl', CHANNEL_THUMBNAIL_TTL)
+    for start in range(0, len(missing), CHANNELS_PER_REQUEST):
+        chunk = missing[start:start + CHANNELS_PER_REQUEST]
+        try:
+            found = _fetch_channel_thumbnails(chunk, api_key, config)
+        except Exception as e:
+            print(f'Error getting channel thumbnails from API for {len(chunk)} channels: {e}')
+            continue
+        print(f"DEBUG: Fetched {len(found)} of {len(chunk)} channel thumbnails in one request")
+        expires_at = time.time() + ttl
+        with _channel_thumbnail_lock:
+            for cid in chunk:
+                url = found.get(cid, default)
+                thumbnails[cid] = url
+                _channel_thumbnail_cache[cid] = (url, expires_at)
+            if len(_channel_thumbnail_cache) > CHANNEL_THUMBNAIL_CACHE_MAX_ENTRIES:
+                now = time.time()
+                for key in [k for k, v in _channel_thumbnail_cache.items() if v[1] <= now]:
+                    del _channel_thumbnail_cache[key]
+                while len(_channel_thumbnail_cache) > CHANNEL_THUMBNAIL_CACHE_MAX_ENTRIES:
+                    del _channel_thumbnail_cache[next(iter(_channel_thumbnail_cache))]
+
+    for cid in ids:
+        thumbnails.setdefault(cid, default)
+    return thumbnails
+
 def get_channel_thumbnail(channel_id, api_key, config):
-    """Get channel thumbnail with multiple fallback methods"""
+    """Get channel thumbnail (cached, see get_channel_thumbnails)"""
     if not config.get('fetch_channel_thumbnails', False):
         return ''
-    
-    print(f"DEBUG: Getting channel thumbnail for channel_id: {channel_id}")
-    
-    # Method 1: Try YouTube API to get channel thumbnail
-    try:
-        r = requests.get(
-            f"https://www.googleapis.com/youtube/v3/channels?id={channel_id}&key={api_key}&part=snippet", 
-            timeout=config.get('request_timeout', 30)
-        )
-        r.raise_for_status()
-        data = r.json()
-        
-        print(f"DEBUG: API response: {json.dumps(data, ensure_ascii=False)[:200]}...")
-        
-        if data.get('items') and data['items']:
-            # Get channel thumbnail from channel data
-            channel_snippet = data['items'][0]['snippet']
-            thumbnail_url = channel_snippet['thumbnails']['default']['url']
-            print(f"DEBUG: Found channel thumbnail: {thumbnail_url}")
-            # Replace domain for better reliability
-            return replace_youtube_thumbnail_domain(thumbnail_url)
-        else:
-            print("DEBUG: No items in API response")
-                
-    except Exception as e:
-        print(f'Error getting channel thumbnail from API for {channel_id}: {e}')
-    
-    # Fallback
-    return replace_youtube_thumbnail_domain('https://yt3.ggpht.com/a/default-user=s88-c-k-c0x00ffffff-no-rj')
+    if not channel_id:
+        return replace_youtube_thumbnail_domain(DEFAULT_CHANNEL_THUMBNAIL)
+    return get_channel_thumbnails([channel_id], api_key, config)[channel_id]
 
 def get_api_key(config, request_args=None):
     """Get API key from request parameters or config.
@@ -222,24 +425,17 @@ def get_api_key(config, request_args=None):
     return get_api_key_rotated(config)
 
 def get_api_key_rotated(config):
-    """Get an API key from the config's api_keys list with rotation.
-    
-    This function rotates through the available API keys to distribute the load.
+    """Get an API key from the config's api_keys (or api_key) with quota-aware scheduling.
+
+    The key with the most estimated quota left that is not quarantined
+    after a quota or invalid-key error is returned (see APIKeyScheduler).
+    Raises NoAPIKeyError if config.json has no keys, so no request is sent
+    with key=None.
     """
-    global _api_key_counter, _api_key_lock
-    
-    api_keys = config.get('api_keys', [])
-    if not api_keys:
-        # Fallback to old config format
-        return get_api_key_rotated(config)
-    
-    # Thread-safe increment and selection
-    with _api_key_lock:
-        index = _api_key_counter % len(api_keys)
-        key = api_keys[index]
-        _api_key_counter += 1
-    
-    # Log which API key is being used
-    print(f"Using API key at index {index}: {key}")
-    
+    scheduler = get_key_scheduler()
+    if not scheduler.keys:
+        scheduler = init_api_keys(config)
+    key = scheduler.pick()
+    if key is None:
+        raise NoAPIKeyError("no YouTube Data API key configured (api_keys / api_key in config.json)")
     return key
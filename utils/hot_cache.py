@@ -0,0 +1,188 @@
+import os
+import threading
+from collections import OrderedDict
+
+from .fmp4 import index_file
+
+DEFAULT_SIZE_MB = 256
+DEFAULT_PREFIX_MB = 4
+DEFAULT_MIN_HITS = 2
+# How many files the request counter remembers (bounded, least recently requested forgotten first)
+MAX_TRACKED_FILES = 4096
+# Approximate memory per fragment in a FragmentIndex (tuple of offset and time)
+FRAGMENT_COST = 64
+
+
+class _HotEntry:
+    __slots__ = ('version', 'prefix', 'index', 'cost')
+
+    def __init__(self, version):
+        self.version = version
+        self.prefix = None
+        self.index = None
+        self.cost = 0
+
+
+class HotTier:
+    """In-memory tier in front of the disk cache.
+
+    Keeps the first prefix_bytes of the most requested cache files (ftyp,
+    moov and the first fragments - what a player reads on startup and when
+    probing) and their parsed fragment indexes, so startup Range requests
+    and time seeks do not touch the disk.
+
+    Memory is accounted in bytes against budget_bytes, least recently used
+    files are dropped first. A file's prefix is loaded on its min_hits-th
+    request; entries are keyed by path and checked against (mtime, size),
+    so a replaced file is never served from a stale copy.
+    """
+
+    def __init__(self, budget_bytes, prefix_bytes, min_hits=DEFAULT_MIN_HITS):
+        self.budget_bytes = max(0, int(budget_bytes))
+        self.prefix_bytes = max(0, int(prefix_bytes))
+        self.min_hits = max(1, int(min_hits))
+        self._entries = OrderedDict()  # path -> _HotEntry
+        self._requests = OrderedDict()  # path -> request count
+        self._used = 0
+        self._lock = threading.Lock()
+        self._stats = {'served_requests': 0, 'served_bytes': 0, 'prefix_loads': 0, 'index_hits': 0, 'index_loads': 0,
+                       'evictions': 0}
+
+    @property
+    def enabled(self):
+        return self.budget_bytes > 0 and self.prefix_bytes > 0
+
+    def _entry(self, path, version):
+        """Current entry for path (moved to the LRU end), dropping it if the file changed. Lock held."""
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        if entry.version != version:
+            self._drop(path)
+            return None
+        self._entries.move_to_end(path)
+        return entry
+
+    def _drop(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._used -= entry.cost
+
+    def _store(self, path, version, prefix=None, index=None):
+        """Attach a prefix or index to the entry for path and evict to fit the budget. Lock held."""
+        entry = self._entries.get(path)
+        if entry is None or entry.version != version:
+            self._drop(path)
+            entry = _HotEntry(version)
+            self._entries[path] = entry
+        if prefix is not None:
+            entry.prefix = prefix
+        if index is not None:
+            entry.index = index
+        self._used -= entry.cost
+        entry.cost = (len(entry.prefix) if entry.prefix else 0) + \
+            (len(entry.index.fragments) * FRAGMENT_COST if entry.index else 0)
+        self._used += entry.cost
+        self._entries.move_to_end(path)
+        while self._used > self.budget_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self._stats['evictions'] += 1
+
+    def _count_request(self, path):
+        count = self._requests.pop(path, 0) + 1
+        self._requests[path] = count
+        while len(self._requests) > MAX_TRACKED_FILES:
+            self._requests.popitem(last=False)
+        return count
+
+    def get_prefix(self, path, stat):
+        """Leading bytes of the file if it is hot (loading them on the min_hits-th request), else None.
+
+        Counts one request for the file.
+        """
+        if not self.enabled:
+            return None
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entry(path, version)
+            if entry is not None and entry.prefix is not None:
+                return entry.prefix
+            if self._count_request(path) < self.min_hits:
+                return None
+        length = min(self.prefix_bytes, stat.st_size)
+        try:
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                prefix = os.pread(fd, length, 0)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"[ERROR] Hot tier: error reading {path}: {e}")
+            return None
+        if len(prefix) != length:
+            return None
+        with self._lock:
+            self._store(path, version, prefix=prefix)
+            self._stats['prefix_loads'] += 1
+        return prefix
+
+    def get_index(self, path, stat):
+        """FragmentIndex of a complete cache file, parsed once and kept while the file stays hot."""
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entry(path, version)
+            if entry is not None and entry.index is not None:
+                self._stats['index_hits'] += 1
+                return entry.index
+        index = index_file(path)
+        if self.budget_bytes:
+            with self._lock:
+                self._store(path, version, index=index)
+                self._stats['index_loads'] += 1
+        return index
+
+    def record_served(self, nbytes):
+        """Count a response (or part of one) that was answered from memory."""
+        with self._lock:
+            self._stats['served_requests'] += 1
+            self._stats['served_bytes'] += nbytes
+
+    def invalidate(self, path):
+        with self._lock:
+            self._drop(path)
+            self._requests.pop(path, None)
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._stats)
+            metrics.update({
+                'files': len(self._entries),
+                'used_bytes': self._used,
+                'budget_bytes': self.budget_bytes,
+                'prefix_bytes': self.prefix_bytes,
+                'min_hits': self.min_hits,
+            })
+        return metrics
+
+
+_hot_tier = HotTier(DEFAULT_SIZE_MB * 1024 * 1024, DEFAULT_PREFIX_MB * 1024 * 1024)
+
+
+def configure(config):
+    """Читает hot_cache_size_mb, hot_cache_prefix_mb и hot_cache_min_hits из конфигурации."""
+    global _hot_tier
+    try:
+        budget = float(config.get('hot_cache_size_mb', DEFAULT_SIZE_MB)) * 1024 * 1024
+        prefix = float(config.get('hot_cache_prefix_mb', DEFAULT_PREFIX_MB)) * 1024 * 1024
+        min_hits = int(config.get('hot_cache_min_hits', DEFAULT_MIN_HITS))
+    except (TypeError, ValueError):
+        budget, prefix, min_hits = DEFAULT_SIZE_MB * 1024 * 1024, DEFAULT_PREFIX_MB * 1024 * 1024, DEFAULT_MIN_HITS
+    _hot_tier = HotTier(budget, prefix, min_hits)
+    print(f"[DEBUG] Hot tier: {budget / 1024 / 1024:.0f} MB, first {prefix / 1024 / 1024:.1f} MB of files "
+          f"requested {min_hits}+ times")
+    return _hot_tier
+
+
+def get_hot_tier():
+    return _hot_tier
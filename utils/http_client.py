@@ -0,0 +1,127 @@
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_POOL_HOSTS = 16
+DEFAULT_POOL_SIZE = 32
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.3
+CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+# Потоковая передача (video.proxy): ожидание следующего куска, а не всего ответа
+STREAM_TIMEOUT = (CONNECT_TIMEOUT, 60)
+# Повторяются только ошибки сервера; 403/429 Data API разбирает планировщик ключей
+RETRY_STATUSES = (500, 502, 503, 504)
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+# Настройки по умолчанию, задаются из config.json через configure()
+_pool_hosts = DEFAULT_POOL_HOSTS
+_pool_size = DEFAULT_POOL_SIZE
+_retries = DEFAULT_RETRIES
+_backoff = DEFAULT_BACKOFF
+_timeout = (CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure(config):
+    """Читает http_pool_hosts, http_pool_size, http_retries, http_backoff и request_timeout из config.json."""
+    global _pool_hosts, _pool_size, _retries, _backoff, _timeout, _session
+    try:
+        _pool_hosts = max(1, int(config.get('http_pool_hosts', DEFAULT_POOL_HOSTS)))
+        _pool_size = max(1, int(config.get('http_pool_size', DEFAULT_POOL_SIZE)))
+        _retries = max(0, int(config.get('http_retries', DEFAULT_RETRIES)))
+        _backoff = max(0.0, float(config.get('http_backoff', DEFAULT_BACKOFF)))
+        _timeout = (CONNECT_TIMEOUT, float(config.get('request_timeout', DEFAULT_READ_TIMEOUT)))
+    except (TypeError, ValueError):
+        _pool_hosts, _pool_size, _retries, _backoff = DEFAULT_POOL_HOSTS, DEFAULT_POOL_SIZE, DEFAULT_RETRIES, DEFAULT_BACKOFF
+        _timeout = (CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+    with _session_lock:
+        old, _session = _session, None
+    if old is not None:
+        old.close()
+    print(f"[DEBUG] HTTP client: {_pool_size} connections per host, {_retries} retries, timeout {_timeout}")
+
+
+def _retry_policy(retries, backoff):
+    """Повторы при сетевых ошибках и 5xx с экспоненциальной паузой и случайным разбросом.
+
+    Ошибка соединения повторяется для любого метода (запрос не ушёл), 5xx -
+    только для GET/HEAD. Ошибка чтения (в том числе закрытое сервером
+    keep-alive соединение) повторяется один раз: медленный апстрим иначе
+    растягивал бы таймаут в несколько раз. После последней попытки
+    возвращается сам ответ, а не исключение, - маршруты разбирают его как раньше.
+    """
+    options = dict(total=retries, connect=retries, read=min(retries, 1), status=retries, backoff_factor=backoff,
+                   status_forcelist=RETRY_STATUSES, allowed_methods=RETRY_METHODS,
+                   raise_on_status=False, respect_retry_after_header=True)
+    try:
+        return Retry(backoff_jitter=backoff, **options)
+    except TypeError:  # urllib3 1.x: без backoff_jitter
+        return _JitteredRetry(**options)
+
+
+class _JitteredRetry(Retry):
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return backoff * random.uniform(0.5, 1.5) if backoff else backoff
+
+
+class _Session(requests.Session):
+    """requests.Session, у которой запрос без timeout получает таймаут по умолчанию."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.default_timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.default_timeout
+        return super().request(method, url, **kwargs)
+
+
+def new_session(pool_size=None, retries=None, headers=None, timeout=None):
+    """Отдельная сессия со своим пулом (например, для googlevideo); параметры по умолчанию - общие."""
+    session = _Session(timeout or _timeout)
+    adapter = HTTPAdapter(
+        pool_connections=_pool_hosts,
+        pool_maxsize=pool_size or _pool_size,
+        max_retries=_retry_policy(_retries if retries is None else retries, _backoff),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def get_session():
+    """Общая keep-alive сессия: по пулу соединений на хост (googleapis.com, youtube.com, i.ytimg.com...).
+
+    HTTP/1.1: requests не умеет HTTP/2, а повторное использование
+    соединений и так убирает TCP- и TLS-рукопожатие у каждого запроса.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = new_session()
+        return _session
+
+
+def request(method, url, **kwargs):
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return get_session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return get_session().post(url, **kwargs)
+
+
+def head(url, **kwargs):
+    return get_session().head(url, **kwargs)
@@ -0,0 +1,259 @@
+import re
+import threading
+
+import requests
+
+from . import http_client
+from .format_table import codec_family
+
+DEFAULT_CHUNK_SIZE = 65536
+DEFAULT_POOL_SIZE = 32
+CONNECT_TIMEOUT = 10
+# Сколько ждать следующего куска от googlevideo, прежде чем переподключиться
+READ_TIMEOUT = 30
+# Сколько раз один поток переподключается (обрыв соединения или истёкшая ссылка)
+MAX_RESUMES = 3
+UPSTREAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0 Safari/537.36',
+    'Referer': 'https://www.youtube.com',
+    'Origin': 'https://www.youtube.com',
+}
+
+# Настройки по умолчанию, задаются из config.json через configure()
+_enabled = True
+_chunk_size = DEFAULT_CHUNK_SIZE
+_pool_size = DEFAULT_POOL_SIZE
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure(config):
+    """Читает passthrough_enabled, passthrough_pool_size и stream_chunk_size из конфигурации."""
+    global _enabled, _chunk_size, _pool_size, _session
+    _enabled = bool(config.get('passthrough_enabled', True))
+    try:
+        _chunk_size = max(4096, int(config.get('stream_chunk_size', DEFAULT_CHUNK_SIZE)))
+        _pool_size = max(1, int(config.get('passthrough_pool_size', DEFAULT_POOL_SIZE)))
+    except (TypeError, ValueError):
+        _chunk_size, _pool_size = DEFAULT_CHUNK_SIZE, DEFAULT_POOL_SIZE
+    with _session_lock:
+        _session = None
+    print(f"[DEBUG] Passthrough: {'on' if _enabled else 'off'}, {_pool_size} upstream connections per host")
+
+
+def _get_session():
+    """Общая requests.Session: соединения с googlevideo переиспользуются (keep-alive)."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            # Свой пул под googlevideo и без повторов: обрыв продолжает сам поток (Range)
+            _session = http_client.new_session(pool_size=_pool_size, retries=0, headers=UPSTREAM_HEADERS,
+                                               timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        return _session
+
+
+def can_passthrough(fmt, audio_format=None):
+    """Можно ли отдать формат без FFmpeg: прогрессивный MP4 (H.264 + AAC) или M4A (AAC) по https-ссылке."""
+    if not _enabled or audio_format is not None or not fmt or not fmt.get('url'):
+        return False
+    if fmt.get('protocol') != 'https' or not (fmt.get('acodec') or '').startswith('mp4a'):
+        return False
+    if fmt.get('vcodec') in (None, 'none'):
+        return fmt.get('ext') in ('m4a', 'mp4')
+    return fmt.get('ext') == 'mp4' and codec_family(fmt.get('vcodec')) == 'avc1'
+
+
+class PassthroughSource:
+    """Прогрессивный MP4 или M4A, который отдаётся как есть, вместо команды FFmpeg.
+
+    refresh() - новая подписанная ссылка того же формата (или None); cmd и
+    resume - команда FFmpeg для того же видео на случай, если прямое
+    чтение не удалось начать.
+    """
+
+    __slots__ = ('url', 'refresh', 'cmd', 'resume')
+
+    def __init__(self, url, refresh=None, cmd=None, resume=None):
+        self.url = url
+        self.refresh = refresh
+        self.cmd = cmd
+        self.resume = resume
+
+
+class UpstreamError(Exception):
+    """googlevideo не отдал файл (код ответа не 200/206 или сетевая ошибка)."""
+
+
+def _parse_content_range(value):
+    """(start, end, total) из 'bytes 0-99/1000'; total None для '*'."""
+    m = re.match(r'bytes\s+(\d+)-(\d+)/(\d+|\*)', value or '')
+    if not m:
+        return None
+    return int(m.group(1)), int(m.group(2)), (int(m.group(3)) if m.group(3) != '*' else None)
+
+
+class PassthroughPipeline:
+    """Отдача прогрессивного MP4 с googlevideo без FFmpeg.
+
+    Повторяет интерфейс StreamPipeline (start, iter_chunks, tee_to_cache,
+    pump_to, cancel), поэтому маршруты и прогрев отдают и кэшируют его
+    так же. Байты читаются через общую keep-alive сессию; byte_range
+    (start, end) передаётся в запрос как Range, а status, content_range
+    и length описывают ответ googlevideo для клиента.
+
+    Файл формата не меняется между подписями ссылки, поэтому при обрыве
+    соединения чтение продолжается запросом Range с текущей позиции, а
+    на 403 - по ссылке из source.refresh(). Слот планировщика FFmpeg не
+    нужен: процессор почти не используется.
+    """
+
+    def __init__(self, source, byte_range=None, chunk_size=None, name='passthrough'):
+        self.source = source
+        self.url = source.url
+        self.byte_range = byte_range
+        self.chunk_size = chunk_size or _chunk_size
+        self.name = name
+        self.resumes = 0
+        self.status = None
+        self.content_range = None
+        self.length = None  # байт в ответе клиенту, если известно
+        self._position = byte_range[0] if byte_range else 0
+        self._end = None  # абсолютное смещение конца ответа (исключительно), если известно
+        self._response = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def _open(self, start, end=None):
+        headers = {}
+        if start or end is not None:
+            headers['Range'] = f"bytes={start}-{end if end is not None else ''}"
+        try:
+            response = _get_session().get(self.url, headers=headers, stream=True,
+                                          timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except requests.RequestException as e:
+            raise UpstreamError(str(e))
+        if response.status_code == 403 and self.source.refresh is not None:
+            response.close()
+            url = self.source.refresh()
+            if not url:
+                raise UpstreamError('403 and no fresh URL')
+            self.url = url
+            try:
+                response = _get_session().get(self.url, headers=headers, stream=True,
+                                              timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            except requests.RequestException as e:
+                raise UpstreamError(str(e))
+        if response.status_code not in (200, 206):
+            response.close()
+            raise UpstreamError(f'HTTP {response.status_code}')
+        return response
+
+    def start(self):
+        """Открывает соединение. UpstreamError, если googlevideo не отдал файл."""
+        start, end = self.byte_range if self.byte_range else (0, None)
+        response = self._open(start, end)
+        self.status = response.status_code
+        if self.status == 206:
+            parsed = _parse_content_range(response.headers.get('Content-Range'))
+            if parsed is None:
+                response.close()
+                raise UpstreamError('206 without Content-Range')
+            self.content_range = response.headers['Content-Range']
+            self._position, last, _ = parsed
+            self._end = last + 1
+        else:
+            # Range без ответа 206 - googlevideo отдаёт файл целиком
+            self._position = 0
+            length = response.headers.get('Content-Length')
+            self._end = int(length) if length and length.isdigit() else None
+        if self._end is not None:
+            self.length = self._end - self._position
+        with self._lock:
+            self._response = response
+        return self
+
+    def _reopen(self):
+        """Продолжает чтение с текущей позиции после обрыва. False, если нельзя."""
+        if self._cancelled or self.resumes >= MAX_RESUMES or self._end is None:
+            return False
+        self.resumes += 1
+        print(f"[DEBUG] {self.name}: upstream connection lost at byte {self._position}, "
+              f"resuming (attempt {self.resumes})")
+        try:
+            response = self._open(self._position, self._end - 1)
+        except UpstreamError as e:
+            print(f"[ERROR] {self.name}: error resuming: {e}")
+            return False
+        if response.status_code != 206:
+            response.close()
+            print(f"[ERROR] {self.name}: upstream ignored Range on resume")
+            return False
+        with self._lock:
+            if self._cancelled:
+                response.close()
+                return False
+            self._response = response
+        return True
+
+    def _iter_upstream(self):
+        """Куски ответа с переподключениями; заканчивается, когда отдан весь диапазон или продолжить нельзя."""
+        while not self._cancelled:
+            try:
+                for chunk in self._response.iter_content(self.chunk_size):
+                    if chunk:
+                        self._position += len(chunk)
+                        yield chunk
+            except (requests.RequestException, OSError) as e:
+                if self._cancelled:
+                    return
+                print(f"[DEBUG] {self.name}: upstream read error: {e}")
+            finally:
+                self._response.close()
+            if self._end is None or self._position >= self._end or not self._reopen():
+                return
+
+    @property
+    def complete(self):
+        """Отдан ли весь ответ googlevideo."""
+        return not self._cancelled and self._end is not None and self._position >= self._end
+
+    def iter_chunks(self):
+        """Отдаёт ответ кусками; по окончании или отключении клиента закрывает соединение."""
+        try:
+            yield from self._iter_upstream()
+        except Exception as e:
+            print(f"[ERROR] {self.name}: error reading upstream: {e}")
+        finally:
+            self.cancel()
+
+    def pump_to(self, cache_entry):
+        """Переписывает ответ в файл кэша; файл попадает в кэш, только если прочитан целиком."""
+        ok = False
+        try:
+            for chunk in self._iter_upstream():
+                cache_entry.append(chunk)
+            ok = self.complete
+            if not ok and not self._cancelled:
+                print(f"[ERROR] {self.name}: upstream ended at byte {self._position} of {self._end}")
+        except Exception as e:
+            print(f"[ERROR] {self.name}: error writing cache file: {e}")
+        finally:
+            self.cancel()
+            cache_entry.finish(ok)
+
+    def tee_to_cache(self, cache_entry):
+        """Запускает запись в кэш в фоновом потоке."""
+        threading.Thread(target=self.pump_to, args=(cache_entry,), daemon=True).start()
+
+    def cancel(self):
+        """Закрывает соединение с googlevideo."""
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            response = self._response
+        if response is not None:
+            try:
+                response.close()
+            except Exception:
+                pass
@@ -0,0 +1,289 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from .helpers import get_video_info, get_cached_video_info
+from .video_cache import (
+    get_cache_path, is_video_cached, get_in_progress_entry, start_cache_entry, get_cache_janitor
+)
+from .stream_pipeline import StreamPipeline
+from .passthrough import PassthroughSource, PassthroughPipeline
+from .transcode_scheduler import get_transcode_scheduler, PRIORITY_BACKGROUND
+
+DEFAULT_TOP_N = 5
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_RESOLVES_PER_MINUTE = 20
+DEFAULT_PREMUX_MB_PER_HOUR = 1024
+DEFAULT_MAX_LOAD = 0.75
+# Пауза при высокой нагрузке: начинается с BACKOFF_MIN и удваивается до BACKOFF_MAX
+BACKOFF_MIN = 5
+BACKOFF_MAX = 120
+# Видео, уже прогретое за это время, повторно из лент не берётся
+RECENT_TTL = 1800
+
+_prefetcher = None
+
+
+class Prefetcher:
+    """Фоновый прогрев видео, которые вот-вот откроют из лент.
+
+    Маршруты лент (популярное, категории, рекомендации) передают в offer()
+    свои ID; первые top_n каждой ленты ставятся в ограниченную очередь без
+    повторов. Один рабочий поток для каждого видео:
+      - заранее извлекает ссылки форматов (кэш извлечений yt-dlp), не чаще
+        resolves_per_minute раз в минуту;
+      - при premux - ещё и записывает качество quality в кэш видео через
+        build_cmd(video_id, quality, manifest) -> (cmd, resume), не больше
+        premux_mb_per_hour за последний час и только пока кэш не заполнен
+        (прогрев не вытесняет уже просмотренные файлы). quality - ключ
+        кэша, как в параметре quality маршрутов; None - стандартный поток
+        ссылки direct_url без quality.
+
+    FFmpeg запускается со слотом PRIORITY_BACKGROUND и только если слот
+    свободен сразу; прогрессивный MP4 (PassthroughSource) пишется без него.
+    Пока занято больше max_load слотов FFmpeg, есть очередь к планировщику
+    или loadavg на ядро выше max_load, поток ждёт с экспоненциальной паузой.
+
+    join/finish - single-flight маршрутов видео: прогрев записывает файл
+    только став ведущим, так что запрос этого же видео подключается к
+    растущему файлу, а не запускает второй FFmpeg.
+    """
+
+    def __init__(self, quality, build_cmd=None, join=None, finish=None, top_n=DEFAULT_TOP_N, premux=False,
+                 queue_size=DEFAULT_QUEUE_SIZE, resolves_per_minute=DEFAULT_RESOLVES_PER_MINUTE,
+                 premux_mb_per_hour=DEFAULT_PREMUX_MB_PER_HOUR, max_load=DEFAULT_MAX_LOAD):
+        self.quality = quality
+        self.build_cmd = build_cmd
+        self.join = join
+        self.finish = finish
+        self.top_n = max(0, int(top_n))
+        self.premux = bool(premux) and build_cmd is not None
+        self.resolves_per_minute = max(1, int(resolves_per_minute))
+        self.premux_bytes_per_hour = int(float(premux_mb_per_hour) * 1024 * 1024)
+        self.max_load = float(max_load)
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._pending = set()
+        self._recent = {}  # video_id -> время прогрева
+        self._resolves = deque()  # время последних извлечений
+        self._premuxed = deque()  # (время, байт) записанных файлов
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {'offered': 0, 'queued': 0, 'dropped_full': 0, 'resolved': 0, 'resolve_failed': 0,
+                       'already_resolved': 0, 'premuxed': 0, 'premux_failed': 0, 'premux_bytes': 0,
+                       'skipped_cached': 0, 'skipped_cache_full': 0, 'skipped_budget': 0, 'skipped_busy': 0,
+                       'backoffs': 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name='prefetcher')
+            self._thread.start()
+
+    def offer(self, video_ids, source=''):
+        """Ставит в очередь первые top_n ID ленты source. Не блокирует: при полной очереди ID отбрасываются."""
+        if self._thread is None:
+            return 0
+        queued = 0
+        now = time.time()
+        with self._lock:
+            self._stats['offered'] += 1
+            for video_id in list(video_ids)[:self.top_n]:
+                if not video_id or video_id in self._pending:
+                    continue
+                if now - self._recent.get(video_id, 0) < RECENT_TTL:
+                    continue
+                try:
+                    self._queue.put_nowait(video_id)
+                except queue.Full:
+                    self._stats['dropped_full'] += 1
+                    break
+                self._pending.add(video_id)
+                queued += 1
+            self._stats['queued'] += queued
+        if queued:
+            print(f"[DEBUG] Prefetch: queued {queued} videos from {source or 'feed'}")
+        return queued
+
+    def _run(self):
+        backoff = BACKOFF_MIN
+        while True:
+            video_id = self._queue.get()
+            try:
+                while self._foreground_busy():
+                    with self._lock:
+                        self._stats['backoffs'] += 1
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, BACKOFF_MAX)
+                backoff = BACKOFF_MIN
+                self._prefetch(video_id)
+            except Exception as e:
+                print(f"[ERROR] Prefetch of {video_id} failed: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(video_id)
+                    self._recent[video_id] = time.time()
+                    if len(self._recent) > 4 * self._queue.maxsize:
+                        cutoff = time.time() - RECENT_TTL
+                        self._recent = {k: t for k, t in self._recent.items() if t > cutoff}
+
+    def _foreground_busy(self):
+        """Заняты ли слоты FFmpeg (или процессор) запросами пользователей."""
+        metrics = get_transcode_scheduler().metrics()
+        if metrics['queue_depth'] or metrics['running'] >= metrics['max_concurrent'] * self.max_load:
+            return True
+        if hasattr(os, 'getloadavg'):
+            try:
+                return os.getloadavg()[0] / (os.cpu_count() or 1) > self.max_load
+            except OSError:
+                pass
+        return False
+
+    def _prefetch(self, video_id):
+        if self.premux and is_video_cached(video_id, self.quality):
+            with self._lock:
+                self._stats['skipped_cached'] += 1
+            return
+        self._resolve(video_id)
+        if self.premux:
+            self._premux(video_id)
+
+    def _wait_for_resolve_budget(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._resolves and now - self._resolves[0] >= 60:
+                    self._resolves.popleft()
+                if len(self._resolves) < self.resolves_per_minute:
+                    self._resolves.append(now)
+                    return
+                delay = 60 - (now - self._resolves[0])
+            time.sleep(max(delay, 0.1))
+
+    def _resolve(self, video_id):
+        if get_cached_video_info(video_id) is not None:
+            with self._lock:
+                self._stats['already_resolved'] += 1
+            return True
+        self._wait_for_resolve_budget()
+        info = get_video_info(video_id)
+        with self._lock:
+            self._stats['resolved' if info else 'resolve_failed'] += 1
+        return bool(info)
+
+    def _premux_budget_left(self):
+        with self._lock:
+            now = time.monotonic()
+            while self._premuxed and now - self._premuxed[0][0] >= 3600:
+                self._premuxed.popleft()
+            return self.premux_bytes_per_hour - sum(size for _, size in self._premuxed)
+
+    def _skip(self, reason):
+        with self._lock:
+            self._stats[reason] += 1
+
+    def _premux(self, video_id):
+        cache_path = get_cache_path(video_id, self.quality)
+        if is_video_cached(video_id, self.quality) or get_in_progress_entry(cache_path) is not None:
+            return self._skip('skipped_cached')
+        if self._premux_budget_left() <= 0:
+            return self._skip('skipped_budget')
+        if get_cache_janitor().victim() is not None:
+            return self._skip('skipped_cache_full')
+
+        is_leader, flight = self.join((video_id, self.quality))
+        if not is_leader:
+            return self._skip('skipped_cached')
+        try:
+            if get_in_progress_entry(cache_path) is not None or is_video_cached(video_id, self.quality):
+                return self._skip('skipped_cached')
+            info = get_cached_video_info(video_id) or {}
+            manifest = {'video_id': video_id, 'quality': self.quality, 'duration': info.get('duration'),
+                        'prefetched': True}
+            cmd, resume = self.build_cmd(video_id, self.quality, manifest)
+            if not cmd:
+                return self._skip('premux_failed')
+            if isinstance(cmd, PassthroughSource):
+                # Прогрессивный MP4 записывается как есть, без FFmpeg и слота
+                pipeline = PassthroughPipeline(cmd, name='passthrough-prefetch')
+                manifest['passthrough'] = True
+            else:
+                slot = get_transcode_scheduler().acquire(PRIORITY_BACKGROUND, timeout=0)
+                if slot is None:
+                    return self._skip('skipped_busy')
+                pipeline = StreamPipeline(cmd, slot=slot, name='ffmpeg-prefetch', resume=resume)
+            try:
+                pipeline.start()
+            except Exception as e:
+                print(f"[ERROR] Error starting {pipeline.name} to prefetch {video_id}: {e}")
+                return self._skip('premux_failed')
+            print(f"Prefetching {video_id} ({self.quality}) into the cache")
+            cache_entry = start_cache_entry(cache_path, manifest=manifest)
+        finally:
+            self.finish(flight)
+        pipeline.pump_to(cache_entry)
+        with self._lock:
+            if cache_entry.ok:
+                self._stats['premuxed'] += 1
+                self._stats['premux_bytes'] += cache_entry.size
+                self._premuxed.append((time.monotonic(), cache_entry.size))
+            else:
+                self._stats['premux_failed'] += 1
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._stats)
+            metrics['pending'] = len(self._pending)
+        metrics.update({
+            'top_n': self.top_n,
+            'premux': self.premux,
+            'quality': self.quality,
+            'premux_budget_left_bytes': max(0, self._premux_budget_left()) if self.premux else 0,
+        })
+        return metrics
+
+
+def configure(config, build_cmd=None, join=None, finish=None):
+    """Читает prefetch_* из config.json и запускает прогрев, если prefetch_enabled.
+
+    build_cmd, join и finish передаёт маршрут видео (см. Prefetcher).
+    """
+    global _prefetcher
+    if not config.get('prefetch_enabled', False):
+        _prefetcher = None
+        print("[DEBUG] Prefetch: off")
+        return None
+    # По умолчанию - без качества: этот ключ кэша у ссылки direct_url?video_id=...,
+    # которую get-ytvideo-info.php отдаёт клиентам (стандартный комбинированный поток)
+    quality = str(config['prefetch_quality']) if config.get('prefetch_quality') else None
+    _prefetcher = Prefetcher(
+        quality,
+        build_cmd=build_cmd,
+        join=join,
+        finish=finish,
+        top_n=config.get('prefetch_top_n', DEFAULT_TOP_N),
+        premux=config.get('prefetch_premux', False) and join is not None and finish is not None,
+        queue_size=config.get('prefetch_queue_size', DEFAULT_QUEUE_SIZE),
+        resolves_per_minute=config.get('prefetch_resolves_per_minute', DEFAULT_RESOLVES_PER_MINUTE),
+        premux_mb_per_hour=config.get('prefetch_premux_mb_per_hour', DEFAULT_PREMUX_MB_PER_HOUR),
+        max_load=config.get('prefetch_max_load', DEFAULT_MAX_LOAD),
+    )
+    _prefetcher.start()
+    print(f"[DEBUG] Prefetch: top {_prefetcher.top_n} of each feed, "
+          f"{'resolve and pre-mux ' + (quality or 'standard') if _prefetcher.premux else 'resolve only'}")
+    return _prefetcher
+
+
+def prefetch_feed(video_ids, source=''):
+    """Передаёт ID из ленты в прогрев; ничего не делает, если прогрев выключен."""
+    if _prefetcher is None:
+        return 0
+    try:
+        return _prefetcher.offer(video_ids, source)
+    except Exception as e:
+        print(f"[ERROR] Error queueing prefetch from {source}: {e}")
+        return 0
+
+
+def prefetcher_metrics():
+    return _prefetcher.metrics() if _prefetcher is not None else {'enabled': False}
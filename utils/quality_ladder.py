@@ -0,0 +1,229 @@
+import queue
+import threading
+
+from .video_cache import get_cache_index, get_cache_path, is_video_cached, get_in_progress_entry, start_cache_entry
+from .stream_pipeline import StreamPipeline
+from .transcode_scheduler import get_transcode_scheduler, PRIORITY_BACKGROUND
+
+DEFAULT_LADDER = [144, 240, 360, 480, 720, 1080, 1440, 2160]
+DEFAULT_PREGENERATE = ['144', '240', '360']
+DEFAULT_PREGENERATE_MIN_HITS = 5
+# Background jobs wait this long for a free FFmpeg slot before giving up
+PREGENERATE_SLOT_TIMEOUT = 300
+
+QUALITY_ALIASES = {
+    'tiny': 144, 'small': 240, 'medium': 360, 'large': 480,
+    'hd': 720, 'hd720': 720, '720p': 720,
+    'hd1080': 1080, '1080p': 1080,
+    '144p': 144, '240p': 240, '360p': 360, '480p': 480,
+    '2160p': 2160, '1440p': 1440
+}
+
+# Настройки, задаются из config.json через configure()
+_ladder = list(DEFAULT_LADDER)
+_derive_enabled = True
+_serve_closest = False
+_downscale_preset = 'veryfast'
+_downscale_crf = 23
+_pregenerator = None
+
+
+def parse_height(qval):
+    """Преобразует параметр quality (720, '720p', 'hd720', ...) в высоту кадра."""
+    if not qval:
+        return None
+    s = str(qval).strip().lower()
+    try:
+        return int(s)
+    except Exception:
+        pass
+    digits = ''.join(ch for ch in s if ch.isdigit())
+    if digits:
+        try:
+            return int(digits)
+        except Exception:
+            pass
+    return QUALITY_ALIASES.get(s)
+
+
+def configure(config):
+    """Читает лестницу качеств (available_qualities) и настройки cache_derive_*/cache_pregenerate_*."""
+    global _ladder, _derive_enabled, _serve_closest, _downscale_preset, _downscale_crf, _pregenerator
+    heights = {parse_height(q) for q in config.get('available_qualities', [])}
+    _ladder = sorted(h for h in heights if h) or list(DEFAULT_LADDER)
+    _derive_enabled = bool(config.get('cache_derive_lower_qualities', True))
+    _serve_closest = bool(config.get('cache_serve_closest_quality', False))
+    _downscale_preset = config.get('cache_downscale_preset', 'veryfast')
+    _downscale_crf = int(config.get('cache_downscale_crf', 23))
+    rungs = [h for h in (parse_height(q) for q in config.get('cache_pregenerate_qualities', DEFAULT_PREGENERATE))
+             if h in _ladder]
+    _pregenerator = RungPregenerator(rungs, config.get('cache_pregenerate_min_hits', DEFAULT_PREGENERATE_MIN_HITS))
+    if rungs:
+        _pregenerator.start()
+    print(f"[DEBUG] Quality ladder: {_ladder}, derive lower qualities {'on' if _derive_enabled else 'off'}, "
+          f"pregenerate {rungs}")
+
+
+def cached_renditions(video_id):
+    """Готовые файлы кэша видео с известной высотой кадра: [{'height', 'quality', 'path', 'hits'}]."""
+    renditions = []
+    for entry in get_cache_index().entries_for_video(video_id):
+        height = parse_height(entry['quality'])
+        if height:
+            entry['height'] = height
+            renditions.append(entry)
+    return renditions
+
+
+def find_rendition(video_id, height, allow_closest=None):
+    """Закэшированный файл для высоты height.
+
+    Файл той же высоты подходит всегда (quality могло быть записано как
+    '360' или '360p'). С allow_closest (по умолчанию cache_serve_closest_quality)
+    подходит ближайшее по высоте качество; при равенстве - более высокое.
+    """
+    renditions = cached_renditions(video_id)
+    for rendition in renditions:
+        if rendition['height'] == height:
+            return rendition
+    if allow_closest is None:
+        allow_closest = _serve_closest
+    if not allow_closest or not renditions:
+        return None
+    return min(renditions, key=lambda r: (abs(r['height'] - height), -r['height']))
+
+
+def downscale_source(video_id, height):
+    """Наименьший закэшированный файл выше height, из которого можно получить height локально.
+
+    Получаются только ступени лестницы (available_qualities).
+    """
+    if not _derive_enabled or height not in _ladder:
+        return None
+    higher = [r for r in cached_renditions(video_id) if r['height'] > height]
+    return min(higher, key=lambda r: r['height']) if higher else None
+
+
+def build_downscale_cmd(source_path, height):
+    """Команда FFmpeg, уменьшающая закэшированный файл до height (fMP4 в stdout, аудио без перекодирования)."""
+    return [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin',
+        '-i', source_path,
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-vf', f'scale=-2:{int(height)}',
+        '-c:v', 'libx264', '-preset', _downscale_preset, '-crf', str(_downscale_crf),
+        '-c:a', 'copy',
+        '-movflags', 'frag_keyframe+empty_moov',
+        '-f', 'mp4',
+        '-'
+    ]
+
+
+class RungPregenerator:
+    """Фоновая подготовка нижних качеств (по умолчанию 144/240/360) для популярных видео.
+
+    Когда у закэшированного файла набирается min_hits просмотров, видео
+    ставится в очередь; один рабочий поток уменьшает этот файл до каждой
+    недостающей ступени. FFmpeg запускается через общий планировщик с
+    наименьшим приоритетом, поэтому не отнимает слоты у просмотров.
+    """
+
+    def __init__(self, rungs, min_hits=DEFAULT_PREGENERATE_MIN_HITS):
+        self.rungs = sorted(rungs)
+        self.min_hits = max(1, int(min_hits))
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {'queued': 0, 'generated': 0, 'failed': 0, 'skipped_busy': 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name='rung-pregenerator')
+            self._thread.start()
+
+    def maybe_enqueue(self, video_id, quality):
+        """Ставит видео в очередь, если его файл quality достаточно популярен и ступеней не хватает."""
+        if self._thread is None or not self.rungs:
+            return False
+        height = parse_height(quality)
+        if not height or height <= self.rungs[0]:
+            return False
+        with self._lock:
+            if video_id in self._pending:
+                return False
+        entry = get_cache_index().get(get_cache_path(video_id, quality))
+        if not entry or entry['hits'] < self.min_hits:
+            return False
+        cached_heights = {r['height'] for r in cached_renditions(video_id)}
+        if all(rung in cached_heights for rung in self.rungs if rung < height):
+            return False
+        with self._lock:
+            if video_id in self._pending:
+                return False
+            self._pending.add(video_id)
+            self._stats['queued'] += 1
+        self._queue.put(video_id)
+        return True
+
+    def _run(self):
+        while True:
+            video_id = self._queue.get()
+            try:
+                self._generate(video_id)
+            except Exception as e:
+                print(f"[ERROR] Pregenerating qualities for {video_id} failed: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(video_id)
+
+    def _generate(self, video_id):
+        for rung in self.rungs:
+            cache_path = get_cache_path(video_id, str(rung))
+            if is_video_cached(video_id, str(rung)) or get_in_progress_entry(cache_path) is not None:
+                continue
+            if find_rendition(video_id, rung, allow_closest=False):
+                continue
+            source = downscale_source(video_id, rung)
+            if source is None:
+                continue
+            slot = get_transcode_scheduler().acquire(PRIORITY_BACKGROUND, timeout=PREGENERATE_SLOT_TIMEOUT)
+            if slot is None:
+                with self._lock:
+                    self._stats['skipped_busy'] += 1
+                return
+            print(f"Pregenerating {video_id} {rung}p from cached {source['quality']}")
+            pipeline = StreamPipeline(build_downscale_cmd(source['path'], rung), slot=slot, name='ffmpeg-downscale')
+            try:
+                pipeline.start()
+            except Exception as e:
+                print(f"[ERROR] Error starting FFmpeg for {video_id} {rung}p: {e}")
+                return
+            manifest = {'video_id': video_id, 'quality': str(rung), 'derived_from': source['quality']}
+            cache_entry = start_cache_entry(cache_path, manifest=manifest)
+            pipeline.pump_to(cache_entry)
+            with self._lock:
+                self._stats['generated' if cache_entry.ok else 'failed'] += 1
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._stats)
+            metrics['pending'] = len(self._pending)
+        metrics['rungs'] = self.rungs
+        metrics['min_hits'] = self.min_hits
+        return metrics
+
+
+def maybe_pregenerate(video_id, quality):
+    """Ставит в очередь подготовку нижних качеств, если видео популярно."""
+    if _pregenerator is None:
+        return False
+    try:
+        return _pregenerator.maybe_enqueue(video_id, quality)
+    except Exception as e:
+        print(f"[ERROR] Error checking pregeneration for {video_id}: {e}")
+        return False
+
+
+def pregenerator_metrics():
+    return _pregenerator.metrics() if _pregenerator is not None else {}
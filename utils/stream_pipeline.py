@@ -0,0 +1,333 @@
+import errno
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import deque
+
+from .fmp4 import FragmentIndex
+
+DEFAULT_CHUNK_SIZE = 65536
+# Сколько ждать выхода процесса после terminate() перед kill()
+TERMINATE_GRACE_SECONDS = 5
+# Последние строки stderr, которые печатаются при ошибке процесса
+STDERR_TAIL_LINES = 20
+# Так FFmpeg сообщает, что googlevideo отказал в чтении: истекла подписанная ссылка
+UPSTREAM_EXPIRED = re.compile(r'\b403\b|Forbidden')
+# Сколько раз один поток продолжается с новыми ссылками
+MAX_RESUMES = 3
+# Сколько байт продолженного потока можно пропустить в поисках следующего фрагмента
+RESUME_SKIP_LIMIT = 64 * 1024 * 1024
+
+# Настройки по умолчанию, задаются из config.json через configure()
+_chunk_size = DEFAULT_CHUNK_SIZE
+_use_splice = True
+
+
+class _Reaper:
+    """Один фоновый поток, добивающий (kill) процессы, не вышедшие после terminate().
+
+    cancel() часто вызывается при закрытии генератора ответа, где запускать
+    по потоку на каждый процесс нельзя (например, при завершении интерпретатора).
+    """
+
+    def __init__(self):
+        self._pending = []  # [(deadline, pipeline)]
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def watch(self, pipeline, deadline):
+        with self._cond:
+            if self._thread is None:
+                # Не запущен (configure() не вызывался) - остаётся только terminate()
+                return
+            self._pending.append((deadline, pipeline))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = [item for item in self._pending if item[0] <= now]
+                self._pending = [item for item in self._pending if item[0] > now]
+                if not due:
+                    self._cond.wait(min(deadline for deadline, _ in self._pending) - now)
+            for _, pipeline in due:
+                pipeline._kill_if_running()
+
+
+_reaper = _Reaper()
+
+
+def configure(config):
+    """Читает stream_chunk_size и stream_use_splice из конфигурации."""
+    global _chunk_size, _use_splice
+    try:
+        _chunk_size = max(4096, int(config.get('stream_chunk_size', DEFAULT_CHUNK_SIZE)))
+    except (TypeError, ValueError):
+        _chunk_size = DEFAULT_CHUNK_SIZE
+    _use_splice = bool(config.get('stream_use_splice', True))
+    _reaper.start()
+    print(f"[DEBUG] Stream pipeline: chunk size {_chunk_size}, splice {'on' if _use_splice and splice_available() else 'off'}")
+
+
+def splice_available():
+    """os.splice есть только в Linux и Python 3.10+."""
+    return hasattr(os, 'splice')
+
+
+class StreamPipeline:
+    """Процесс (FFmpeg), отдающий поток в stdout, и всё, что нужно для его отдачи.
+
+    Владеет жизненным циклом процесса: запуск, чтение stderr (хвост
+    сохраняется для логов), отдача stdout клиенту или в файл кэша,
+    отмена (terminate, затем kill) и ожидание завершения.
+
+    stdout читается напрямую из дескриптора кусками chunk_size. При записи
+    в кэш данные по возможности переносятся из pipe в файл через os.splice,
+    не проходя через Python. Backpressure при отдаче клиенту обеспечивает
+    сам pipe: пока клиент не прочитал кусок, FFmpeg блокируется на записи.
+
+    slot - разрешение планировщика FFmpeg (TranscodeSlot); освобождается,
+    когда процесс остановлен или не смог запуститься.
+
+    resume(seconds) - команда, продолжающая тот же fMP4 с момента seconds
+    (с -copyts, по заново подписанным ссылкам). Если вход оборвался с 403,
+    процесс перезапускается этой командой с начала последнего фрагмента;
+    из её вывода пропускаются init-сегмент и уже отданные фрагменты, так
+    что клиент и файл кэша получают непрерывный поток (с пропуском не
+    больше одной группы кадров на месте обрыва).
+    """
+
+    def __init__(self, cmd, chunk_size=None, use_splice=None, name='ffmpeg', slot=None, resume=None):
+        self.cmd = cmd
+        self.resume = resume
+        self.resumes = 0
+        self.chunk_size = chunk_size or _chunk_size
+        self.use_splice = (_use_splice if use_splice is None else use_splice) and splice_available()
+        self.name = name
+        self.slot = slot
+        self.process = None
+        self.stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._stderr_thread = None
+
+    def start(self):
+        """Запускает процесс. FileNotFoundError, если исполняемый файл не найден."""
+        try:
+            self._spawn(self.cmd)
+        except Exception:
+            self._release_slot()
+            raise
+        return self
+
+    def _spawn(self, cmd):
+        self.process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=0
+        )
+        self._stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_thread.start()
+
+    def _drain_stderr(self):
+        try:
+            for line in iter(self.process.stderr.readline, b''):
+                self.stderr_tail.append(line.decode('utf-8', 'replace').rstrip())
+        except Exception:
+            pass
+
+    def _read(self):
+        return os.read(self.process.stdout.fileno(), self.chunk_size)
+
+    def iter_chunks(self):
+        """Отдаёт stdout процесса кусками; по окончании или отключении клиента останавливает процесс."""
+        index = FragmentIndex() if self.resume is not None else None
+        try:
+            while True:
+                chunk = self._read()
+                if not chunk:
+                    if index is None or self._cancelled:
+                        break
+                    self.wait(timeout=10)
+                    chunk = self._resume_after_expiry(index)
+                    if chunk is None:
+                        break
+                if index is not None:
+                    index.feed(chunk)
+                yield chunk
+        except Exception as e:
+            print(f"[ERROR] {self.name}: error reading output: {e}")
+        finally:
+            self.cancel()
+            self._release_slot()
+
+    def pump_to(self, cache_entry):
+        """Переписывает stdout в файл кэша до конца потока, затем завершает запись.
+
+        Файл попадает в кэш, только если процесс завершился с кодом 0 и не был отменён.
+        """
+        ok = False
+        try:
+            use_splice = self.use_splice
+            while True:
+                use_splice = self._pump_output(cache_entry, use_splice)
+                code = self.wait(timeout=10)
+                if self._cancelled:
+                    break
+                if self._upstream_expired():
+                    resumed = self._resume_after_expiry(cache_entry.fragment_index)
+                    if resumed is None:
+                        break
+                    cache_entry.append(resumed)
+                    continue
+                ok = code == 0
+                break
+        except Exception as e:
+            print(f"[ERROR] {self.name}: error writing cache file: {e}")
+        finally:
+            if not ok:
+                self._log_failure()
+            self.cancel()
+            self._release_slot()
+            cache_entry.finish(ok)
+
+    def _pump_output(self, cache_entry, use_splice):
+        """Переносит stdout текущего процесса в файл кэша до EOF; возвращает, работает ли splice."""
+        fd = self.process.stdout.fileno()
+        while True:
+            if use_splice:
+                try:
+                    moved = cache_entry.append_from_fd(fd, self.chunk_size)
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                        raise
+                    # Файловая система не поддерживает splice - обычное копирование
+                    use_splice = False
+                    continue
+                if not moved:
+                    return use_splice
+            else:
+                chunk = self._read()
+                if not chunk:
+                    return use_splice
+                cache_entry.append(chunk)
+
+    def _upstream_expired(self):
+        """Оборвался ли вход на 403 (истекла подписанная ссылка). Дожидается конца stderr."""
+        if self._stderr_thread:
+            self._stderr_thread.join(timeout=1)
+        return any(UPSTREAM_EXPIRED.search(line) for line in self.stderr_tail)
+
+    def _resume_after_expiry(self, index):
+        """Продолжает поток после обрыва входа с 403.
+
+        index описывает уже отданный поток. Процесс перезапускается командой
+        resume(seconds) с начала последнего фрагмента; возвращаются первые
+        байты продолжения (начиная с moof первого фрагмента после seconds)
+        или None, если продолжить нельзя.
+        """
+        if self.resume is None or self._cancelled or self.resumes >= MAX_RESUMES:
+            return None
+        if not self._upstream_expired():
+            return None
+        last = index.last_fragment()
+        if last is None or not index.at_box_boundary:
+            return None
+        seconds = last[1]
+        try:
+            cmd = self.resume(seconds)
+        except Exception as e:
+            print(f"[ERROR] {self.name}: error building resume command: {e}")
+            return None
+        if not cmd:
+            return None
+        self.resumes += 1
+        print(f"[DEBUG] {self.name}: upstream URL expired, resuming from {seconds:.1f}s (attempt {self.resumes})")
+        with self._lock:
+            if self._cancelled:
+                return None
+            self.stderr_tail.clear()
+            for pipe in (self.process.stdout, self.process.stderr):
+                try:
+                    pipe.close()
+                except Exception:
+                    pass
+            try:
+                self._spawn(cmd)
+            except Exception as e:
+                print(f"[ERROR] {self.name}: error restarting process: {e}")
+                return None
+        return self._skip_to_fragment_after(seconds)
+
+    def _skip_to_fragment_after(self, seconds):
+        """Читает вывод перезапущенного процесса до первого фрагмента, начинающегося позже seconds."""
+        probe = FragmentIndex()
+        data = bytearray()
+        while len(data) < RESUME_SKIP_LIMIT:
+            chunk = self._read()
+            if not chunk:
+                return None
+            data += chunk
+            probe.feed(chunk)
+            for offset, start in probe.fragments:
+                if start > seconds + 0.001:
+                    return bytes(data[offset:])
+        print(f"[ERROR] {self.name}: no fragment after {seconds:.1f}s in resumed stream")
+        return None
+
+    def tee_to_cache(self, cache_entry):
+        """Запускает запись в кэш в фоновом потоке."""
+        threading.Thread(target=self.pump_to, args=(cache_entry,), daemon=True).start()
+
+    def cancel(self):
+        """Останавливает процесс: terminate, а если он не вышел за TERMINATE_GRACE_SECONDS - kill."""
+        with self._lock:
+            process = self.process
+            if process is None or process.poll() is not None:
+                return
+            self._cancelled = True
+        try:
+            process.terminate()
+        except Exception:
+            return
+        _reaper.watch(self, time.monotonic() + TERMINATE_GRACE_SECONDS)
+
+    def _release_slot(self):
+        if self.slot is not None:
+            self.slot.release()
+
+    def _kill_if_running(self):
+        try:
+            if self.process.poll() is None:
+                print(f"[DEBUG] {self.name} did not exit after terminate, killing")
+                self.process.kill()
+        except Exception:
+            pass
+
+    def wait(self, timeout=None):
+        try:
+            return self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return None
+
+    def _log_failure(self):
+        if self._cancelled:
+            return
+        if self._stderr_thread:
+            self._stderr_thread.join(timeout=1)
+        code = self.process.poll() if self.process else None
+        print(f"[ERROR] {self.name} exited with code {code}")
+        for line in self.stderr_tail:
+            print(f"[ERROR]   {line}")
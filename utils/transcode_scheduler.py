@@ -0,0 +1,144 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+
+# Приоритеты: меньше - раньше
+PRIORITY_INTERACTIVE = 0  # /direct_url, перемотка - клиент ждёт первый байт
+PRIORITY_DOWNLOAD = 10  # /download
+PRIORITY_BACKGROUND = 20  # фоновая подготовка нижних качеств из кэша
+
+DEFAULT_MAX_PER_CORE = 1.0
+DEFAULT_MAX_QUEUE = 32
+DEFAULT_QUEUE_TIMEOUT = 15
+DEFAULT_RETRY_AFTER = 5
+
+
+class TranscodeSlot:
+    """Разрешение на запуск одного процесса FFmpeg; release() можно вызывать несколько раз."""
+
+    def __init__(self, scheduler, priority):
+        self._scheduler = scheduler
+        self.priority = priority
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._scheduler._release(self)
+
+
+class TranscodeScheduler:
+    """Ограничивает число одновременных процессов FFmpeg.
+
+    Запросы сверх лимита ждут в очереди с приоритетами (интерактивный
+    просмотр раньше скачиваний, внутри приоритета - по порядку прихода).
+    Если очередь полна или ожидание дольше queue_timeout, acquire()
+    возвращает None, и запрос получает 503 с Retry-After.
+    """
+
+    def __init__(self, max_concurrent, max_queue=DEFAULT_MAX_QUEUE, queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.max_queue = max(0, int(max_queue))
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._running = 0
+        self._waiters = []  # heap of [priority, seq, event, slot]
+        self._seq = itertools.count()
+        self._stats = {'admitted': 0, 'queued': 0, 'dequeued': 0, 'rejected_full': 0, 'rejected_timeout': 0,
+                       'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0}
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """Возвращает TranscodeSlot или None, если запрос не допущен."""
+        timeout = self.queue_timeout if timeout is None else timeout
+        with self._lock:
+            if self._running < self.max_concurrent and not self._waiters:
+                self._running += 1
+                self._stats['admitted'] += 1
+                return TranscodeSlot(self, priority)
+            if len(self._waiters) >= self.max_queue:
+                self._stats['rejected_full'] += 1
+                return None
+            waiter = [priority, next(self._seq), threading.Event(), None]
+            heapq.heappush(self._waiters, waiter)
+            self._stats['queued'] += 1
+
+        started = time.monotonic()
+        waiter[2].wait(timeout)
+        waited = time.monotonic() - started
+        with self._lock:
+            if waiter[3] is None:
+                # Не дождались: убираем себя из очереди
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+                self._stats['rejected_timeout'] += 1
+                return None
+            self._stats['dequeued'] += 1
+            self._stats['wait_seconds_total'] += waited
+            self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], waited)
+            return waiter[3]
+
+    def _release(self, slot):
+        with self._lock:
+            if self._waiters:
+                # Слот переходит следующему в очереди, счётчик running не меняется
+                waiter = heapq.heappop(self._waiters)
+                waiter[3] = TranscodeSlot(self, waiter[0])
+                self._stats['admitted'] += 1
+                waiter[2].set()
+            else:
+                self._running -= 1
+
+    def metrics(self):
+        with self._lock:
+            queued_by_priority = {}
+            for waiter in self._waiters:
+                queued_by_priority[waiter[0]] = queued_by_priority.get(waiter[0], 0) + 1
+            metrics = dict(self._stats)
+            metrics.update({
+                'running': self._running,
+                'max_concurrent': self.max_concurrent,
+                'queue_depth': len(self._waiters),
+                'queue_depth_interactive': queued_by_priority.get(PRIORITY_INTERACTIVE, 0),
+                'queue_depth_download': queued_by_priority.get(PRIORITY_DOWNLOAD, 0),
+                'queue_depth_background': queued_by_priority.get(PRIORITY_BACKGROUND, 0),
+                'max_queue': self.max_queue,
+            })
+        dequeued = metrics['dequeued']
+        metrics['wait_seconds_avg'] = metrics['wait_seconds_total'] / dequeued if dequeued else 0.0
+        return metrics
+
+
+_scheduler = None
+_retry_after = DEFAULT_RETRY_AFTER
+
+
+def init_transcode_scheduler(config):
+    """Создаёт общий планировщик по настройкам transcode_* из config.json."""
+    global _scheduler, _retry_after
+    cores = os.cpu_count() or 1
+    per_core = float(config.get('transcode_max_per_core', DEFAULT_MAX_PER_CORE))
+    max_concurrent = max(1, int(cores * per_core))
+    _scheduler = TranscodeScheduler(
+        max_concurrent,
+        config.get('transcode_max_queue', DEFAULT_MAX_QUEUE),
+        config.get('transcode_queue_timeout', DEFAULT_QUEUE_TIMEOUT)
+    )
+    _retry_after = int(config.get('transcode_retry_after', DEFAULT_RETRY_AFTER))
+    print(f"[DEBUG] Transcode scheduler: {max_concurrent} concurrent FFmpeg processes ({cores} cores), queue {_scheduler.max_queue}")
+    return _scheduler
+
+
+def get_transcode_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = TranscodeScheduler(max(1, int((os.cpu_count() or 1) * DEFAULT_MAX_PER_CORE)))
+    return _scheduler
+
+
+def get_retry_after():
+    return _retry_after
@@ -0,0 +1,214 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+# Ссылка считается годной, пока до её истечения больше EXPIRY_MARGIN секунд
+EXPIRY_MARGIN = 300
+# Если в ссылке нет параметра expire
+DEFAULT_TTL = 3600
+DEFAULT_REFRESH_AHEAD = 900
+DEFAULT_HOT_WINDOW = 1800
+DEFAULT_REFRESH_INTERVAL = 60
+DEFAULT_REFRESH_PER_PASS = 10
+MAX_ENTRIES = 50000
+# Как долго ждать переизвлечения, уже начатого другим потоком
+REFRESH_WAIT_TIMEOUT = 120
+
+
+def get_url_expire(url):
+    """Возвращает unix-время истечения подписанной ссылки googlevideo (параметр expire) или None."""
+    if not url:
+        return None
+    try:
+        parsed = urlparse(url)
+        values = parse_qs(parsed.query).get('expire')
+        if values:
+            return int(values[0])
+        # Манифесты HLS/DASH хранят параметры в пути: /expire/1700000000/
+        m = re.search(r'/expire/(\d+)', parsed.path)
+        if m:
+            return int(m.group(1))
+    except (ValueError, TypeError):
+        pass
+    return None
+
+
+class _ResolvedURL:
+    __slots__ = ('url', 'expires_at', 'last_used', 'uses')
+
+    def __init__(self, url, expires_at):
+        self.url = url
+        self.expires_at = expires_at
+        self.last_used = 0.0
+        self.uses = 0
+
+
+class ResolvedURLStore:
+    """Подписанные ссылки googlevideo по (video_id, format_id) со временем истечения.
+
+    Ссылки попадают сюда из каждого извлечения yt-dlp (put_formats), expire
+    берётся из параметра ссылки. url() отдаёт ссылку, пока до истечения
+    больше EXPIRY_MARGIN секунд; touch() отмечает, что формат отдаётся.
+
+    Фоновый поток раз в interval секунд переизвлекает видео, форматы
+    которых использовались за последние hot_window секунд и истекают в
+    ближайшие refresh_ahead секунд (не больше per_pass видео за проход), -
+    популярные видео получают новые ссылки до того, как старые перестанут
+    работать. refresh(video_id) - внеочередное переизвлечение (например,
+    когда поток получил 403); одновременные вызовы для видео объединяются.
+    """
+
+    def __init__(self, refresh=None, refresh_ahead=DEFAULT_REFRESH_AHEAD, hot_window=DEFAULT_HOT_WINDOW,
+                 interval=DEFAULT_REFRESH_INTERVAL, per_pass=DEFAULT_REFRESH_PER_PASS, max_entries=MAX_ENTRIES):
+        self._refresh_fn = refresh
+        self.refresh_ahead = refresh_ahead
+        self.hot_window = hot_window
+        self.interval = interval
+        self.per_pass = max(1, int(per_pass))
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (video_id, format_id) -> _ResolvedURL
+        self._refreshing = {}  # video_id -> (threading.Event, {'ok': результат ведущего})
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {'stored': 0, 'hits': 0, 'expired': 0, 'refreshed': 0, 'refresh_failed': 0,
+                       'background_refreshes': 0}
+
+    def start(self):
+        if self._thread is None and self._refresh_fn is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name='url-refresher')
+            self._thread.start()
+
+    def put_formats(self, video_id, formats):
+        """Запоминает ссылки всех форматов из извлечения, сохраняя статистику использования."""
+        now = time.time()
+        with self._lock:
+            for f in formats or []:
+                format_id, url = f.get('format_id'), f.get('url')
+                if not format_id or not url:
+                    continue
+                key = (video_id, str(format_id))
+                entry = _ResolvedURL(url, get_url_expire(url) or now + DEFAULT_TTL)
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    entry.last_used, entry.uses = old.last_used, old.uses
+                self._entries[key] = entry
+                self._stats['stored'] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def url(self, video_id, format_id):
+        """Годная ссылка формата или None, если её нет или она скоро истечёт."""
+        with self._lock:
+            entry = self._entries.get((video_id, str(format_id)))
+            if entry is None:
+                return None
+            if entry.expires_at - EXPIRY_MARGIN <= time.time():
+                self._stats['expired'] += 1
+                return None
+            self._stats['hits'] += 1
+            return entry.url
+
+    def touch(self, video_id, format_id):
+        """Отмечает, что формат видео отдаётся клиенту (для фонового обновления)."""
+        with self._lock:
+            entry = self._entries.get((video_id, str(format_id)))
+            if entry is not None:
+                entry.last_used = time.time()
+                entry.uses += 1
+                self._entries.move_to_end((video_id, str(format_id)))
+
+    def expires_at(self, video_id, format_id):
+        with self._lock:
+            entry = self._entries.get((video_id, str(format_id)))
+            return entry.expires_at if entry is not None else None
+
+    def refresh(self, video_id):
+        """Переизвлекает видео (новые ссылки всех форматов). True, если удалось."""
+        if self._refresh_fn is None:
+            return False
+        with self._lock:
+            flight = self._refreshing.get(video_id)
+            is_leader = flight is None
+            if is_leader:
+                flight = (threading.Event(), {'ok': False})
+                self._refreshing[video_id] = flight
+        event, result = flight
+        if not is_leader:
+            # Результат ведущего; не дождались - ссылки не обновлены
+            if not event.wait(REFRESH_WAIT_TIMEOUT):
+                return False
+            return result['ok']
+        ok = False
+        try:
+            ok = bool(self._refresh_fn(video_id))
+        except Exception as e:
+            print(f"[ERROR] Error refreshing stream URLs of {video_id}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.pop(video_id, None)
+                self._stats['refreshed' if ok else 'refresh_failed'] += 1
+            result['ok'] = ok
+            event.set()
+        return ok
+
+    def _due_for_refresh(self, now):
+        """Видео с недавно использованными форматами, ссылки которых скоро истекут, - раньше истекающие первыми."""
+        due = {}
+        with self._lock:
+            for (video_id, _), entry in self._entries.items():
+                if now - entry.last_used > self.hot_window or entry.expires_at - now > self.refresh_ahead:
+                    continue
+                if video_id not in due or entry.expires_at < due[video_id]:
+                    due[video_id] = entry.expires_at
+        return sorted(due, key=due.get)[:self.per_pass]
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                for video_id in self._due_for_refresh(time.time()):
+                    with self._lock:
+                        self._stats['background_refreshes'] += 1
+                    self.refresh(video_id)
+            except Exception as e:
+                print(f"[ERROR] URL refresh pass failed: {e}")
+
+    def metrics(self):
+        now = time.time()
+        with self._lock:
+            metrics = dict(self._stats)
+            metrics['entries'] = len(self._entries)
+            metrics['hot'] = sum(1 for entry in self._entries.values() if now - entry.last_used <= self.hot_window)
+        metrics['refresh_ahead'] = self.refresh_ahead
+        metrics['hot_window'] = self.hot_window
+        return metrics
+
+
+_store = ResolvedURLStore()
+
+
+def configure(config, refresh=None):
+    """Читает url_refresh_* из config.json; refresh(video_id) - переизвлечение видео."""
+    global _store
+    store = ResolvedURLStore(
+        refresh=refresh,
+        refresh_ahead=float(config.get('url_refresh_ahead', DEFAULT_REFRESH_AHEAD)),
+        hot_window=float(config.get('url_refresh_hot_window', DEFAULT_HOT_WINDOW)),
+        interval=float(config.get('url_refresh_interval', DEFAULT_REFRESH_INTERVAL)),
+        per_pass=config.get('url_refresh_max_per_pass', DEFAULT_REFRESH_PER_PASS),
+    )
+    # Уже извлечённые ссылки переносятся в новое хранилище
+    with _store._lock:
+        store._entries = OrderedDict(_store._entries)
+    _store = store
+    if config.get('url_refresh_enabled', True):
+        _store.start()
+    print(f"[DEBUG] Resolved URL store: background refresh "
+          f"{'on' if _store._thread is not None else 'off'}, {_store.refresh_ahead:.0f}s before expiry")
+    return _store
+
+
+def get_url_store():
+    return _store
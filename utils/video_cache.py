@@ -2,28 +2,362 @@ import os
 import time
 import threading
 import json
-from datetime import datetime, timedelta
+import hashlib
+import shutil
+from .fmp4 import FragmentIndex, index_file
+from .cache_index import CacheIndex
+from . import cache_eviction
+from .cache_admission import create_admission_filter
+from .hot_cache import get_hot_tier
 
-# Simple in-memory cache tracking for video requests
-video_request_counts = {}
 video_cache_lock = threading.Lock()
 
-# Path to the video views tracking file
-VIEWS_TRACKING_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'assets', 'temp', 'video_views.json')
+# Request frequency for cache admission (TinyLFU sketch, fixed memory)
+_admission = create_admission_filter({})
+
+# Cache files that are still being written: cache_path -> InProgressCacheEntry
+_in_progress_entries = {}
+_in_progress_lock = threading.Lock()
+
+# How long a tailing reader waits for new bytes before giving up on a stalled writer
+TAIL_IDLE_TIMEOUT = 60
+
+# Cache files are written as <name>.part and renamed only after a successful write.
+# <name>.json is the sidecar manifest describing the finished file.
+PARTIAL_SUFFIX = '.part'
+MANIFEST_SUFFIX = '.json'
+
+# Directory holding the cache shards, the views tracking file and the cache index
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'assets', 'temp')
+
+# Cache files are stored as CACHE_DIR/<aa>/<bb>/<key>.mp4 (key = sha1 of video id and quality),
+# so 65536 leaf directories keep every directory small even with millions of cached files
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+# Path to the video views tracking file (superseded by the cache index, read once to migrate)
+VIEWS_TRACKING_FILE = os.path.join(CACHE_DIR, 'video_views.json')
+
+# SQLite index of finished cache files: sizes, hits, last access
+CACHE_INDEX_FILE = os.path.join(CACHE_DIR, 'cache_index.sqlite3')
+
+DEFAULT_MAX_CACHE_SIZE_MB = 5120
+
+# YouTube video ids are 11 characters, so a flat-layout <id>_<quality>.mp4 splits unambiguously
+VIDEO_ID_LENGTH = 11
+
+_cache_index = None
+_cache_index_lock = threading.Lock()
+_cache_janitor = None
+
+# Requests served from the cache (finished or in-progress file) vs. ones that needed a new mux
+_cache_lookups = {'hits': 0, 'misses': 0}
+
+def get_cache_key(video_id, quality=None):
+    """Name of the cache file of a video in a quality (sha1 hex, whatever characters the id has)"""
+    return hashlib.sha1(f"{video_id}/{quality or ''}".encode('utf-8')).hexdigest()
 
 def get_cache_path(video_id, quality=None):
-    """Get the file path for cached video"""
-    cache_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'assets', 'temp')
-    if quality:
-        filename = f"{video_id}_{quality}.mp4"
-    else:
-        filename = f"{video_id}.mp4"
-    return os.path.join(cache_dir, filename)
+    """Get the file path for cached video: CACHE_DIR/<aa>/<bb>/<key>.mp4"""
+    key = get_cache_key(video_id, quality)
+    shards = [key[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+    return os.path.join(CACHE_DIR, *shards, key + '.mp4')
 
 def is_video_cached(video_id, quality=None):
-    """Check if video is already cached with the specific quality"""
+    """Check if video is already cached with the specific quality.
+
+    Files that are still being written are not considered cached.
+    """
     cache_path = get_cache_path(video_id, quality)
-    return os.path.exists(cache_path)
+    return os.path.exists(cache_path) and get_in_progress_entry(cache_path) is None
+
+def get_partial_path(cache_path):
+    """Temporary path a cache file is written to before it is complete."""
+    return cache_path + PARTIAL_SUFFIX
+
+def get_manifest_path(cache_path):
+    """Path of the sidecar manifest for a cache file."""
+    return cache_path + MANIFEST_SUFFIX
+
+def load_cache_manifest(cache_path):
+    """Load the sidecar manifest of a cache file, or None if there is none."""
+    try:
+        with open(get_manifest_path(cache_path), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error loading cache manifest for {cache_path}: {e}")
+        return {}
+
+def save_cache_manifest(cache_path, manifest):
+    """Atomically write the sidecar manifest of a cache file."""
+    manifest_path = get_manifest_path(cache_path)
+    tmp_path = manifest_path + PARTIAL_SUFFIX
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path)
+
+def remove_cache_file(cache_path):
+    """Remove a cache file together with its partial file, manifest, index row and hot-tier copy."""
+    get_hot_tier().invalidate(cache_path)
+    try:
+        get_cache_index().remove(cache_path)
+    except Exception as e:
+        print(f"Error removing {cache_path} from cache index: {e}")
+    for path in (cache_path, get_partial_path(cache_path), get_manifest_path(cache_path)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error removing cache file {path}: {e}")
+
+def _fsync_dir(dir_path):
+    """Persist a rename in dir_path (no-op where directories can't be opened)."""
+    if os.name == 'nt':
+        return
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+class InProgressCacheEntry:
+    """A cache file that is being written while readers follow it.
+
+    The writer appends chunks; any number of readers tail the growing file
+    and block until new bytes arrive or the writer finishes (EOF). When the
+    last reader leaves before the writer is done, on_abandon is called so
+    the producing process can be stopped.
+
+    Data goes to a .part file that is fsynced and renamed to the final
+    cache path only when the writer reports success, so a cache file that
+    exists under its final name is always complete.
+
+    While writing, fragment_index records the moof offsets and their start
+    times, so seeks into already produced data can be served immediately.
+    """
+
+    def __init__(self, path, on_abandon=None, manifest=None):
+        self.path = path
+        self.partial_path = get_partial_path(path)
+        self.on_abandon = on_abandon
+        self.manifest = dict(manifest or {})
+        self.size = 0
+        self.done = False
+        self.ok = False
+        self.readers = 0
+        self.fragment_index = FragmentIndex()
+        self._stale_partial = False
+        self._cond = threading.Condition()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.manifest.update({'status': 'writing', 'started_at': time.time()})
+        save_cache_manifest(path, self.manifest)
+        # Unbuffered so that every append is visible to readers immediately;
+        # readable so the fragment index can scan what was spliced in
+        self._file = open(self.partial_path, 'w+b', buffering=0)
+
+    def append(self, chunk):
+        """Write a chunk and wake up waiting readers."""
+        self._file.write(chunk)
+        self.fragment_index.feed(chunk)
+        with self._cond:
+            self.size += len(chunk)
+            self._cond.notify_all()
+
+    def append_from_fd(self, fd, max_bytes):
+        """Move up to max_bytes from a pipe straight into the file with os.splice.
+
+        The data does not pass through Python; the fragment index reads back
+        only the box headers. Returns the number of bytes moved, 0 at EOF.
+        """
+        moved = os.splice(fd, self._file.fileno(), max_bytes)
+        if moved:
+            self.fragment_index.feed_file(self._file.fileno(), self.size + moved)
+            with self._cond:
+                self.size += moved
+                self._cond.notify_all()
+        return moved
+
+    def _commit(self):
+        """fsync the data, mark the manifest complete and rename into place."""
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self.manifest.update({'status': 'complete', 'size': self.size, 'completed_at': time.time()})
+        if self.fragment_index.codecs:
+            self.manifest['codecs'] = list(self.fragment_index.codecs)
+        save_cache_manifest(self.path, self.manifest)
+        self._move_into_place()
+        _fsync_dir(os.path.dirname(self.path))
+        try:
+            get_cache_index().add(self.path, self.manifest.get('video_id', ''), self.manifest.get('quality'), self.size)
+        except Exception as e:
+            print(f"Error adding {self.path} to cache index: {e}")
+
+    def _move_into_place(self):
+        """Rename the .part file to the final cache path.
+
+        On Windows files are opened without FILE_SHARE_DELETE, so a reader
+        still tailing the .part makes the rename fail. The data is then
+        copied to the final path instead, and the .part is removed once
+        the last of those readers has closed it.
+        """
+        try:
+            os.replace(self.partial_path, self.path)
+            return
+        except PermissionError as e:
+            print(f"Cache file {self.partial_path} is still open ({e}), copying it into place")
+        copy_path = get_partial_path(self.path + '.copy')
+        shutil.copyfile(self.partial_path, copy_path)
+        with open(copy_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(copy_path, self.path)
+        with self._cond:
+            self._stale_partial = True
+        self._remove_stale_partial()
+
+    def _remove_stale_partial(self):
+        """Remove the .part left behind by a copying commit once no reader holds it open."""
+        with self._cond:
+            if not self._stale_partial or self.readers:
+                return
+            self._stale_partial = False
+        # A new writer for the same path reuses the .part name
+        if get_in_progress_entry(self.path) not in (None, self):
+            return
+        try:
+            os.remove(self.partial_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # Removed at the next startup by discard_partial_cache_files
+            print(f"Error removing partial cache file {self.partial_path}: {e}")
+
+    def finish(self, ok):
+        """Mark the entry as complete (ok=True) or failed and release readers.
+
+        A failed or empty write is discarded instead of being left behind
+        as a truncated cache file.
+        """
+        ok = ok and self.size > 0
+        try:
+            if ok:
+                self._commit()
+            else:
+                self._file.close()
+        except Exception as e:
+            print(f"Error finalizing cache file {self.path}: {e}")
+            ok = False
+        if not ok:
+            # Readers keep their open handles, so the data they follow stays readable
+            for path in (self.partial_path, get_manifest_path(self.path)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    print(f"Error removing partial cache file {path}: {e}")
+        with _in_progress_lock:
+            if _in_progress_entries.get(self.path) is self:
+                del _in_progress_entries[self.path]
+        with self._cond:
+            self.done = True
+            self.ok = ok
+            self._cond.notify_all()
+        if ok:
+            check_and_cleanup_cache()
+
+    def _add_reader(self):
+        with self._cond:
+            self.readers += 1
+
+    def _remove_reader(self):
+        with self._cond:
+            self.readers -= 1
+            abandoned = self.readers == 0 and not self.done
+            stale_partial = self.readers == 0 and self._stale_partial
+        if stale_partial:
+            self._remove_stale_partial()
+        if abandoned and self.on_abandon:
+            try:
+                self.on_abandon()
+            except Exception as e:
+                print(f"Error abandoning in-progress cache entry {self.path}: {e}")
+
+    def _open_for_read(self):
+        try:
+            return open(self.partial_path, 'rb')
+        except FileNotFoundError:
+            # The write may have been committed before this reader started
+            with self._cond:
+                committed = self.done and self.ok
+            if committed:
+                return open(self.path, 'rb')
+            raise
+
+    def iter_from(self, offset=0, chunk_size=65536, end=None):
+        """Yield the file contents from offset (up to end, exclusive), following the writer until EOF."""
+        return self.iter_ranges([(offset, end)], chunk_size)
+
+    def iter_ranges(self, ranges, chunk_size=65536):
+        """Yield several [start, end) byte ranges in order as one stream.
+
+        end=None means "until the writer finishes". The whole stream counts
+        as a single reader, so the writer is not abandoned between ranges.
+        """
+        self._add_reader()
+        try:
+            try:
+                f = self._open_for_read()
+            except FileNotFoundError:
+                print(f"Cache file {self.path} disappeared before it could be read")
+                return
+            with f:
+                for offset, end in ranges:
+                    f.seek(offset)
+                    while end is None or offset < end:
+                        with self._cond:
+                            while self.size <= offset and not self.done:
+                                if not self._cond.wait(TAIL_IDLE_TIMEOUT):
+                                    print(f"Writer of {self.path} stalled, closing reader")
+                                    return
+                            available = self.size - offset
+                        if available <= 0:
+                            # Writer finished and everything has been read
+                            return
+                        if end is not None:
+                            available = min(available, end - offset)
+                        chunk = f.read(min(chunk_size, available))
+                        if not chunk:
+                            return
+                        offset += len(chunk)
+                        yield chunk
+        finally:
+            self._remove_reader()
+
+def start_cache_entry(cache_path, on_abandon=None, manifest=None):
+    """Create and register an in-progress entry for cache_path.
+
+    manifest holds what is known up front (video_id, quality, expected
+    duration); size and status are filled in by the entry itself.
+    """
+    entry = InProgressCacheEntry(cache_path, on_abandon, manifest)
+    with _in_progress_lock:
+        if cache_path in _in_progress_entries:
+            print(f"Replacing in-progress cache entry for {cache_path}")
+        _in_progress_entries[cache_path] = entry
+    return entry
+
+def get_in_progress_entry(cache_path):
+    """Return the in-progress entry for cache_path, or None if it is not being written."""
+    with _in_progress_lock:
+        return _in_progress_entries.get(cache_path)
 
 def get_cached_video_size(video_id, quality=None):
     """Get the size of cached video file"""
@@ -32,33 +366,39 @@ def get_cached_video_size(video_id, quality=None):
         return os.path.getsize(cache_path)
     return 0
 
-def record_video_request(video_id):
+def _admission_key(video_id, quality=None):
+    # Same granularity as cache files: one entry per video and quality
+    return f"{video_id}_{quality}" if quality else video_id
+
+def record_video_request(video_id, quality=None):
     """Record a video request for frequency tracking"""
-    with video_cache_lock:
-        now = time.time()
-        if video_id not in video_request_counts:
-            video_request_counts[video_id] = []
-        
-        # Add current request timestamp
-        video_request_counts[video_id].append(now)
-        
-        # Remove requests older than 1 hour
-        cutoff = now - 3600  # 1 hour
-        video_request_counts[video_id] = [
-            timestamp for timestamp in video_request_counts[video_id] 
-            if timestamp > cutoff
-        ]
-        
-        # Return request count in the last hour
-        return len(video_request_counts[video_id])
-
-def should_cache_video(video_id, request_threshold=5):
-    """Determine if video should be cached based on request frequency"""
-    request_count = record_video_request(video_id)
-    return request_count >= request_threshold
+    _admission.record(_admission_key(video_id, quality))
+
+def should_cache_video(video_id, quality=None):
+    """Record a cache miss and decide whether the video should be written to the cache.
+
+    When the cache is full, the video must be requested more often than the
+    file the eviction policy would remove for it.
+    """
+    key = _admission_key(video_id, quality)
+    _admission.record(key)
+    victim_key = None
+    if _admission.mode == 'tinylfu':
+        try:
+            victim = get_cache_janitor().victim()
+        except Exception as e:
+            print(f"Error looking up eviction victim: {e}")
+            victim = None
+        if victim is not None:
+            victim_key = _admission_key(victim['video_id'], victim['quality'])
+    admitted = _admission.should_admit(key, victim_key)
+    if not admitted:
+        print(f"Not caching {key}: estimated {_admission.estimate(key)} recent requests"
+              + (f", eviction victim {victim_key}" if victim_key else ''))
+    return admitted
 
 def load_video_views():
-    """Load video views from the tracking file"""
+    """Load video views from the legacy tracking file"""
     try:
         if os.path.exists(VIEWS_TRACKING_FILE):
             with open(VIEWS_TRACKING_FILE, 'r', encoding='utf-8') as f:
@@ -67,121 +407,306 @@ def load_video_views():
         print(f"Error loading video views: {e}")
     return {}
 
-def save_video_views(views_data):
-    """Save video views to the tracking file"""
+def _parse_cache_filename(path):
+    """Split a flat-layout <video_id>[_<quality>].mp4 into (video_id, quality)."""
+    name = os.path.basename(path)[:-len('.mp4')]
+    if len(name) > VIDEO_ID_LENGTH and name[VIDEO_ID_LENGTH] == '_':
+        return name[:VIDEO_ID_LENGTH], name[VIDEO_ID_LENGTH + 1:]
+    return name, None
+
+def _is_shard_name(name):
+    return len(name) == SHARD_WIDTH and all(ch in '0123456789abcdef' for ch in name)
+
+def _iter_shard_dirs(path=None, level=1):
+    """Leaf directories of the sharded layout that exist on disk."""
+    try:
+        with os.scandir(path or CACHE_DIR) as it:
+            shards = [entry.path for entry in it if _is_shard_name(entry.name) and entry.is_dir()]
+    except FileNotFoundError:
+        return
+    for shard in sorted(shards):
+        if level == SHARD_LEVELS:
+            yield shard
+        else:
+            yield from _iter_shard_dirs(shard, level + 1)
+
+def _scan_cache_files():
+    """path -> (size, mtime) for every finished cache file."""
+    files = {}
+    for shard in _iter_shard_dirs():
+        with os.scandir(shard) as it:
+            for dir_entry in it:
+                if not dir_entry.name.endswith('.mp4') or not dir_entry.is_file():
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except OSError:
+                    continue
+                files[dir_entry.path] = (stat.st_size, stat.st_mtime)
+    return files
+
+def _describe_cache_file(path):
+    """(video_id, quality) of a cache file from its manifest, or None if it has none."""
+    manifest = load_cache_manifest(path)
+    if not manifest or not manifest.get('video_id'):
+        return None
+    return manifest['video_id'], manifest.get('quality')
+
+def _flat_cache_files():
+    """Cache files left in CACHE_DIR itself by the flat layout."""
+    try:
+        with os.scandir(CACHE_DIR) as it:
+            return sorted(entry.path for entry in it if entry.name.endswith('.mp4') and entry.is_file())
+    except FileNotFoundError:
+        return []
+
+def get_cache_index():
+    """The shared cache index, opened on first use."""
+    global _cache_index
+    with _cache_index_lock:
+        if _cache_index is None:
+            _cache_index = CacheIndex(CACHE_INDEX_FILE, CACHE_DIR)
+        return _cache_index
+
+def _megabytes_to_bytes(value, default_mb):
+    try:
+        return int(float(value) * 1024 * 1024)
+    except (TypeError, ValueError):
+        return default_mb * 1024 * 1024
+
+def init_cache_index(config):
+    """Open the cache index, reconcile it with the cache directory and start the janitor.
+
+    Meant to run at startup after discard_partial_cache_files(). This is the
+    only full scan of the directory; view counts from the legacy
+    video_views.json are carried over to files that were not indexed yet.
+
+    The janitor keeps the cache under cache_max_size_mb (and under
+    cache_quality_caps_mb per quality) with cache_eviction_policy.
+    cache_admission_* configure which missed videos get cached at all.
+    """
+    global _cache_janitor, _admission
+    _admission = create_admission_filter(config)
+    index = get_cache_index()
+    try:
+        index.reconcile(_scan_cache_files(), _describe_cache_file, load_video_views())
+    except Exception as e:
+        print(f"Error reconciling cache index: {e}")
+
+    max_bytes = _megabytes_to_bytes(config.get('cache_max_size_mb', DEFAULT_MAX_CACHE_SIZE_MB), DEFAULT_MAX_CACHE_SIZE_MB)
+    quality_caps = {
+        str(quality): _megabytes_to_bytes(cap, DEFAULT_MAX_CACHE_SIZE_MB)
+        for quality, cap in (config.get('cache_quality_caps_mb') or {}).items()
+    }
+    _cache_janitor = cache_eviction.CacheJanitor(
+        index,
+        cache_eviction.create_policy(config),
+        max_bytes,
+        quality_caps,
+        remove=remove_cache_file,
+        is_busy=lambda path: get_in_progress_entry(path) is not None,
+        high_watermark=float(config.get('cache_high_watermark', cache_eviction.DEFAULT_HIGH_WATERMARK)),
+        low_watermark=float(config.get('cache_low_watermark', cache_eviction.DEFAULT_LOW_WATERMARK)),
+        interval=float(config.get('cache_janitor_interval', cache_eviction.DEFAULT_JANITOR_INTERVAL)),
+    )
+    print(f"[DEBUG] Cache index: {index.count()} files, {index.total_size() / 1024 / 1024:.1f} MB "
+          f"of {max_bytes // 1024 // 1024} MB, eviction policy {_cache_janitor.policy.name}")
+    flat = _flat_cache_files()
+    if flat:
+        print(f"[WARNING] {len(flat)} cache files in the old flat layout in {CACHE_DIR} are not used; "
+              f"run migrate_cache.py to move them into the sharded layout")
+    _cache_janitor.start()
+    _cache_janitor.wake()
+    return index
+
+def get_cache_janitor():
+    """The janitor started by init_cache_index, or one with default settings."""
+    global _cache_janitor
+    with _cache_index_lock:
+        if _cache_janitor is None:
+            _cache_janitor = cache_eviction.CacheJanitor(
+                _cache_index or CacheIndex(CACHE_INDEX_FILE, CACHE_DIR),
+                cache_eviction.create_policy({}),
+                DEFAULT_MAX_CACHE_SIZE_MB * 1024 * 1024,
+                remove=remove_cache_file,
+                is_busy=lambda path: get_in_progress_entry(path) is not None,
+            )
+        return _cache_janitor
+
+def increment_video_view_count(video_id, quality=None):
+    """Count a view served from the cache (hit count and last access in the cache index)"""
+    with video_cache_lock:
+        _cache_lookups['hits'] += 1
+    record_video_request(video_id, quality)
     try:
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(VIEWS_TRACKING_FILE), exist_ok=True)
-        with open(VIEWS_TRACKING_FILE, 'w', encoding='utf-8') as f:
-            json.dump(views_data, f, ensure_ascii=False, indent=2)
+        get_cache_index().record_hit(get_cache_path(video_id, quality))
     except Exception as e:
-        print(f"Error saving video views: {e}")
+        print(f"Error recording view of {video_id}: {e}")
+
+def record_cache_miss(video_id, quality=None):
+    """Count a request that could not be served from the cache"""
+    with video_cache_lock:
+        _cache_lookups['misses'] += 1
 
-def increment_video_view_count(video_id):
-    """Increment the view count for a video"""
+def get_cache_stats():
+    """Cache size, per-quality usage, hit ratio and janitor counters"""
+    index = get_cache_index()
     with video_cache_lock:
-        views_data = load_video_views()
-        if video_id not in views_data:
-            views_data[video_id] = {
-                'views': 0,
-                'last_accessed': time.time()
-            }
-        views_data[video_id]['views'] += 1
-        views_data[video_id]['last_accessed'] = time.time()
-        save_video_views(views_data)
+        lookups = dict(_cache_lookups)
+    total = lookups['hits'] + lookups['misses']
+    return {
+        'files': index.count(),
+        'size_bytes': index.total_size(),
+        'qualities': {quality or 'default': {'size_bytes': size, 'files': count}
+                      for quality, (size, count) in index.quality_sizes().items()},
+        'hits': lookups['hits'],
+        'misses': lookups['misses'],
+        'hit_ratio': lookups['hits'] / total if total else 0.0,
+        'janitor': get_cache_janitor().metrics(),
+        'admission': _admission.metrics(),
+    }
 
 def get_temp_folder_size():
-    """Get the total size of the temp folder in bytes"""
-    cache_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'assets', 'temp')
-    if not os.path.exists(cache_dir):
-        return 0
-    
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(cache_dir):
-        for filename in filenames:
-            if filename.endswith('.mp4'):
-                filepath = os.path.join(dirpath, filename)
-                try:
-                    total_size += os.path.getsize(filepath)
-                except Exception:
-                    pass
-    return total_size
+    """Get the total size of the cached videos in bytes"""
+    return get_cache_index().total_size()
 
 def cleanup_cache_if_needed(max_size_bytes):
-    """Clean up cache if it exceeds the maximum size"""
-    cache_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'assets', 'temp')
-    if not os.path.exists(cache_dir):
-        return
-    
-    current_size = get_temp_folder_size()
-    if current_size <= max_size_bytes:
-        return
-    
-    # Load video views data
-    views_data = load_video_views()
-    
-    # Get all cached video files with their sizes and last access times
-    video_files = []
-    for filename in os.listdir(cache_dir):
-        if filename.endswith('.mp4'):
-            filepath = os.path.join(cache_dir, filename)
+    """Evict cached videos in eviction-policy order until the cache is at most max_size_bytes"""
+    get_cache_janitor().evict_to(max_size_bytes)
+
+def check_and_cleanup_cache(max_size_mb=None, cleanup_threshold_mb=100):
+    """Check if cache needs cleanup and perform it if necessary
+
+    Without max_size_mb this only wakes the background janitor, which applies
+    the configured limits and watermarks; with it, evicts synchronously."""
+    janitor = get_cache_janitor()
+    try:
+        if max_size_mb is not None:
+            cleanup_cache_if_needed(max_size_mb * 1024 * 1024)
+        elif janitor.running:
+            janitor.wake()
+        else:
+            janitor.run_once()
+    except Exception as e:
+        print(f"Error cleaning up cache: {e}")
+
+def discard_partial_cache_files():
+    """Remove leftovers of interrupted cache writes.
+
+    Meant to run at startup, when no writer can be active: every .part file
+    is an orphan, and a cache file whose manifest is missing or not complete,
+    or whose size differs from the recorded one, is treated as broken.
+    Files already indexed with their current size are complete (they are
+    indexed only after the rename) and their manifests are not read.
+    """
+    try:
+        indexed = get_cache_index().sizes()
+    except Exception as e:
+        print(f"Error reading cache index: {e}")
+        indexed = {}
+
+    removed = 0
+    for shard in _iter_shard_dirs():
+        with os.scandir(shard) as it:
+            entries = {dir_entry.name: dir_entry for dir_entry in it}
+        for filename, dir_entry in entries.items():
+            filepath = dir_entry.path
             try:
-                file_size = os.path.getsize(filepath)
-                last_modified = os.path.getmtime(filepath)
-                
-                # Extract video_id from filename
-                video_id = filename.replace('.mp4', '')
-                if '_' in video_id:
-                    video_id = video_id.split('_')[0]
-                
-                # Get view count or use 0 if not tracked
-                view_count = views_data.get(video_id, {}).get('views', 0)
-                last_accessed = views_data.get(video_id, {}).get('last_accessed', last_modified)
-                
-                video_files.append({
-                    'filepath': filepath,
-                    'filename': filename,
-                    'size': file_size,
-                    'video_id': video_id,
-                    'view_count': view_count,
-                    'last_accessed': last_accessed
-                })
+                if filename.endswith(PARTIAL_SUFFIX):
+                    os.remove(filepath)
+                    removed += 1
+                elif filename.endswith('.mp4'):
+                    size = dir_entry.stat().st_size
+                    if indexed.get(filepath) == size and filename + MANIFEST_SUFFIX in entries:
+                        continue
+                    manifest = load_cache_manifest(filepath)
+                    if not manifest or manifest.get('status') != 'complete' or manifest.get('size') != size:
+                        remove_cache_file(filepath)
+                        removed += 1
+                elif filename.endswith('.mp4' + MANIFEST_SUFFIX):
+                    if filename[:-len(MANIFEST_SUFFIX)] not in entries:
+                        os.remove(filepath)
             except Exception as e:
-                print(f"Error getting file info for {filename}: {e}")
-    
-    # Sort by view count (ascending) and last accessed time (ascending)
-    # This will prioritize deleting least viewed and least recently accessed files
-    video_files.sort(key=lambda x: (x['view_count'], x['last_accessed']))
-    
-    # Calculate how many files to delete (10% of total files)
-    files_to_delete = max(1, len(video_files) // 10)
-    
-    # Delete the least popular files
-    bytes_freed = 0
-    deleted_count = 0
-    
-    for video_file in video_files:
-        if deleted_count >= files_to_delete:
-            break
-            
+                print(f"Error checking cache file {filepath}: {e}")
+
+    if removed:
+        print(f"Discarded {removed} partial or broken cache files.")
+
+def migrate_flat_cache(dry_run=False):
+    """Move cache files of the flat layout ({video_id}_{quality}.mp4 in CACHE_DIR) into the sharded layout.
+
+    Each moved file gets a complete manifest with video_id, quality, codecs
+    and size, and keeps the hits and last access of its index row. Broken
+    files and leftover .part files are deleted. Meant to be run once, while
+    the server is stopped. Returns (moved, skipped).
+    """
+    index = get_cache_index()
+    moved = skipped = 0
+    for filepath in _flat_cache_files():
+        filename = os.path.basename(filepath)
         try:
-            os.remove(video_file['filepath'])
-            bytes_freed += video_file['size']
-            deleted_count += 1
-            print(f"Removed cached video file: {video_file['filename']} ({video_file['size']} bytes)")
+            size = os.path.getsize(filepath)
+            manifest = load_cache_manifest(filepath)
+            if manifest is not None and (manifest.get('status') != 'complete' or manifest.get('size') != size):
+                print(f"Skipping broken cache file {filename}")
+                if not dry_run:
+                    remove_cache_file(filepath)
+                skipped += 1
+                continue
+            manifest = manifest or {}
+            video_id = manifest.get('video_id')
+            name = filename[:-len('.mp4')]
+            if video_id and name == video_id:
+                quality = None
+            elif video_id and name.startswith(video_id + '_'):
+                quality = name[len(video_id) + 1:]
+            else:
+                video_id, quality = _parse_cache_filename(filepath)
+
+            target = get_cache_path(video_id, quality)
+            if os.path.exists(target):
+                print(f"Skipping {filename}: {os.path.relpath(target, CACHE_DIR)} already exists")
+                skipped += 1
+                continue
+            print(f"{filename} -> {os.path.relpath(target, CACHE_DIR)}")
+            if dry_run:
+                moved += 1
+                continue
+
+            codecs = manifest.get('codecs')
+            if not codecs:
+                try:
+                    codecs = index_file(filepath).codecs
+                except Exception as e:
+                    print(f"Error reading codecs of {filename}: {e}")
+            manifest.update({'video_id': video_id, 'quality': quality, 'status': 'complete', 'size': size,
+                             'migrated_at': time.time()})
+            if codecs:
+                manifest['codecs'] = list(codecs)
+            row = index.get(filepath)
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            save_cache_manifest(target, manifest)
+            os.replace(filepath, target)
+            _fsync_dir(os.path.dirname(target))
+            remove_cache_file(filepath)
+            index.add(target, video_id, quality, size,
+                      hits=row['hits'] if row else 0,
+                      last_access=row['last_access'] if row else os.path.getmtime(target))
+            moved += 1
         except Exception as e:
-            print(f"Error removing cached video file {video_file['filename']}: {e}")
-    
-    print(f"Cache cleanup completed. Deleted {deleted_count} files, freed {bytes_freed} bytes.")
+            print(f"Error migrating cache file {filename}: {e}")
+            skipped += 1
 
-def check_and_cleanup_cache(max_size_mb=5120, cleanup_threshold_mb=100):
-    """Check if cache needs cleanup and perform it if necessary
-    Default max_size_mb is 5120 (5GB)"""
-    max_size_bytes = max_size_mb * 1024 * 1024
-    # cleanup_threshold_bytes = cleanup_threshold_mb * 1024 * 1024
-    
-    current_size = get_temp_folder_size()
-    
-    # If we're over the 5GB limit, trigger cleanup
-    if current_size > max_size_bytes:
-        cleanup_cache_if_needed(max_size_bytes)
\ No newline at end of file
+    if os.path.isdir(CACHE_DIR) and not dry_run:
+        for filename in os.listdir(CACHE_DIR):
+            filepath = os.path.join(CACHE_DIR, filename)
+            if filename.endswith(PARTIAL_SUFFIX) or (
+                    filename.endswith('.mp4' + MANIFEST_SUFFIX) and not os.path.exists(filepath[:-len(MANIFEST_SUFFIX)])):
+                try:
+                    os.remove(filepath)
+                except OSError as e:
+                    print(f"Error removing {filename}: {e}")
+
+    print(f"Cache migration {'(dry run) ' if dry_run else ''}finished: {moved} moved, {skipped} skipped.")
+    return moved, skipped
\ No newline at end of file
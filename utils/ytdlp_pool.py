@@ -0,0 +1,92 @@
+import queue
+import threading
+
+try:
+    import yt_dlp
+except ImportError:  # yt-dlp как python-модуль не установлен, доступен только бинарник
+    yt_dlp = None
+
+# Параметры YoutubeDL, эквивалентные запуску бинарника с --dump-json
+BASE_YDL_OPTIONS = {
+    'quiet': True,
+    'no_warnings': True,
+    'skip_download': True,
+    'noprogress': True,
+}
+
+
+def is_available():
+    """Проверяет, можно ли использовать встроенный движок yt-dlp."""
+    return yt_dlp is not None
+
+
+class YoutubeDLPool:
+    """Пул прогретых экземпляров yt_dlp.YoutubeDL, отдельный для каждого файла cookies.
+
+    Экземпляр YoutubeDL не потокобезопасен, поэтому каждый рабочий экземпляр
+    одновременно обслуживает только одно извлечение. Экстракторы и cookie jar
+    загружаются один раз при создании экземпляра и переиспользуются.
+    """
+
+    def __init__(self, size=2, extra_options=None):
+        self.size = max(1, int(size))
+        self.extra_options = extra_options or {}
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _build_instance(self, cookie_file):
+        options = dict(BASE_YDL_OPTIONS)
+        options.update(self.extra_options)
+        if cookie_file:
+            options['cookiefile'] = cookie_file
+        return yt_dlp.YoutubeDL(options)
+
+    def _get_pool(self, cookie_file):
+        key = cookie_file or ''
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = queue.Queue()
+                for _ in range(self.size):
+                    pool.put(None)  # Экземпляры создаются лениво при первом использовании
+                self._pools[key] = pool
+            return pool
+
+    def extract_info(self, url, cookie_file=None, timeout=None):
+        """Извлекает info dict (как --dump-json) на одном из прогретых экземпляров."""
+        pool = self._get_pool(cookie_file)
+        try:
+            ydl = pool.get(timeout=timeout)
+        except queue.Empty:
+            print(f"[ERROR] yt-dlp pool busy, no free worker for {url}")
+            return None
+
+        try:
+            if ydl is None:
+                ydl = self._build_instance(cookie_file)
+            info = ydl.extract_info(url, download=False)
+            return ydl.sanitize_info(info) if info else None
+        except Exception as e:
+            print(f"[ERROR] yt-dlp pool extraction failed for {url}: {e}")
+            # Экземпляр после ошибки может быть в неконсистентном состоянии - пересоздаём
+            ydl = None
+            return None
+        finally:
+            pool.put(ydl)
+
+    def warm_up(self, cookie_files):
+        """Заранее создаёт экземпляры для перечисленных файлов cookies."""
+        for cookie_file in cookie_files or [None]:
+            pool = self._get_pool(cookie_file)
+            instances = []
+            while True:
+                try:
+                    instances.append(pool.get_nowait())
+                except queue.Empty:
+                    break
+            for ydl in instances:
+                try:
+                    pool.put(ydl or self._build_instance(cookie_file))
+                except Exception as e:
+                    print(f"[ERROR] Failed to warm up yt-dlp instance: {e}")
+                    pool.put(None)
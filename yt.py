@@ -26,6 +26,14 @@ def create_app():
     from routes.search_routes import search_bp, setup_search_routes
     from routes.channel_routes import channel_bp, setup_channel_routes
     from routes.additional_routes import additional_bp, setup_additional_routes
+    from utils.helpers import init_ytdlp_backend
+    from utils.http_client import configure as configure_http_client
+    from utils.api_cache import init_api_cache
+    from utils.api_keys import init_api_keys
+    from utils.file_serving import uses_x_sendfile
+
+    # Keep-alive connection pools shared by all upstream calls
+    configure_http_client(config)
 
     # Setup routes with configuration
     setup_auth_routes(
@@ -40,7 +48,15 @@ def create_app():
         ]
     )
    
+    # yt-dlp extraction backend (subprocess binary or warm in-process pool)
+    init_ytdlp_backend(config)
+    # Data API keys are picked by remaining quota; responses are cached (in-process or Redis)
+    init_api_keys(config)
+    init_api_cache(config)
+
     setup_video_routes(config)
+    # Cached files can be handed off to Apache/lighttpd via X-Sendfile
+    app.config['USE_X_SENDFILE'] = uses_x_sendfile()
     setup_search_routes(config)
     setup_channel_routes(config)
     setup_additional_routes(config)